@@ -0,0 +1,404 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A local HTTP stub of the AgileZen v1 API, for benchmarks.
+
+Only the resources used by Pikpoint are implemented, in memory.
+"""
+
+
+import BaseHTTPServer
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+PHASE_NAMES = ('Backlog', 'Ready', 'Working', 'Done', 'Archive')
+
+# Only filters on phases, e.g. 'phase:"Ready" or phase:"Working"', are
+# supported.
+_PHASE_FILTER_RE = re.compile(r'phase:"((?:[^"\\]|\\.)*)"')
+
+
+class NotFound(Exception):
+    pass
+
+
+class AgileZenStub(object):
+    """The in-memory state and request handling of the API stub.
+    """
+
+    def __init__(self, latency=0.0):
+        """Initialize this stub.
+
+        Args:
+            latency: The time to wait before answering every request,
+                in seconds.  Defaults to 0.
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.projects = {}
+        # The number of requests, by HTTP method.
+        self.calls = collections.Counter()
+        # The number of connections accepted.
+        self.accepted_connections = 0
+        self._ids = itertools.count(1)
+        self._routes = [
+            (re.compile(pattern), handler) for pattern, handler in (
+                (r'^projects/(\d+)$', self._project),
+                (r'^projects/(\d+)/phases$', self._phases),
+                (r'^projects/(\d+)/tags$', self._tags),
+                (r'^projects/(\d+)/tags/(\d+)$', self._tag),
+                (r'^projects/(\d+)/stories$', self._stories),
+                (r'^projects/(\d+)/stories/(\d+)$', self._story),
+                (r'^projects/(\d+)/stories/(\d+)/tags$', self._story_tags),
+                (r'^projects/(\d+)/stories/(\d+)/tasks$', self._story_tasks),
+                (r'^projects/(\d+)/stories/(\d+)/tasks/(\d+)$',
+                 self._story_task),
+                )]
+        self._server = None
+        self._thread = None
+
+    def add_project(self, name='Benchmark', phase_names=PHASE_NAMES):
+        """Adds an empty project.
+
+        Returns:
+            The ID of the new project.
+        """
+        project_id = self._ids.next()
+        self.projects[project_id] = {
+            'json': {
+                'id': project_id,
+                'name': name,
+                'description': '',
+                'createTime': datetime.datetime.now().strftime(TIME_FORMAT),
+                'owner': {'id': 1, 'name': 'Owner', 'userName': 'owner',
+                          'email': 'owner@example.com'},
+                },
+            'phases': [{'id': self._ids.next(), 'name': phase_name,
+                        'description': '', 'index': i}
+                       for i, phase_name in enumerate(phase_names)],
+            'tags': collections.OrderedDict(),
+            'stories': collections.OrderedDict(),
+            }
+        return project_id
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+            self.accepted_connections = 0
+
+    def _get_project(self, project_id):
+        project = self.projects.get(int(project_id))
+        if project is None:
+            raise NotFound()
+        return project
+
+    def _get_story(self, project_id, story_id):
+        story = self._get_project(project_id)['stories'].get(int(story_id))
+        if story is None:
+            raise NotFound()
+        return story
+
+    @staticmethod
+    def _page(items, query):
+        page = int(query.get('page', 1))
+        page_size = int(query.get('pageSize', 100))
+        total_pages = max((len(items) + page_size - 1) // page_size, 1)
+        return {
+            'page': page,
+            'pageSize': page_size,
+            'totalPages': total_pages,
+            'totalItems': len(items),
+            'items': items[(page-1)*page_size:page*page_size],
+            }
+
+    def _get_tags(self, project, json_tags):
+        tags = []
+        for json_tag in json_tags:
+            tag_id = project['tags'].get(json_tag['name'])
+            if tag_id is None:
+                tag_id = self._ids.next()
+                project['tags'][json_tag['name']] = tag_id
+            tags.append({'id': tag_id, 'name': json_tag['name']})
+        return tags
+
+    def _new_task(self, json_task):
+        return {
+            'id': self._ids.next(),
+            'text': json_task['text'],
+            'createTime': datetime.datetime.now().strftime(TIME_FORMAT),
+            'status': json_task.get('status', 'incomplete'),
+            }
+
+    @staticmethod
+    def _story_json(story, enrichments):
+        # Like AgileZen, omit the fields without values.
+        json_story = dict([(field, value) for field, value in story.iteritems()
+                           if value is not None])
+        for enrichment in ('details', 'tags', 'tasks'):
+            if enrichment not in enrichments:
+                json_story.pop(enrichment, None)
+        return json_story
+
+    def _project(self, method, query, body, project_id):
+        return self._get_project(project_id)['json']
+
+    def _phases(self, method, query, body, project_id):
+        return self._page(self._get_project(project_id)['phases'], query)
+
+    def _tags(self, method, query, body, project_id):
+        project = self._get_project(project_id)
+        if method == 'POST':
+            return self._get_tags(project, [body])[0]
+        return self._page([{'id': tag_id, 'name': name}
+                           for name, tag_id in project['tags'].iteritems()],
+                          query)
+
+    def _tag(self, method, query, body, project_id, tag_id):
+        project = self._get_project(project_id)
+        for name, id_ in project['tags'].items():
+            if id_ == int(tag_id):
+                del project['tags'][name]
+                for story in project['stories'].itervalues():
+                    story['tags'] = [tag for tag in story['tags']
+                                     if tag['id'] != id_]
+                return None
+        raise NotFound()
+
+    def _stories(self, method, query, body, project_id):
+        project = self._get_project(project_id)
+        if method == 'POST':
+            phases = dict([(phase['id'], phase)
+                           for phase in project['phases']])
+            story = {
+                'id': self._ids.next(),
+                'text': body.get('text'),
+                'details': body.get('details'),
+                'size': body.get('size'),
+                'priority': body.get('priority'),
+                'color': body.get('color', 'grey'),
+                'phase': phases.get(body.get('phase', {}).get('id'),
+                                    project['phases'][0]),
+                'creator': project['json']['owner'],
+                'owner': body.get('owner'),
+                'tags': self._get_tags(project, body.get('tags', [])),
+                'tasks': [self._new_task(task)
+                          for task in body.get('tasks', [])],
+                }
+            project['stories'][story['id']] = story
+            return self._story_json(story, ('details', 'tags', 'tasks'))
+        enrichments = query.get('with', '').split(',')
+        stories = project['stories'].values()
+        if 'where' in query:
+            phase_names = set([
+                name.replace('\\"', '"')
+                for name in _PHASE_FILTER_RE.findall(query['where'])])
+            stories = [story for story in stories
+                       if story['phase']['name'] in phase_names]
+        return self._page([self._story_json(story, enrichments)
+                           for story in stories],
+                          query)
+
+    def _story(self, method, query, body, project_id, story_id):
+        project = self._get_project(project_id)
+        story = self._get_story(project_id, story_id)
+        if method == 'DELETE':
+            del project['stories'][story['id']]
+            return None
+        if method == 'PUT':
+            phases = dict([(phase['id'], phase)
+                           for phase in project['phases']])
+            for field in ('text', 'details', 'size', 'priority', 'color',
+                          'owner'):
+                if field in body:
+                    story[field] = body[field]
+            if 'phase' in body:
+                story['phase'] = phases[body['phase']['id']]
+            if 'tags' in body:
+                story['tags'] = self._get_tags(project, body['tags'])
+        return self._story_json(story, ('details', 'tags', 'tasks'))
+
+    def _story_tags(self, method, query, body, project_id, story_id):
+        project = self._get_project(project_id)
+        story = self._get_story(project_id, story_id)
+        story['tags'] = self._get_tags(project, body)
+        return self._story_json(story, ('details', 'tags', 'tasks'))
+
+    def _story_tasks(self, method, query, body, project_id, story_id):
+        story = self._get_story(project_id, story_id)
+        if method == 'POST':
+            task = self._new_task(body)
+            # Tasks created via the API are inserted first.
+            story['tasks'].insert(0, task)
+            return task
+        # Reorder the tasks.
+        tasks = dict([(task['id'], task) for task in story['tasks']])
+        story['tasks'] = [tasks[task_id] for task_id in body]
+        return story['tasks']
+
+    def _story_task(self, method, query, body, project_id, story_id,
+                    task_id):
+        story = self._get_story(project_id, story_id)
+        for task in story['tasks']:
+            if task['id'] == int(task_id):
+                if method == 'DELETE':
+                    story['tasks'].remove(task)
+                    return None
+                task['text'] = body.get('text', task['text'])
+                task['status'] = body.get('status', task['status'])
+                return task
+        raise NotFound()
+
+    def handle(self, method, path, query, body):
+        """Handles a request.
+
+        Args:
+            method: The HTTP method.
+            path: The path of the resource, relative to the API's base
+                URL.
+            query: The dict of query parameters.
+            body: The decoded JSON body, or None.
+
+        Returns:
+            A tuple (status_code, json_value).
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+            for pattern, handler in self._routes:
+                match = pattern.match(path)
+                if match is not None:
+                    try:
+                        return (200, handler(method, query, body,
+                                             *match.groups()))
+                    except NotFound:
+                        return (404, None)
+            return (404, None)
+
+    def start(self):
+        """Starts serving on a local port, in a background thread.
+
+        Returns:
+            The base URL of the API.
+        """
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            # Don't delay the responses' small writes.
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                url = urlparse.urlparse(self.path)
+                path = url.path[len('/api/v1/'):]
+                query = dict(urlparse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status_code, json_value = stub.handle(self.command, path,
+                                                      query, body)
+                data = json.dumps(json_value) if json_value is not None else ''
+                etag = None
+                if self.command == 'GET' and status_code == 200:
+                    etag = '"%s"' % (hashlib.sha1(data).hexdigest(),)
+                    if self.headers.get('If-None-Match') == etag:
+                        status_code = 304
+                        data = ''
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def __init__(self, server_address, handler_class):
+                BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                                   handler_class)
+                # The threads of the open connections, by socket.
+                self.connections_lock = threading.Lock()
+                self.connections = {}
+
+            def process_request(self, request, client_address):
+                thread = threading.Thread(
+                    target=self.process_request_thread,
+                    args=(request, client_address))
+                thread.daemon = True
+                with self.connections_lock:
+                    self.connections[request] = thread
+                with stub.lock:
+                    stub.accepted_connections += 1
+                thread.start()
+
+            def shutdown_request(self, request):
+                with self.connections_lock:
+                    self.connections.pop(request, None)
+                BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+            def handle_error(self, request, client_address):
+                # Ignore the connections closed by clients.
+                pass
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return 'http://127.0.0.1:%i/api/v1/' % (self._server.server_port,)
+
+    def stop(self):
+        """Stops serving, and waits for all connections to be closed.
+
+        The connections kept alive by clients are closed, so that
+        their threads don't outlive the stub, e.g. until the
+        interpreter exits.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            with self._server.connections_lock:
+                connections = self._server.connections.items()
+            for request, thread in connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                thread.join()
+            self._server = None
+            self._thread = None
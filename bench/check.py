@@ -0,0 +1,301 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Checks the readers of OmniFocus databases against fixtures.
+
+The fixtures are in the fixtures directory:
+
+  bundle.ofocus: A database bundle of a base transaction and of a
+      transaction updating, inserting, and deleting objects.
+  compacted.ofocus: The same database, compacted into a single
+      transaction.
+  export.json: An export of OmniFocus, as returned by the export script
+      of --ofocus-script, with the fields of objects in the order of
+      omnifocusscript.PROJECT_FIELDS, TASK_FIELDS, etc.
+
+Dates are checked in UTC.
+
+Usage: python bench/check.py
+"""
+
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, 'src'))
+
+import omnifocus
+import omnifocusbundle
+import omnifocusscript
+
+
+def _date(*args):
+    return datetime.datetime(*args)
+
+
+# The projects of the fixture bundles, in order.
+BUNDLE_PROJECTS = [
+    omnifocus.Project(
+        'pTaxes', 'Taxes', '', omnifocus.STATUS_ON_HOLD, False,
+        _date(2012, 9, 3, 9), None, _date(2012, 9, 1), 'fAdmin', None,
+        'Work, Admin', '', []),
+    omnifocus.Project(
+        'pBudget', 'Budget 2013', 'Spending\nLimits',
+        omnifocus.STATUS_ACTIVE, False, None, _date(2012, 9, 20, 8),
+        _date(2012, 9, 15, 9, 30), 'fAdmin', 'cPhone', 'Work, Admin',
+        'Office/Mobile', ['Office', 'Office/Mobile']),
+    omnifocus.Project(
+        'pGarden', 'Garden', '', omnifocus.STATUS_DONE, True, None, None,
+        _date(2012, 9, 10, 18), 'fHome', None, 'Home', '', []),
+    ]
+
+# The tasks of the fixture bundles, by project ID.  Sub-tasks, inbox
+# tasks, and deleted tasks are not read.
+BUNDLE_TASKS = {
+    'pTaxes': [
+        omnifocus.Task(
+            'tReturns', 'File the returns', '', False, None,
+            _date(2012, 10, 1), _date(2012, 9, 15, 9, 30), 'pTaxes',
+            'pTaxes', None, '', []),
+        ],
+    'pBudget': [
+        omnifocus.Task(
+            'tCall', 'Call the bank', '', True, None, None,
+            _date(2012, 9, 15, 9, 30), 'pBudget', 'pBudget', 'cPhone',
+            'Office/Mobile', ['Office', 'Office/Mobile']),
+        omnifocus.Task(
+            'tForm', 'Fill in the form', '', True, None, None,
+            _date(2012, 9, 1), 'pBudget', 'pBudget', None, '', []),
+        ],
+    'pGarden': [
+        omnifocus.Task(
+            'tSeeds', 'Buy seeds', '', True, None, None, _date(2012, 9, 1),
+            'pGarden', 'pGarden', 'cErrands', 'Errands', ['Errands']),
+        ],
+    }
+
+# The projects of the fixture export, in order.
+EXPORT_PROJECTS = [
+    omnifocus.Project(
+        'pBudget', 'Budget', 'Spending\nLimits', omnifocus.STATUS_ACTIVE,
+        False, None, _date(2012, 9, 20, 8), _date(2012, 9, 15, 9, 30),
+        'fAdmin', 'tPhone', 'Work, Admin', 'Office/Phone',
+        ['Office', 'Office/Phone']),
+    omnifocus.Project(
+        'pTaxes', 'Taxes', '', omnifocus.STATUS_ON_HOLD, False,
+        _date(2012, 9, 3, 9), None, _date(2012, 9, 1), 'fAdmin', None,
+        'Work, Admin', '', []),
+    omnifocus.Project(
+        'pGarden', 'Garden', '', omnifocus.STATUS_DONE, True, None, None,
+        _date(2012, 9, 10, 18), 'fHome', None, 'Home', '', []),
+    omnifocus.Project(
+        'pOld', 'Old', '', omnifocus.STATUS_DROPPED, False, None, None,
+        _date(2012, 9, 1), None, None, '', '', []),
+    ]
+
+# The tasks of the fixture export, by project ID.  The projects' root
+# tasks, sub-tasks, and inbox tasks are not read.
+EXPORT_TASKS = {
+    'pBudget': [
+        omnifocus.Task(
+            'tCall', 'Call the bank', 'Ask for Ann', True, None, None,
+            _date(2012, 9, 15, 9, 30), 'pBudget', 'rBudget', 'tPhone',
+            'Office/Phone', ['Office', 'Office/Phone']),
+        omnifocus.Task(
+            'tForm', 'Fill in the form', '', False, _date(2012, 9, 5, 7),
+            None, _date(2012, 9, 1), 'pBudget', 'rBudget', None, '', []),
+        ],
+    'pTaxes': [
+        omnifocus.Task(
+            'tReturns', 'File the returns', '', False, None,
+            _date(2012, 10, 1), _date(2012, 9, 15, 9, 30), 'pTaxes', None,
+            None, '', []),
+        ],
+    'pGarden': [
+        omnifocus.Task(
+            'tSeeds', 'Buy seeds', '', True, None, None,
+            _date(2012, 9, 9, 12), 'pGarden', 'rGarden', 'tErrands',
+            'Errands', ['Errands']),
+        ],
+    }
+
+
+def check_snapshot(name, snapshot, projects, project_tasks):
+    """Checks that a snapshot has the expected projects and tasks.
+
+    Args:
+        name: The name of the snapshot, to describe the mismatches.
+        snapshot: The omnifocus.OmniFocusSnapshot to check.
+        projects: The list of the expected Project objects, in order.
+        project_tasks: The dict of the lists of the expected Task
+            objects, by project ID.
+
+    Returns:
+        The list of the descriptions of the mismatches, if any.
+    """
+    errors = []
+    if snapshot.projects.keys() != [project.id for project in projects]:
+        errors.append('%s: projects %r, expected %r' % (
+                name, snapshot.projects.keys(),
+                [project.id for project in projects]))
+    for project in projects:
+        actual = snapshot.projects.get(project.id)
+        if actual is not None and actual != project:
+            errors.append('%s: project %r, expected %r' % (name, actual,
+                                                           project))
+    for project_id in sorted(set(snapshot.project_tasks)
+                             | set(project_tasks)):
+        actual = snapshot.project_tasks.get(project_id, [])
+        expected = project_tasks.get(project_id, [])
+        if actual != expected:
+            errors.append('%s: tasks of project %s %r, expected %r' % (
+                    name, project_id, actual, expected))
+    return errors
+
+
+def _read_records(bundle_path):
+    """Applies the transactions of a bundle with apply_transaction.
+
+    Returns:
+        The list of the states after every transaction, in order.
+    """
+    objects = dict([(name, {}) for name
+                    in omnifocusbundle.OBJECT_ELEMENT_NAMES])
+    states = []
+    for name in sorted(os.listdir(bundle_path)):
+        with zipfile.ZipFile(os.path.join(bundle_path, name)) as z:
+            with z.open(omnifocusbundle.CONTENTS_NAME) as f:
+                omnifocusbundle.apply_transaction(objects, f)
+        states.append(dict([(element_name, dict(records))
+                            for element_name, records
+                            in objects.iteritems()]))
+    return states
+
+
+def check_bundle():
+    """Checks OmniFocusBundleDataAccess against the fixture bundles.
+
+    The bundle is read transaction by transaction, from its cached
+    state, and again after it is compacted.
+
+    Returns:
+        The list of the descriptions of the mismatches, if any.
+    """
+    errors = []
+    base, updated = _read_records(os.path.join(FIXTURES_DIR,
+                                               'bundle.ofocus'))
+    # Empty elements.
+    if 'project' in base['task']['tCall']:
+        errors.append('task tCall is read as a project')
+    if base['task']['pTaxes'].get('context_id') is not None:
+        errors.append('empty context reference of pTaxes is not None')
+    if base['task']['tCall'].get('completed') is not None:
+        errors.append('empty completion date of tCall is not None')
+    # Updates and deletes.
+    if base['context']['cPhone'].get('name') != 'Phone':
+        errors.append('context cPhone is not named Phone before update')
+    if updated['context']['cPhone'].get('name') != 'Mobile':
+        errors.append('context cPhone is not renamed Mobile by update')
+    if 'pOld' not in base['task'] or 'pOld' in updated['task']:
+        errors.append('project pOld is not deleted by the transaction')
+    if updated['task']['tSeeds'] != base['task']['tSeeds']:
+        errors.append('task tSeeds is modified by a reference')
+
+    fixture_path = os.path.join(FIXTURES_DIR, 'bundle.ofocus')
+    base_name, delta_name = sorted(os.listdir(fixture_path))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        bundle_path = os.path.join(tmp_dir, 'OmniFocus.ofocus')
+        cache_path = os.path.join(tmp_dir, 'cache')
+        os.mkdir(bundle_path)
+        shutil.copy(os.path.join(fixture_path, base_name), bundle_path)
+        dao = omnifocusbundle.OmniFocusBundleDataAccess(
+            bundle_path, cache_path=cache_path)
+        dao.take_snapshot()
+        base_dao = omnifocusbundle.OmniFocusBundleDataAccess(bundle_path)
+        base_dao.take_snapshot()
+        # Apply the new transaction to the state of the base one.
+        shutil.copy(os.path.join(fixture_path, delta_name), bundle_path)
+        errors.extend(check_snapshot('bundle', dao.take_snapshot(),
+                                     BUNDLE_PROJECTS, BUNDLE_TASKS))
+        cached_dao = omnifocusbundle.OmniFocusBundleDataAccess(
+            bundle_path, cache_path=cache_path)
+        errors.extend(check_snapshot('cached bundle',
+                                     cached_dao.take_snapshot(),
+                                     BUNDLE_PROJECTS, BUNDLE_TASKS))
+        # Compact the database after only the base transaction was
+        # read, so that the deleted objects must be forgotten.
+        shutil.rmtree(bundle_path)
+        shutil.copytree(os.path.join(FIXTURES_DIR, 'compacted.ofocus'),
+                        bundle_path)
+        errors.extend(check_snapshot('compacted bundle',
+                                     base_dao.take_snapshot(),
+                                     BUNDLE_PROJECTS, BUNDLE_TASKS))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return errors
+
+
+def check_script():
+    """Checks OmniFocusScriptDataAccess against the fixture export.
+
+    The export is returned instead of running the export script.
+
+    Returns:
+        The list of the descriptions of the mismatches, if any.
+    """
+    with open(os.path.join(FIXTURES_DIR, 'export.json'), 'rb') as f:
+        text = f.read()
+    scripts = []
+
+    def run_script(script):
+        scripts.append(script)
+        return text
+
+    dao = omnifocusscript.OmniFocusScriptDataAccess(None,
+                                                    run_script=run_script)
+    errors = check_snapshot('export', dao.take_snapshot(), EXPORT_PROJECTS,
+                            EXPORT_TASKS)
+    if scripts != [dao.script]:
+        errors.append('export script run %i times, expected once'
+                      % (len(scripts),))
+    return errors
+
+
+def main():
+    # Check the dates independently of the local time zone.
+    os.environ['TZ'] = 'UTC'
+    time.tzset()
+    errors = check_bundle() + check_script()
+    for error in errors:
+        print 'ERROR: %s' % (error,)
+    if errors:
+        sys.exit(1)
+    print 'ok'
+
+
+if __name__ == '__main__':
+    main()
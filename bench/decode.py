@@ -0,0 +1,139 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures the cost of decoding AgileZen stories from JSON.
+
+The decoding of 1000 stories is timed without accessing their tasks
+and tags, as for unmodified stories, and with accessing them, as for
+modified stories.
+
+Usage: python bench/decode.py [--stories 1000] [--repeat 10]
+"""
+
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, 'src'))
+
+import agilezen
+
+
+BASE_DATE = datetime.datetime(2012, 9, 1)
+
+USER = {'id': 1, 'name': 'Owner', 'userName': 'owner',
+        'email': 'owner@example.com'}
+
+
+def generate_stories(count, tasks_per_story=10, tags_per_story=3):
+    """Generates the JSON text of a page of stories.
+
+    Args:
+        count: The number of stories.
+        tasks_per_story: The number of tasks in every story.
+        tags_per_story: The number of tags of every story.
+
+    Returns:
+        The JSON text of the page.
+    """
+    stories = []
+    for s in xrange(count):
+        create_time = BASE_DATE + datetime.timedelta(minutes=s)
+        stories.append({
+            'id': s,
+            'text': '**Project %i**\nFolder %i' % (s, s % 10),
+            'details': 'Notes of project %i\n[id](project-%i)' % (s, s),
+            'size': None,
+            'priority': None,
+            'color': 'green',
+            'phase': {'id': 2, 'name': 'Working', 'description': '',
+                      'index': 2},
+            'creator': USER,
+            'owner': USER,
+            'tags': [{'id': t, 'name': 'context %i' % (t,)}
+                     for t in xrange(tags_per_story)],
+            'tasks': [{'id': s * tasks_per_story + t,
+                       'text': 'Task %i of project %i' % (t, s),
+                       'createTime': (create_time + datetime.timedelta(
+                           seconds=t)).strftime(agilezen.TIME_FORMAT),
+                       'status': 'incomplete'}
+                      for t in xrange(tasks_per_story)],
+            })
+    return json.dumps({'page': 1, 'pageSize': count, 'totalPages': 1,
+                       'totalItems': count, 'items': stories})
+
+
+def time_decode(text, touch_nested, repeat):
+    """Times the decoding of a page of stories into Story objects.
+
+    The parsing of the JSON text itself is not timed.
+
+    Args:
+        text: The JSON text of the page.
+        touch_nested: Whether to iterate over the tasks and tags of
+            every story after decoding it.
+        repeat: The number of times to decode the page.
+
+    Returns:
+        The best time to decode the page, in seconds.
+    """
+    json_objs = json.loads(text)['items']
+    best = None
+    for _ in xrange(repeat):
+        start_time = time.time()
+        for json_obj in json_objs:
+            story = agilezen.Story.create_from_json(json_obj)
+            if touch_nested:
+                for task in story.tasks:
+                    task.text
+                for tag in story.tags:
+                    tag.name
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the decoding of AgileZen stories')
+    parser.add_argument(
+        '--stories', default=1000, type=int,
+        help='the number of stories to decode (default: %(default)i)')
+    parser.add_argument(
+        '--repeat', default=10, type=int,
+        help='the number of runs, of which the best is reported '
+             '(default: %(default)i)')
+    options = parser.parse_args()
+
+    text = generate_stories(options.stories)
+    for touch_nested in (False, True):
+        elapsed = time_decode(text, touch_nested, options.repeat)
+        print '%-32s %8.2f ms per 1k stories' % (
+            'decode + tasks and tags' if touch_nested else 'decode',
+            elapsed * 1000.0 * 1000.0 / options.stories)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,520 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""An in-process fake of the appscript module, backed by an object graph.
+
+Only the subset of appscript used by Pikpoint is implemented.  Every
+get() or set() on a reference counts as one Apple Event.  Call
+install() before importing the omnifocus module.
+
+OmniFocus's "evaluate javascript" command is faked by running the
+script with Node.js, against a fake of Omni Automation's objects.
+"""
+
+
+import collections
+import json
+import subprocess
+import sys
+import threading
+import time
+import types
+
+
+class Keyword(object):
+    """A fake AppleScript keyword, e.g. k.active.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'k.' + self.name
+
+
+class _Keywords(object):
+
+    def __init__(self):
+        self._keywords = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        keyword = self._keywords.get(name)
+        if keyword is None:
+            keyword = Keyword(name)
+            self._keywords[name] = keyword
+        return keyword
+
+
+k = _Keywords()
+
+
+class CommandError(Exception):
+    pass
+
+
+reference = types.ModuleType('appscript.reference')
+reference.CommandError = CommandError
+
+
+# The names of the elements of objects, and the classes of their
+# elements.
+ELEMENT_CLASSES = {
+    'flattened_projects': 'project',
+    'flattened_tasks': 'task',
+    'flattened_contexts': 'context',
+    'flattened_folders': 'folder',
+    'projects': 'project',
+    'tasks': 'task',
+    'contexts': 'context',
+    'folders': 'folder',
+    }
+
+
+class FakeObject(object):
+    """An object in a fake OmniFocus database.
+    """
+
+    __slots__ = ('cls', 'id', 'attrs', 'children')
+
+    def __init__(self, cls, obj_id, **attrs):
+        self.cls = cls
+        self.id = obj_id
+        self.attrs = attrs
+        self.children = []
+
+
+class FakeDatabase(object):
+    """A fake OmniFocus database, which counts Apple Events.
+    """
+
+    def __init__(self, latency=0.0):
+        """Initialize an empty database.
+
+        Args:
+            latency: The time every Apple Event takes, in seconds.
+                Defaults to 0.
+        """
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.document = FakeObject('document', 'document', name='OmniFocus')
+        self.objects = {}
+        # The flattened lists of objects, by class, in document order.
+        self.flattened = collections.defaultdict(list)
+        # The number of Apple Events, by (verb, property path).
+        self.events = collections.Counter()
+
+    def add(self, obj, container=None, flattened=True):
+        """Adds an object into this database.
+
+        Args:
+            obj: The FakeObject to add.
+            container: The containing FakeObject, or None for the
+                document.
+            flattened: Whether the object must be listed in its
+                class's flattened elements.  Defaults to True.
+
+        Returns:
+            The added object.
+        """
+        if container is None:
+            container = self.document
+        obj.attrs['container'] = container
+        container.children.append(obj)
+        self.objects[obj.id] = obj
+        if flattened:
+            self.flattened[obj.cls].append(obj)
+        return obj
+
+    def record_event(self, verb, path):
+        """Counts an Apple Event, and waits for its latency.
+        """
+        with self._lock:
+            self.events[(verb, path)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count_events(self):
+        return sum(self.events.itervalues())
+
+    def reset_events(self):
+        self.events.clear()
+
+    def get_attr(self, obj, name):
+        if obj is None:
+            return None
+        elif name == 'id':
+            return obj.id
+        elif name == 'containing_document':
+            return self.document
+        else:
+            return obj.attrs.get(name)
+
+    def resolve(self, obj, path):
+        for name in path:
+            obj = self.get_attr(obj, name)
+        return obj
+
+    def to_app_value(self, value):
+        if value is None:
+            return k.missing_value
+        elif isinstance(value, FakeObject):
+            return ObjectRef(self, value.id)
+        else:
+            return value
+
+    def from_app_value(self, value):
+        if value is k.missing_value:
+            return None
+        elif isinstance(value, ObjectRef):
+            return value._resolve()
+        else:
+            return value
+
+
+class Reference(object):
+    """The base class of fake AppScript references.
+    """
+
+
+class PropertyRef(Reference):
+    """A reference to a property of one object or of a collection.
+    """
+
+    def __init__(self, db, objs_getter, path, single):
+        self._db = db
+        self._objs_getter = objs_getter
+        self._path = path
+        self._single = single
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return PropertyRef(self._db, self._objs_getter, self._path + (name,),
+                           self._single)
+
+    def _key(self):
+        return (tuple(obj.id for obj in self._objs_getter()), self._path)
+
+    def __eq__(self, other):
+        return isinstance(other, PropertyRef) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def get(self):
+        db = self._db
+        db.record_event('get', '.'.join(self._path))
+        values = [db.to_app_value(db.resolve(obj, self._path))
+                  for obj in self._objs_getter()]
+        return values[0] if self._single else values
+
+    def set(self, value):
+        db = self._db
+        db.record_event('set', '.'.join(self._path))
+        value = db.from_app_value(value)
+        for obj in self._objs_getter():
+            parent = db.resolve(obj, self._path[:-1])
+            parent.attrs[self._path[-1]] = value
+
+
+class ElementsRef(Reference):
+    """A reference to a collection of elements, e.g. flattened_tasks.
+    """
+
+    def __init__(self, db, objs_getter):
+        self._db = db
+        self._objs_getter = objs_getter
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return PropertyRef(self._db, self._objs_getter, (name,), False)
+
+    def __getitem__(self, test):
+        objs_getter = self._objs_getter
+        db = self._db
+        return ElementsRef(
+            db, lambda: [obj for obj in objs_getter()
+                         if test._evaluate(db, obj)])
+
+    def ID(self, obj_id):
+        return ObjectRef(self._db, obj_id)
+
+    def get(self):
+        self._db.record_event('get', 'elements')
+        return [ObjectRef(self._db, obj.id) for obj in self._objs_getter()]
+
+
+class ObjectRef(Reference):
+    """A reference to a single object, by ID.
+    """
+
+    def __init__(self, db, obj_id):
+        self._db = db
+        self._obj_id = obj_id
+
+    def _resolve(self):
+        if self._obj_id == self._db.document.id:
+            return self._db.document
+        obj = self._db.objects.get(self._obj_id)
+        if obj is None:
+            raise CommandError('object %r not found' % (self._obj_id,))
+        return obj
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        db = self._db
+        cls = ELEMENT_CLASSES.get(name)
+        if cls is not None:
+            if self._obj_id == db.document.id:
+                return ElementsRef(db, lambda: db.flattened[cls])
+            return ElementsRef(
+                db, lambda: [obj for obj in self._resolve().children
+                             if obj.cls == cls])
+        return PropertyRef(db, lambda: [self._resolve()], (name,), True)
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectRef) and self._obj_id == other._obj_id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._obj_id)
+
+    def get(self):
+        self._db.record_event('get', 'object')
+        self._resolve()
+        return self
+
+
+class _Test(object):
+    """A fake whose-clause test.
+    """
+
+    def __init__(self, evaluate):
+        self._evaluate = evaluate
+
+    def AND(self, other):
+        return _Test(lambda db, obj: (self._evaluate(db, obj)
+                                      and other._evaluate(db, obj)))
+
+    def OR(self, other):
+        return _Test(lambda db, obj: (self._evaluate(db, obj)
+                                      or other._evaluate(db, obj)))
+
+    def NOT(self):
+        return _Test(lambda db, obj: not self._evaluate(db, obj))
+
+
+class _Its(object):
+    """A fake test specifier root, i.e. appscript.its.
+    """
+
+    def __init__(self, path=()):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Its(self._path + (name,))
+
+    def _value(self, db, obj, other):
+        if isinstance(other, _Its):
+            return db.resolve(obj, other._path)
+        return db.from_app_value(other)
+
+    def __eq__(self, other):
+        return _Test(lambda db, obj: (db.resolve(obj, self._path)
+                                      == self._value(db, obj, other)))
+
+    def __ne__(self, other):
+        return _Test(lambda db, obj: (db.resolve(obj, self._path)
+                                      != self._value(db, obj, other)))
+
+    def isin(self, values):
+        return _Test(lambda db, obj: (
+            db.resolve(obj, self._path)
+            in [self._value(db, obj, value) for value in values]))
+
+
+its = _Its()
+
+
+class FakeApp(object):
+    """A fake appscript application, backed by a FakeDatabase.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.default_document = ObjectRef(db, db.document.id)
+
+    def isrunning(self):
+        return True
+
+    def evaluate_javascript(self, script):
+        """Evaluates an Omni Automation script, as one Apple Event.
+
+        Args:
+            script: The JavaScript source of the script.
+
+        Returns:
+            The string result of the script.
+        """
+        self.db.record_event('evaluate', 'javascript')
+        program = '%s\nprocess.stdout.write(String(%s));\n' % (
+            _make_omni_automation_prelude(self.db), script)
+        try:
+            process = subprocess.Popen(['node'], stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+        except OSError, e:
+            raise CommandError('failed to run node: %s' % (e,))
+        output = process.communicate(program)[0]
+        if process.returncode != 0:
+            raise CommandError('script failed with status %i'
+                               % (process.returncode,))
+        return output.decode('utf-8')
+
+
+# Builds the fake Omni Automation objects from their JSON records, in
+# which references are {"$ref": ID}, dates are {"$date": ISO}, and
+# project statuses are {"$status": NAME}.
+_OMNI_AUTOMATION_PRELUDE = '''\
+var Project = {Status: {Active: {}, OnHold: {}, Done: {}, Dropped: {}}};
+var records = %s;
+var objects = {};
+Object.keys(records).forEach(function (kind) {
+    records[kind].forEach(function (r) {
+        objects[r.id] = {id: {primaryKey: r.id}};
+    });
+});
+function decode(v) {
+    if (v === null || typeof v !== 'object') return v;
+    if (Array.isArray(v)) return v.map(decode);
+    if ('$ref' in v) return objects[v.$ref];
+    if ('$date' in v) return new Date(v.$date);
+    return Project.Status[v.$status];
+}
+function build(kind) {
+    return records[kind].map(function (r) {
+        var o = objects[r.id];
+        Object.keys(r.attrs).forEach(function (k) {
+            o[k] = decode(r.attrs[k]);
+        });
+        return o;
+    });
+}
+build('rootTasks');
+var flattenedTags = build('tags');
+var flattenedFolders = build('folders');
+var flattenedProjects = build('projects');
+var flattenedTasks = build('tasks');
+'''
+
+# The names of the statuses of projects in Omni Automation.
+_STATUS_NAMES = {
+    'active': 'Active',
+    'on_hold': 'OnHold',
+    'done': 'Done',
+    'dropped': 'Dropped',
+    }
+
+
+def _make_omni_automation_prelude(db):
+    """Generates the JavaScript of the Omni Automation objects of a database.
+    """
+    def ref(obj):
+        if obj is None or obj.cls == 'document':
+            return None
+        return {'$ref': obj.id}
+
+    def date(value):
+        if value is None:
+            return None
+        return {'$date': time.strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z',
+                time.gmtime(time.mktime(value.timetuple())))}
+
+    def tags(obj):
+        context = obj.attrs.get('context')
+        return [] if context is None else [ref(context)]
+
+    def parent(obj, cls):
+        container = obj.attrs['container']
+        return ref(container) if container.cls == cls else None
+
+    records = {
+        'tags': [], 'folders': [], 'projects': [], 'rootTasks': [],
+        'tasks': []}
+    for obj in db.flattened['context']:
+        records['tags'].append({'id': obj.id, 'attrs': {
+                    'name': obj.attrs['name'],
+                    'parent': parent(obj, 'context')}})
+    for obj in db.flattened['folder']:
+        records['folders'].append({'id': obj.id, 'attrs': {
+                    'name': obj.attrs['name'],
+                    'parent': parent(obj, 'folder')}})
+    for obj in db.flattened['project']:
+        attrs = obj.attrs
+        root_task = attrs['root_task']
+        records['projects'].append({'id': obj.id, 'attrs': {
+                    'name': attrs['name'],
+                    'note': attrs.get('note') or '',
+                    'status': {'$status': _STATUS_NAMES[attrs['status'].name]},
+                    'deferDate': date(attrs.get('start_date')),
+                    'dueDate': date(attrs.get('due_date')),
+                    'parentFolder': parent(obj, 'folder'),
+                    'tags': tags(obj),
+                    'task': ref(root_task)}})
+        records['rootTasks'].append({'id': root_task.id, 'attrs': {
+                    'completed': bool(attrs.get('completed')),
+                    'modified': date(attrs.get('modification_date'))}})
+    for obj in db.flattened['task']:
+        attrs = obj.attrs
+        records['tasks'].append({'id': obj.id, 'attrs': {
+                    'name': attrs['name'],
+                    'note': attrs.get('note') or '',
+                    'completed': bool(attrs.get('completed')),
+                    'deferDate': date(attrs.get('start_date')),
+                    'dueDate': date(attrs.get('due_date')),
+                    'modified': date(attrs.get('modification_date')),
+                    'containingProject': ref(attrs.get('containing_project')),
+                    'parent': ref(attrs.get('parent_task')),
+                    'tags': tags(obj)}})
+    return _OMNI_AUTOMATION_PRELUDE % (json.dumps(records),)
+
+
+def app(name=None, database=None):
+    if database is None:
+        raise CommandError('no fake database for application %r' % (name,))
+    return FakeApp(database)
+
+
+def install():
+    """Installs this module as the appscript module.
+    """
+    module = sys.modules[__name__]
+    sys.modules['appscript'] = module
+    sys.modules['appscript.reference'] = reference
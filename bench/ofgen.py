@@ -0,0 +1,295 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Generates synthetic OmniFocus databases for benchmarks.
+"""
+
+
+import datetime
+import os
+import random
+import time
+import xml.sax.saxutils
+import zipfile
+
+import fakeappscript
+from fakeappscript import FakeObject, k
+
+
+# The date of the synthetic databases' modifications.
+BASE_DATE = datetime.datetime(2012, 9, 1)
+
+# The number of children of every folder or context.
+BRANCHING = 3
+
+
+def _generate_tree(db, cls, depth, prefix):
+    """Generates a tree of folders or contexts.
+
+    Args:
+        db: The FakeDatabase to add objects into.
+        cls: The class of the objects, 'folder' or 'context'.
+        depth: The depth of the tree.
+        prefix: The prefix of the objects' names.
+
+    Returns:
+        The list of all the objects in the tree.
+    """
+    objs = []
+    parents = [None]
+    for level in xrange(depth):
+        children = []
+        for parent in parents:
+            for i in xrange(BRANCHING):
+                obj = FakeObject(cls, '%s-%i-%i' % (cls, level, len(objs)),
+                                 name='%s %i.%i' % (prefix, level, i))
+                db.add(obj, container=parent)
+                children.append(obj)
+                objs.append(obj)
+        parents = children
+    return objs
+
+
+def generate_database(projects=100, tasks_per_project=10, folder_depth=2,
+                      context_depth=2, seed=0):
+    """Generates a synthetic OmniFocus database.
+
+    Args:
+        projects: The number of projects.  Defaults to 100.
+        tasks_per_project: The number of tasks in every project.
+            Defaults to 10.
+        folder_depth: The depth of the hierarchy of folders.
+            Defaults to 2.
+        context_depth: The depth of the hierarchy of contexts.
+            Defaults to 2.
+        seed: The seed of the random generator.  Defaults to 0.
+
+    Returns:
+        A fakeappscript.FakeDatabase object.
+    """
+    rnd = random.Random(seed)
+    db = fakeappscript.FakeDatabase()
+    folders = _generate_tree(db, 'folder', folder_depth, 'Folder')
+    contexts = _generate_tree(db, 'context', context_depth, 'Context')
+    statuses = [k.active] * 6 + [k.on_hold] * 3 + [k.dropped]
+    for p in xrange(projects):
+        status = rnd.choice(statuses)
+        due_date = None
+        if rnd.random() < 0.2:
+            due_date = BASE_DATE + datetime.timedelta(days=rnd.randint(1, 60))
+        project = FakeObject(
+            'project', 'project-%i' % (p,),
+            name='Project %i' % (p,),
+            note='Notes of project %i' % (p,),
+            status=status,
+            completed=False,
+            start_date=None,
+            due_date=due_date,
+            modification_date=BASE_DATE,
+            context=rnd.choice(contexts) if contexts else None)
+        db.add(project, container=rnd.choice(folders) if folders else None)
+        root_task = FakeObject('task', 'root-%i' % (p,),
+                               name=project.attrs['name'],
+                               containing_project=project)
+        db.add(root_task, container=project, flattened=False)
+        project.attrs['root_task'] = root_task
+        for t in xrange(tasks_per_project):
+            start_date = None
+            if rnd.random() < 0.1:
+                start_date = BASE_DATE + datetime.timedelta(
+                    days=rnd.randint(1, 30))
+            task = FakeObject(
+                'task', 'task-%i-%i' % (p, t),
+                name='Task %i of project %i' % (t, p),
+                completed=rnd.random() < 0.2,
+                start_date=start_date,
+                due_date=None,
+                modification_date=BASE_DATE,
+                context=rnd.choice(contexts) if contexts else None,
+                containing_project=project,
+                parent_task=root_task,
+                blocked=False)
+            db.add(task, container=root_task)
+    return db
+
+
+def modify_database(db, fraction, seed=0):
+    """Modifies a fraction of the projects of a synthetic database.
+
+    In every modified project, a task is renamed, and another is
+    marked as completed.
+
+    Args:
+        db: The FakeDatabase to modify.
+        fraction: The fraction of projects to modify, e.g. 0.05.
+        seed: The seed of the random generator.  Defaults to 0.
+
+    Returns:
+        The number of modified projects.
+    """
+    rnd = random.Random(seed)
+    projects = db.flattened['project']
+    modified = rnd.sample(projects, int(round(len(projects) * fraction)))
+    modification_date = BASE_DATE + datetime.timedelta(days=1)
+    for project in modified:
+        project.attrs['modification_date'] = modification_date
+        tasks = project.attrs['root_task'].children
+        if tasks:
+            task = rnd.choice(tasks)
+            task.attrs['name'] += ' (renamed)'
+            task.attrs['modification_date'] = modification_date
+            task = rnd.choice(tasks)
+            task.attrs['completed'] = True
+            task.attrs['modification_date'] = modification_date
+    return len(modified)
+
+
+def drop_projects(db, fraction, seed=0):
+    """Drops a fraction of the projects of a synthetic database.
+
+    Args:
+        db: The FakeDatabase to modify.
+        fraction: The fraction of the projects that are not dropped
+            yet to drop, e.g. 0.05.
+        seed: The seed of the random generator.  Defaults to 0.
+
+    Returns:
+        The number of dropped projects.
+    """
+    rnd = random.Random(seed)
+    projects = [project for project in db.flattened['project']
+                if project.attrs['status'] is not k.dropped]
+    dropped = rnd.sample(projects, int(round(len(projects) * fraction)))
+    modification_date = BASE_DATE + datetime.timedelta(days=2)
+    for project in dropped:
+        project.attrs['status'] = k.dropped
+        project.attrs['modification_date'] = modification_date
+    return len(dropped)
+
+
+# The XML namespace of OmniFocus's transactions.
+OMNIFOCUS_XMLNS = 'http://www.omnigroup.com/namespace/OmniFocus/v1'
+
+# The names of the statuses of projects in transactions.
+_STATUS_NAMES = {
+    'active': 'active',
+    'on_hold': 'inactive',
+    'done': 'done',
+    'dropped': 'dropped',
+    }
+
+
+def _format_time(date):
+    if date is None:
+        return ''
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                         time.gmtime(time.mktime(date.timetuple())))
+
+
+def _format_element(name, value):
+    if value is None:
+        return '<%s/>' % (name,)
+    if isinstance(value, FakeObject):
+        return '<%s idref="%s"/>' % (name, value.id)
+    if isinstance(value, datetime.datetime):
+        value = _format_time(value)
+    return '<%s>%s</%s>' % (name, xml.sax.saxutils.escape(value), name)
+
+
+def _format_object(db, obj, op):
+    """Formats an object of a synthetic database as in a transaction.
+    """
+    attrs = obj.attrs
+    container = attrs['container']
+    if container is db.document:
+        container = None
+    lines = []
+    if op is None:
+        lines.append('<%s id="%s">' % (obj.cls, obj.id))
+    else:
+        lines.append('<%s id="%s" op="%s">' % (obj.cls, obj.id, op))
+    if obj.cls == 'project':
+        lines[0] = lines[0].replace('<project', '<task', 1)
+        lines.append(_format_element('task', None))
+        status = _STATUS_NAMES[attrs['status'].name]
+        lines.append('<project>%s%s</project>' % (
+                _format_element('folder', container),
+                _format_element('status', status)))
+    elif obj.cls == 'task':
+        lines.append(_format_element('task', attrs['containing_project']))
+    else:
+        lines.append(_format_element(obj.cls, container))
+    lines.append(_format_element('name', attrs.get('name')))
+    lines.append('<rank>%i</rank>' % (container.children.index(obj)
+                                      if container is not None
+                                      else db.document.children.index(obj),))
+    if obj.cls in ('project', 'task'):
+        if attrs.get('note'):
+            lines.append('<note><text><p><run><lit>%s</lit></run></p>'
+                         '</text></note>'
+                         % (xml.sax.saxutils.escape(attrs['note']),))
+        lines.append(_format_element('context', attrs.get('context')))
+        lines.append(_format_element('modified',
+                                     attrs.get('modification_date')))
+        lines.append(_format_element('start', attrs.get('start_date')))
+        lines.append(_format_element('due', attrs.get('due_date')))
+        completed = attrs.get('completed')
+        lines.append(_format_element(
+                'completed', attrs.get('modification_date') if completed
+                else None))
+    lines.append('</%s>' % ('task' if obj.cls == 'project' else obj.cls,))
+    return '\n'.join(lines)
+
+
+def write_bundle(db, path, since=None):
+    """Writes a synthetic database as a transaction into an .ofocus bundle.
+
+    Args:
+        db: The FakeDatabase to write.
+        path: The path of the bundle directory, created if missing.
+        since: The datetime after which objects must have been
+            modified to be written, as updates.  Defaults to None,
+            i.e. all objects are written, as the bundle's base
+            transaction.
+
+    Returns:
+        The name of the transaction file.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    op = None if since is None else 'update'
+    elements = []
+    for cls in ('context', 'folder', 'project', 'task'):
+        for obj in db.flattened[cls]:
+            modification_date = obj.attrs.get('modification_date')
+            if (since is None or (modification_date is not None
+                                  and modification_date > since)):
+                elements.append(_format_object(db, obj, op))
+    # Transactions are named after their timestamps, and applied in
+    # the order of their names.
+    name = '%s=%06i.zip' % (
+        time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+        len(os.listdir(path)))
+    with zipfile.ZipFile(os.path.join(path, name), 'w',
+                         zipfile.ZIP_DEFLATED) as z:
+        z.writestr('contents.xml',
+                   '<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+                   '<omnifocus xmlns="%s">\n%s\n</omnifocus>\n'
+                   % (OMNIFOCUS_XMLNS, '\n'.join(elements)))
+    return name
@@ -0,0 +1,340 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks synchronizations against a fake OmniFocus and an AZ stub.
+
+Every database size is benchmarked in its own process, with four
+scenarios run in sequence: a cold sync into an empty AgileZen project,
+a no-op resync, a resync after modifying 5% of the projects, and a
+resync after dropping 10% of the projects, with the stories listed in
+small pages.  After every scenario, the stories are checked to match
+the selected projects one to one, and the connections to be reused
+by the next scenarios, as by the daemon.
+
+Usage: python bench/run.py [--sizes 10,100,1000,10000] [--save-baseline]
+"""
+
+
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir, 'src'))
+
+import fakeappscript
+fakeappscript.install()
+
+import agilezen
+import httpcache
+import omnifocus
+import omnifocus2agilezen
+import omnifocusscript
+import syncstate
+
+import azstub
+import ofgen
+
+
+DEFAULT_BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+
+SIZES = (10, 100, 1000, 10000)
+
+SCENARIOS = ('cold', 'noop', 'changed', 'dropped')
+
+# The OmniFocus DAO classes, by backend name.
+OF_BACKENDS = {
+    'events': omnifocus.OmniFocusDataAccess,
+    'script': omnifocusscript.OmniFocusScriptDataAccess,
+    }
+
+# The fraction of projects modified in the "changed" scenario.
+CHANGED_FRACTION = 0.05
+
+# The fraction of projects dropped in the "dropped" scenario.
+DROPPED_FRACTION = 0.1
+
+# The page size of the AgileZen listings in the "dropped" scenario, so
+# that the stories of dropped projects are on multiple pages.  The
+# stories are buffered one page at a time, so that they are planned
+# while the next pages are listed.
+DROPPED_PAGE_SIZE = 20
+
+# The relative increase of a metric over its baseline value beyond
+# which it is reported as a regression.
+REGRESSION_THRESHOLD = 0.2
+
+
+def select_project(proj):
+    return proj.status != fakeappscript.k.dropped
+
+
+def pick_color(proj):
+    return 'blue' if proj.full_context_name.startswith('Context 0.0') \
+        else 'green'
+
+
+def get_peak_rss_kb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024  # In bytes on Mac OS X.
+    return peak_rss
+
+
+def check_stories(db, stub, az_project_id):
+    """Checks that the stories match the selected projects one to one.
+
+    Args:
+        db: The FakeDatabase synchronized from.
+        stub: The AgileZenStub synchronized into.
+        az_project_id: The ID of the AgileZen project.
+
+    Returns:
+        The list of the descriptions of the mismatches, if any.
+    """
+    # The projects selected by select_project.
+    of_project_ids = set([project.id for project in db.flattened['project']
+                          if project.attrs['status']
+                          is not fakeappscript.k.dropped])
+    story_counts = collections.Counter()
+    for story in stub.projects[az_project_id]['stories'].itervalues():
+        details = story['details'] or ''
+        story_counts[details[details.rfind('(')+1:-1]] += 1
+    errors = []
+    missing = of_project_ids.difference(story_counts)
+    if missing:
+        errors.append('%i projects without stories' % (len(missing),))
+    extra = set(story_counts).difference(of_project_ids)
+    if extra:
+        errors.append('%i stories of unselected projects' % (len(extra),))
+    duplicates = sum(count - 1 for count in story_counts.itervalues())
+    if duplicates:
+        errors.append('%i duplicate stories' % (duplicates,))
+    return errors
+
+
+def run_size(projects, tasks_per_project, latency, jobs, of_latency=0.0,
+             of_backend='events'):
+    """Runs all scenarios for a database size.
+
+    Args:
+        projects: The number of projects in the OmniFocus database.
+        tasks_per_project: The number of tasks in every project.
+        latency: The latency of the AgileZen stub, in seconds.
+        jobs: The number of concurrent AgileZen writes.
+        of_latency: The latency of every Apple Event to the fake
+            OmniFocus, in seconds.  Defaults to 0.
+        of_backend: The name of the OmniFocus DAO backend in
+            OF_BACKENDS.  Defaults to 'events'.
+
+    Returns:
+        The list of the results of the scenarios, as dicts.
+    """
+    db = ofgen.generate_database(projects=projects,
+                                 tasks_per_project=tasks_per_project)
+    db.latency = of_latency
+    stub = azstub.AgileZenStub(latency=latency)
+    az_project_id = stub.add_project()
+    api_base_url = stub.start()
+    state_dir = tempfile.mkdtemp()
+    state_store = syncstate.SyncStateStore(os.path.join(state_dir, 'state'))
+    cache = httpcache.ResponseCache(os.path.join(state_dir, 'cache'))
+    try:
+        of_dao = OF_BACKENDS[of_backend](fakeappscript.FakeApp(db))
+        az_dao = agilezen.AgileZenDataAccess(api_base_url, 'benchmark',
+                                             jobs=jobs, cache=cache)
+        sync = omnifocus2agilezen.OmniFocusToAgileZenSync(
+            of_dao, az_dao, state_store=state_store)
+        # The connections are reused by the next syncs, as by the
+        # daemon, so there are at most as many as concurrent requests:
+        # the pages, the writes, and the requests of the main thread.
+        max_connections = az_dao.max_concurrent_pages + jobs + 1
+        connections = 0
+        results = []
+        for scenario in SCENARIOS:
+            if scenario == 'changed':
+                ofgen.modify_database(db, CHANGED_FRACTION)
+            elif scenario == 'dropped':
+                ofgen.drop_projects(db, DROPPED_FRACTION)
+                az_dao.page_size = DROPPED_PAGE_SIZE
+                omnifocus2agilezen.STORY_BUFFER_SIZE = DROPPED_PAGE_SIZE
+            db.reset_events()
+            stub.reset_calls()
+            start_time = time.time()
+            sync.sync_projects(select_project, pick_color, az_project_id)
+            wall_time = time.time() - start_time
+            errors = check_stories(db, stub, az_project_id)
+            connections += stub.accepted_connections
+            if connections > max_connections:
+                errors.append('%i connections opened by the syncs, '
+                              'more than the %i concurrent requests'
+                              % (connections, max_connections))
+            results.append({
+                'projects': projects,
+                'scenario': scenario,
+                'wall_time': wall_time,
+                'apple_events': db.count_events(),
+                'http_calls': dict(stub.calls),
+                'connections': stub.accepted_connections,
+                'peak_rss_kb': get_peak_rss_kb(),
+                'errors': errors,
+                })
+        return results
+    finally:
+        state_store.close()
+        cache.close()
+        shutil.rmtree(state_dir)
+        stub.stop()
+
+
+def run_child(options):
+    results = run_size(options.projects, options.tasks_per_project,
+                       options.latency, options.jobs, options.of_latency,
+                       options.of_backend)
+    json.dump(results, sys.stdout)
+
+
+def format_change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    change = float(value - baseline_value) / baseline_value
+    flag = ' !' if change > REGRESSION_THRESHOLD else ''
+    return ' (%+.0f%%%s)' % (change * 100, flag)
+
+
+def report(results, baseline):
+    """Prints the results, compared to a baseline.
+
+    Args:
+        results: The list of the results of all scenarios.
+        baseline: The dict of the baseline results, by
+            "<projects>/<scenario>" keys.
+    """
+    print '%-8s %-8s %-18s %-18s %-40s %-12s %-16s' % (
+        'projects', 'scenario', 'wall time (s)', 'apple events',
+        'http calls', 'connections', 'peak rss (KB)')
+    for result in results:
+        base = baseline.get('%(projects)i/%(scenario)s' % result, {})
+        http_calls = result['http_calls']
+        total_http_calls = sum(http_calls.itervalues())
+        print '%-8i %-8s %-18s %-18s %-40s %-12s %-16s' % (
+            result['projects'], result['scenario'],
+            '%.3f%s' % (result['wall_time'],
+                        format_change(result['wall_time'],
+                                      base.get('wall_time'))),
+            '%i%s' % (result['apple_events'],
+                      format_change(result['apple_events'],
+                                    base.get('apple_events'))),
+            '%i%s %s' % (total_http_calls,
+                         format_change(total_http_calls,
+                                       sum(base.get('http_calls',
+                                                    {}).itervalues())),
+                         ','.join('%s:%i' % item
+                                  for item in sorted(http_calls.items()))),
+            '%i' % (result.get('connections', 0),),
+            '%i%s' % (result['peak_rss_kb'],
+                      format_change(result['peak_rss_kb'],
+                                    base.get('peak_rss_kb'))))
+    for result in results:
+        for error in result.get('errors', ()):
+            print 'ERROR: %i/%s: %s' % (result['projects'],
+                                        result['scenario'], error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Pikpoint synchronizations')
+    parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in SIZES),
+        help='the comma-separated numbers of projects to benchmark '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--tasks-per-project', default=10, type=int,
+        help='the number of tasks in every project (default: %(default)i)')
+    parser.add_argument(
+        '--latency', default=0.0, type=float,
+        help='the latency of the AgileZen stub, in seconds '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--of-latency', default=0.0, type=float,
+        help='the latency of every Apple Event to the fake OmniFocus, in '
+             'seconds (default: %(default)s)')
+    parser.add_argument(
+        '--of-backend', default='events', choices=sorted(OF_BACKENDS),
+        help='how to read the fake OmniFocus: with one Apple Event per '
+             'attribute, or with a single export script run with Node.js '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-j', '--jobs', default=1, type=int,
+        help='the number of concurrent AgileZen writes '
+             '(default: %(default)i)')
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE_FILE,
+        help='the JSON file of the baseline results (default: %(default)s)')
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='save the results as the new baseline')
+    parser.add_argument('--child', action='store_true',
+                        help='run a single size, for internal use')
+    parser.add_argument('--projects', type=int, help='for internal use')
+    options = parser.parse_args()
+
+    if options.child:
+        run_child(options)
+        return
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        # Run every size in its own process, to measure its peak
+        # memory usage independently.
+        output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--child',
+                '--projects', str(size),
+                '--tasks-per-project', str(options.tasks_per_project),
+                '--latency', str(options.latency),
+                '--of-latency', str(options.of_latency),
+                '--of-backend', options.of_backend,
+                '--jobs', str(options.jobs)])
+        results.extend(json.loads(output))
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if any(result['errors'] for result in results):
+        sys.exit(1)
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(dict([('%(projects)i/%(scenario)s' % result, result)
+                            for result in results]),
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,42 +18,289 @@
 
 
 import collections
+import copy
 import datetime
+import email.utils
+import itertools
 import json
 import logging
+import random
+import sys
+import threading
+import time
 
 # Requests
 # URL: http://docs.python-requests.org/
 # MacPorts package: py*-requests py*-certifi
 import requests
 
+import httpcache
+import profiling
+
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 LOG = logging.getLogger('agilezen')
 
+# The bounds of the page size of queries, when adapted automatically.
+MIN_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 1000
+
+# The response time of a query page beyond which the page size is
+# considered too large, in seconds.
+PAGE_LATENCY_TARGET = 2.0
+
+# The HTTP status codes of responses to throttled requests or to
+# requests that failed because of temporary server errors.
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+# The HTTP status codes of responses to requests that were rejected
+# without being processed, hence that can be retried even if they are
+# not idempotent.
+UNPROCESSED_STATUS_CODES = frozenset([429, 503])
+
+# The HTTP methods of idempotent requests, which can be retried
+# whatever the cause of their failure.
+IDEMPOTENT_METHODS = frozenset(['GET', 'PUT', 'DELETE'])
+
+# The default times during which cached responses are used without
+# requests, if they can't be revalidated, by endpoint template, in
+# seconds.  Responses of other endpoints are cached only if they can
+# be revalidated.
+DEFAULT_CACHE_TTLS = {
+    'projects/{id}': 3600,
+    'projects/{id}/phases': 3600,
+    'projects/{id}/tags': 300,
+    }
+
+# The maximum number of parsed timestamps to cache.
+TIME_CACHE_SIZE = 10000
+
+# The parsed timestamps, by timestamp string truncated to the second.
+_time_cache = {}
+
+
+def iter_concurrently(funcs, max_concurrency):
+    """Calls functions concurrently, and yields their results in order.
+
+    At most max_concurrency functions are executing at any time, each
+    in its own thread.  A function is called only once the result of
+    the max_concurrency-th previous function has been consumed.
+
+    Args:
+        funcs: An iterable of callables taking no arguments.
+        max_concurrency: The maximum number of functions to call
+            concurrently.
+
+    Returns:
+        An iterator over the values returned by the functions, in the
+        order of the functions.  If a function raises an exception,
+        the exception is re-raised when its result is consumed.
+    """
+    funcs = iter(funcs)
+    pending = collections.deque()
+
+    def start(func):
+        result = {}
+
+        def run():
+            try:
+                result['value'] = func()
+            except Exception:
+                result['exc_info'] = sys.exc_info()
+
+        thread = threading.Thread(target=run, name='agilezen-reader')
+        thread.daemon = True
+        thread.start()
+        pending.append((thread, result))
+
+    for func in itertools.islice(funcs, max(max_concurrency, 1)):
+        start(func)
+    while pending:
+        thread, result = pending.popleft()
+        thread.join()
+        for func in itertools.islice(funcs, 1):
+            start(func)
+        if 'exc_info' in result:
+            exc_type, exc_value, exc_traceback = result['exc_info']
+            raise exc_type, exc_value, exc_traceback
+        yield result['value']
+
+
+def parse_time(json_value):
+    """Parses an AgileZen timestamp, e.g. "2012-09-01T10:30:00.123Z".
+
+    Fractions of seconds and time zones are ignored.  Parsed
+    timestamps are cached, since many objects are created at the same
+    times, e.g. when stories are imported.
+
+    Args:
+        json_value: The timestamp string.
+
+    Returns:
+        The naive datetime object.
+    """
+    key = json_value[:19]
+    value = _time_cache.get(key)
+    if value is None:
+        try:
+            # Much faster than strptime.
+            value = datetime.datetime(int(key[0:4]), int(key[5:7]),
+                                      int(key[8:10]), int(key[11:13]),
+                                      int(key[14:16]), int(key[17:19]))
+        except ValueError:
+            value = datetime.datetime.strptime(key, TIME_FORMAT)
+        if len(_time_cache) >= TIME_CACHE_SIZE:
+            _time_cache.clear()
+        _time_cache[key] = value
+    return value
+
+
+class LazyJsonCollection(object):
+    """A collection of objects decoded from JSON only when first accessed.
+
+    The collection behaves like the list or set of its decoded
+    objects.  The values of some fields can be read without decoding
+    the objects with iter_field_values().
+    """
+
+    __slots__ = ('_cls', '_json_objs', '_container', '_objs')
+
+    def __init__(self, cls, json_objs, container=list):
+        """Initialize this collection with the JSON objects to decode.
+
+        Args:
+            cls: The JsonSerializable class of the objects.
+            json_objs: The list of JSON objects.
+            container: The type of collection of the decoded objects,
+                e.g. list or set.  Defaults to list.
+        """
+        self._cls = cls
+        self._json_objs = json_objs
+        self._container = container
+        self._objs = None
+
+    def _get_objs(self):
+        objs = self._objs
+        if objs is None:
+            create_from_json = self._cls.create_from_json
+            objs = self._container([create_from_json(json_obj)
+                                    for json_obj in self._json_objs])
+            self._objs = objs
+            self._json_objs = None
+        return objs
+
+    def iter_field_values(self, field_names):
+        """Iterates over the values of some fields of the objects.
+
+        Args:
+            field_names: The names of the fields to get.
+
+        Returns:
+            An iterator over the tuples of the values of the fields of
+            every object.  The objects are not decoded if they were
+            not decoded yet.
+        """
+        if self._objs is not None:
+            return iter_field_values(self._objs, field_names)
+        json_to_field = self._cls._json_to_field
+        return (tuple([json_to_field(name, json_obj.get(name))
+                       for name in field_names])
+                for json_obj in self._json_objs)
+
+    def __iter__(self):
+        return iter(self._get_objs())
+
+    def __len__(self):
+        if self._objs is None:
+            return len(self._json_objs)
+        return len(self._objs)
+
+    def __contains__(self, obj):
+        return obj in self._get_objs()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJsonCollection):
+            other = other._get_objs()
+        return self._get_objs() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._get_objs())
+
+
+def iter_field_values(objs, field_names):
+    """Iterates over the values of some fields of objects.
+
+    Args:
+        objs: The iterable of objects, which may be a
+            LazyJsonCollection, in which case its objects are not
+            decoded.
+        field_names: The names of the fields to get.
+
+    Returns:
+        An iterator over the tuples of the values of the fields of
+        every object.
+    """
+    if isinstance(objs, LazyJsonCollection):
+        return objs.iter_field_values(field_names)
+    return (tuple([getattr(obj, name) for name in field_names])
+            for obj in objs)
+
 
 class JsonSerializable(object):
 
+    # The functions to convert the JSON values of fields, by field
+    # name.  The JSON values of other fields, and null values, are
+    # used as is.
+    _json_converters = {}
+
     def to_json(self):
         return dict([(field, self._field_to_json(field))
                      for field in self._fields
                      if getattr(self, field) is not None])
 
+    @classmethod
+    def _get_json_decoder(cls):
+        """Gets the precompiled decoder of the JSON objects of this class.
+
+        Returns:
+            The tuple of (field, converter) tuples of all the fields
+            of this class, in order, where converter is None if the
+            field's JSON value is used as is.
+        """
+        decoder = cls.__dict__.get('_json_decoder')
+        if decoder is None:
+            decoder = tuple([(field, cls._json_converters.get(field))
+                             for field in cls._fields])
+            cls._json_decoder = decoder
+        return decoder
+
     @classmethod
     def create_from_json(cls, json_obj):
-        args = [
-            (cls._json_to_field(field, json_obj[field])
-             if field in json_obj else None)
-            for field in cls._fields]
-        return cls(*args)
+        get = json_obj.get
+        values = []
+        for field, converter in cls._get_json_decoder():
+            value = get(field)
+            if converter is not None and value is not None:
+                value = converter(value)
+            values.append(value)
+        # Bypass the checks of the namedtuple's constructor.
+        return tuple.__new__(cls, values)
 
     def _field_to_json(self, field):
         return getattr(self, field)
 
     @classmethod
     def _json_to_field(cls, field, json_value):
-        return json_value
+        converter = cls._json_converters.get(field)
+        if converter is None or json_value is None:
+            return json_value
+        return converter(json_value)
 
 
 class User(collections.namedtuple('User', ('id', 'email', 'name', 'userName')),
@@ -66,6 +313,11 @@ class Project(collections.namedtuple('Project',
                                       'owner')),
               JsonSerializable):
 
+    _json_converters = {
+        'createTime': parse_time,
+        'owner': User.create_from_json,
+        }
+
     def _field_to_json(self, field):
         if field == 'createTime':
             return self.createTime.strftime(TIME_FORMAT)
@@ -74,15 +326,6 @@ class Project(collections.namedtuple('Project',
         else:
             return getattr(self, field)
 
-    @classmethod
-    def _json_to_field(cls, field, json_value):
-        if field == 'createTime':
-            return datetime.datetime.strptime(json_value[:19], TIME_FORMAT)
-        elif field == 'owner':
-            return User.create_from_json(json_value)
-        else:
-            return json_value
-
 
 class Phase(collections.namedtuple('Phase',
                                    ('id', 'name', 'description', 'index',
@@ -139,6 +382,20 @@ class ProjectPhases(collections.namedtuple('ProjectPhases', (
         return cls(backlog, ready, first_in_progress, done, archive)
 
 
+def get_phase_filter(phases):
+    """Gets the filter expression of the stories in some phases.
+
+    Args:
+        phases: The iterable of Phase objects.
+
+    Returns:
+        The filter expression, to pass as the where parameter of
+        story queries, e.g. 'phase:"Ready" or phase:"Working"'.
+    """
+    return ' or '.join(['phase:"%s"' % (phase.name.replace('"', '\\"'),)
+                        for phase in phases])
+
+
 class Tag(collections.namedtuple('Tag', ('id', 'name')),
           JsonSerializable):
     pass
@@ -149,6 +406,13 @@ class Task(collections.namedtuple('Task',
                                    'finishedBy', 'status')),
            JsonSerializable):
 
+    _json_converters = {
+        'status': lambda json_value: json_value == 'complete',
+        'createTime': parse_time,
+        'finishTime': parse_time,
+        'finishedBy': User.create_from_json,
+        }
+
     def _field_to_json(self, field):
         if field == 'status':
             return 'complete' if self.status else 'incomplete'
@@ -159,17 +423,6 @@ class Task(collections.namedtuple('Task',
         else:
             return getattr(self, field)
 
-    @classmethod
-    def _json_to_field(cls, field, json_value):
-        if field == 'status':
-            return json_value == 'complete'
-        elif field in ('createTime', 'finishTime'):
-            return datetime.datetime.strptime(json_value[:19], TIME_FORMAT)
-        elif field == 'finishedBy':
-            return User.create_from_json(json_value)
-        else:
-            return json_value
-
 
 # Valid colors for stories.
 COLORS = ['grey', 'blue', 'red', 'green', 'orange', 'yellow', 'purple', 'teal']
@@ -181,6 +434,16 @@ class Story(collections.namedtuple('Story',
                                     'tags', 'tasks')),
             JsonSerializable):
 
+    # The tags and tasks are decoded lazily, since they are not used
+    # for unmodified stories.
+    _json_converters = {
+        'phase': Phase.create_from_json,
+        'creator': User.create_from_json,
+        'owner': User.create_from_json,
+        'tags': lambda json_value: LazyJsonCollection(Tag, json_value, set),
+        'tasks': lambda json_value: LazyJsonCollection(Task, json_value),
+        }
+
     def _field_to_json(self, field):
         if field in ('phase', 'creator', 'owner'):
             return getattr(self, field).to_json()
@@ -189,98 +452,662 @@ class Story(collections.namedtuple('Story',
         else:
             return getattr(self, field)
 
-    @classmethod
-    def _json_to_field(cls, field, json_value):
-        if field == 'phase':
-            return Phase.create_from_json(json_value)
-        elif field in ('creator', 'owner'):
-            return User.create_from_json(json_value)
-        elif field == 'tags':
-            return set([Tag.create_from_json(tag) for tag in json_value])
-        elif field == 'tasks':
-            return [Task.create_from_json(task) for task in json_value]
-        else:
-            return json_value
+
+class TokenBucket(object):
+    """A thread-safe token bucket, to limit the rate of requests.
+    """
+
+    def __init__(self, rate, capacity):
+        """Initialize this bucket, full.
+
+        Args:
+            rate: The number of tokens added to the bucket per second.
+            capacity: The maximum number of tokens in the bucket,
+                i.e. the maximum size of bursts of requests.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last_time = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token from the bucket, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                delay = (1.0 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class CircuitBreaker(object):
+    """Pauses all requests while the server is degraded.
+
+    The circuit opens after a number of consecutive failures, or when
+    the server asks to retry after a delay.  While the circuit is
+    open, all threads wait before sending requests.  Once it closes,
+    the next failure opens it again until a request succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """Initialize this circuit breaker, closed.
+
+        Args:
+            failure_threshold: The number of consecutive failures
+                after which the circuit opens.  Defaults to 5.
+            reset_timeout: The time during which the circuit remains
+                open after failures, in seconds.  Defaults to 30.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Waits until the circuit is closed.
+        """
+        while True:
+            with self._lock:
+                delay = self._open_until - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, delay):
+        """Opens the circuit for a given time.
+
+        Args:
+            delay: The time during which the circuit remains open, in
+                seconds.
+        """
+        with self._lock:
+            self._open_until = max(self._open_until, time.time() + delay)
+
+    def record_success(self):
+        """Records a successful request.
+        """
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        """Records a failed request, and opens the circuit if necessary.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.failure_threshold:
+                return
+        LOG.warning('AgileZen server degraded, pausing requests for %.1fs',
+                    self.reset_timeout)
+        self.pause(self.reset_timeout)
+
+
+class SessionPool(object):
+    """A pool of Requests sessions shared by threads.
+
+    Requests sessions are not thread-safe, so every session is used by
+    one thread at a time.  A session is released into the pool after
+    every request, so that its keep-alive connections are reused by
+    the next requests of any thread, e.g. of the short-lived threads
+    getting pages of query results.  The pool holds at most as many
+    sessions as requests were sent concurrently.
+    """
+
+    def __init__(self, verify_ssl_cert=True):
+        """Initialize this pool.
+
+        Args:
+            verify_ssl_cert: Whether the sessions verify the SSL
+                certificates of servers.  Defaults to True.
+        """
+        self.verify_ssl_cert = verify_ssl_cert
+        self._lock = threading.Lock()
+        # The idle sessions, the most recently used last.
+        self._sessions = []
+
+    def acquire(self):
+        """Takes an idle session from this pool, or creates one.
+
+        Returns:
+            The Requests session, to release once the request is sent.
+        """
+        with self._lock:
+            if self._sessions:
+                return self._sessions.pop()
+        session = requests.session()
+        session.verify = self.verify_ssl_cert
+        return session
+
+    def release(self, session):
+        """Returns a session acquired from this pool into it.
+
+        Args:
+            session: The Requests session.
+        """
+        with self._lock:
+            self._sessions.append(session)
+
+
+class StoryWriteExecutor(object):
+    """Executes write operations concurrently, in order for each story.
+
+    Operations submitted with the same key, e.g. a story ID, are
+    executed sequentially in submission order.  Operations submitted
+    with different keys are executed concurrently by a bounded pool of
+    worker threads.  If an operation fails, the next operations
+    submitted with the same key are skipped, since they may depend on
+    the failed operation, and the failure is recorded for that key.
+    """
+
+    def __init__(self, max_workers=1):
+        """Initialize this executor.
+
+        Args:
+            max_workers: The maximum number of operations to execute
+                concurrently.  If 1 or less, operations are executed
+                synchronously by submit().  Defaults to 1.
+        """
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        # The queues of pending operations, by key.
+        self._queues = {}
+        # The keys which operations are pending and not being executed.
+        self._ready_keys = collections.deque()
+        # The number of keys which operations are being executed.
+        self._running = 0
+        # The exceptions raised by failed operations, by key.
+        self._failures = {}
+        self._workers = []
+
+    def _run_op(self, key, op):
+        """Executes an operation and records its failure, if any.
+
+        Args:
+            key: The key the operation was submitted with.
+            op: A tuple (func, args, kwargs).
+        """
+        func, args, kwargs = op
+        try:
+            func(*args, **kwargs)
+        except Exception, e:
+            LOG.exception('operation on %r failed', key)
+            with self._cond:
+                self._failures[key] = e
+
+    def _work(self):
+        """Executes the pending operations, key by key, forever.
+        """
+        while True:
+            with self._cond:
+                while not self._ready_keys:
+                    self._cond.wait()
+                key = self._ready_keys.popleft()
+                self._running += 1
+            while True:
+                with self._cond:
+                    queue = self._queues[key]
+                    if not queue or key in self._failures:
+                        del self._queues[key]
+                        self._running -= 1
+                        self._cond.notify_all()
+                        break
+                    op = queue.popleft()
+                self._run_op(key, op)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Submits an operation for execution.
+
+        Args:
+            key: The key identifying the sequence of operations to
+                execute in order, e.g. a story ID.
+            func: The callable to execute.
+            args: The positional arguments to pass to func.
+            kwargs: The keyword arguments to pass to func.
+        """
+        op = (func, args, kwargs)
+        if self.max_workers <= 1:
+            if key not in self._failures:
+                self._run_op(key, op)
+            return
+        with self._cond:
+            if key in self._failures:
+                return
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = collections.deque()
+                self._queues[key] = queue
+                self._ready_keys.append(key)
+                self._cond.notify_all()
+            queue.append(op)
+            if len(self._workers) < min(self.max_workers, len(self._queues)):
+                worker = threading.Thread(target=self._work,
+                                          name='agilezen-writer')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def wait(self):
+        """Waits for the execution of all submitted operations.
+
+        Returns:
+            A dict which keys are the keys of failed operations, and
+            values are the exceptions they raised.  The failures are
+            forgotten after this call.
+        """
+        with self._cond:
+            while self._queues:
+                self._cond.wait()
+            failures = self._failures
+            self._failures = {}
+        return failures
 
 
 class AgileZenDataAccess(object):
     """Provides access to AgileZen projects, stories, tasks, etc.
     """
 
-    def __init__(self, api_base_url, api_key, page_size=100,
-                 verify_ssl_cert=True):
+    def __init__(self, api_base_url, api_key, page_size=None,
+                 verify_ssl_cert=True, jobs=1, max_concurrent_pages=4,
+                 rate_limit=None, max_retries=5, backoff_base=1.0,
+                 max_backoff=60.0, profiler=None, cache=None,
+                 cache_ttls=None):
+        """Initialize this DAO.
+
+        Args:
+            api_base_url: The base URL of the AgileZen API.
+            api_key: The AgileZen API key to authenticate with.
+            page_size: The number of items to get in every page of
+                query results.  Defaults to None, i.e. the page size
+                is adapted to the largest size that the server
+                answers within PAGE_LATENCY_TARGET.
+            verify_ssl_cert: Whether to verify the SSL certificate of
+                the AgileZen API server.  Defaults to True.
+            jobs: The maximum number of write operations to execute
+                concurrently.  Defaults to 1.
+            max_concurrent_pages: The maximum number of pages of
+                query results to get concurrently.  Defaults to 4.
+            rate_limit: The maximum number of requests to send per
+                minute, as allowed by the API's quota.  Defaults to
+                None, i.e. no limit.
+            max_retries: The maximum number of times to retry a
+                throttled or failed request.  Defaults to 5.
+            backoff_base: The maximum delay before the first retry of
+                a request, in seconds.  The maximum delay doubles at
+                every retry.  Defaults to 1.
+            max_backoff: The maximum delay before any retry, in
+                seconds.  Defaults to 60.
+            profiler: The profiling.Profiler to record HTTP requests
+                into.  Defaults to None, i.e. no profiling.
+            cache: The httpcache.ResponseCache to cache the responses
+                to GET requests into.  Cached responses are
+                revalidated with the ETag or Last-Modified headers of
+                the responses if present, and otherwise used until
+                their TTL expires.  Defaults to None, i.e. no caching.
+            cache_ttls: The dict of the TTLs of the cached responses
+                that can't be revalidated, by endpoint template, e.g.
+                'projects/{id}/tags', in seconds.  Defaults to
+                DEFAULT_CACHE_TTLS.
+        """
         self.api_base_url = api_base_url
         self.api_key = api_key
         self.page_size = page_size
-        self.session = requests.session()
-        self.session.verify = verify_ssl_cert
+        self.max_concurrent_pages = max_concurrent_pages
+        self._adaptive_page_size = 100
+        self.verify_ssl_cert = verify_ssl_cert
+        self._sessions = SessionPool(verify_ssl_cert)
+        self.executor = StoryWriteExecutor(jobs)
+        self.token_bucket = None
+        if rate_limit:
+            # Allow bursts of up to one second's worth of requests.
+            self.token_bucket = TokenBucket(rate_limit / 60.0,
+                                            max(rate_limit / 60.0, 1.0))
+        self.circuit_breaker = CircuitBreaker()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.profiler = profiler
+        self.cache = cache
+        self.cache_ttls = (DEFAULT_CACHE_TTLS if cache_ttls is None
+                           else cache_ttls)
+
+    def _send(self, method, url, params, data, headers):
+        """Sends a request with a session of the pool.
+
+        Returns:
+            The Requests response object.
+
+        Raises:
+            requests.exceptions.RequestException: The request failed.
+        """
+        session = self._sessions.acquire()
+        try:
+            return session.request(method, url, params=params, data=data,
+                                   headers=headers)
+        finally:
+            self._sessions.release(session)
+
+    def fork(self):
+        """Creates a DAO that shares the connections of this DAO.
+
+        The new DAO shares the sessions, rate limit, circuit breaker,
+        profiler, and cache of this DAO, but has its own executor of
+        write operations, so that the operations submitted to every
+        DAO are waited for separately, e.g. when synchronizing several
+        AgileZen projects concurrently.
+
+        Returns:
+            The new AgileZenDataAccess object.
+        """
+        dao = copy.copy(self)
+        dao.executor = StoryWriteExecutor(self.executor.max_workers)
+        return dao
+
+    def submit(self, key, func, *args, **kwargs):
+        """Submits a write operation for concurrent execution.
 
-    def _get_headers(self):
-        return {
+        Operations submitted with the same key are executed in order.
+
+        Args:
+            key: The key identifying the sequence of operations to
+                execute in order, e.g. a story ID.
+            func: The callable to execute, e.g. a method of this DAO.
+            args: The positional arguments to pass to func.
+            kwargs: The keyword arguments to pass to func.
+        """
+        self.executor.submit(key, func, *args, **kwargs)
+
+    def wait(self):
+        """Waits for the execution of all submitted write operations.
+
+        Returns:
+            A dict which keys are the keys of failed operations, and
+            values are the exceptions they raised.
+        """
+        return self.executor.wait()
+
+    def _get_headers(self, conditional_headers=None):
+        headers = {
             'X-Zen-ApiKey': self.api_key,
             'Content-Type': 'application/json',
             'Accept': 'application/json',
             }
+        if conditional_headers:
+            headers.update(conditional_headers)
+        return headers
 
-    def _get(self, path, params=None):
-        url = self.api_base_url + path
-        response = self.session.get(url, params=params,
-                                    headers=self._get_headers())
-        if response.status_code != 200:
-            LOG.error('HTTP request failed with status code %i',
-                         response.status_code)
-            raise IOError('HTTP request failed')
-        return response.json()
+    @staticmethod
+    def _get_retry_after(response):
+        """Gets the delay before retrying a request from its response.
 
-    def _post(self, path, data):
+        Args:
+            response: The Requests response object.
+
+        Returns:
+            The delay in seconds given by the Retry-After header, or
+            None if the header is absent or invalid.
+        """
+        retry_after = response.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            retry_date = email.utils.parsedate_tz(retry_after)
+            if retry_date is None:
+                return None
+            return max(email.utils.mktime_tz(retry_date) - time.time(), 0.0)
+
+    def _request(self, method, path, params=None, data=None,
+                 conditional_headers=None):
+        """Sends an HTTP request, retrying it if it fails temporarily.
+
+        Throttled requests and requests that failed because of server
+        errors are retried with a jittered exponential backoff, or
+        after the delay requested by the server.  Non-idempotent
+        requests are retried only if they were rejected without being
+        processed.
+
+        Args:
+            method: The HTTP method, e.g. 'GET'.
+            path: The path of the resource, relative to the API's
+                base URL.
+            params: The dict of query parameters.  Defaults to None.
+            data: The JSON data to send in the request's body.
+                Defaults to None.
+            conditional_headers: The dict of the If-None-Match or
+                If-Modified-Since headers to send.  Defaults to None.
+
+        Returns:
+            The Requests response object of the successful request.
+            Its status code is 304 if the resource was not modified
+            according to the conditional headers.
+
+        Raises:
+            IOError: The request failed and cannot be retried.
+        """
         url = self.api_base_url + path
         if data is not None:
             data = json.dumps(data)
-        response = self.session.post(url, data=data,
-                                     headers=self._get_headers())
-        if response.status_code != 200:
-            LOG.error('HTTP request failed with status code %i',
-                         response.status_code)
-            raise IOError('HTTP request failed')
+        start_time = time.time()
+        attempt = 0
+        while True:
+            self.circuit_breaker.wait()
+            if self.token_bucket is not None:
+                self.token_bucket.acquire()
+            retry_after = None
+            try:
+                response = self._send(
+                    method, url, params, data,
+                    self._get_headers(conditional_headers))
+            except requests.exceptions.RequestException, e:
+                # The request may have been processed.
+                can_retry = method in IDEMPOTENT_METHODS
+                error = 'HTTP request failed: %s' % (e,)
+                self.circuit_breaker.record_failure()
+            else:
+                status_code = response.status_code
+                if status_code == 200 or (status_code == 304
+                                          and conditional_headers):
+                    self.circuit_breaker.record_success()
+                    self._record_request(method, path, start_time, data,
+                                         response)
+                    return response
+                if method == 'DELETE' and status_code == 404 and attempt > 0:
+                    # A previous attempt deleted the resource.
+                    self._record_request(method, path, start_time, data,
+                                         response)
+                    return response
+                can_retry = status_code in RETRY_STATUS_CODES and (
+                    method in IDEMPOTENT_METHODS
+                    or status_code in UNPROCESSED_STATUS_CODES)
+                error = ('HTTP request failed with status code %i'
+                         % (status_code,))
+                if status_code >= 500:
+                    self.circuit_breaker.record_failure()
+                if can_retry:
+                    retry_after = self._get_retry_after(response)
+            if not can_retry or attempt >= self.max_retries:
+                LOG.error('%s %s: %s', method, path, error)
+                self._record_request(method, path, start_time, data, None)
+                raise IOError(error)
+            if retry_after is not None:
+                # The server is throttling all requests, so pause all
+                # threads.
+                delay = retry_after
+                self.circuit_breaker.pause(delay)
+            else:
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff_base * 2**attempt))
+            LOG.warning('%s %s: %s, retrying in %.1fs',
+                        method, path, error, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _record_request(self, method, path, start_time, data, response):
+        """Records a request into the profiler, if profiling.
+
+        Args:
+            method: The HTTP method, e.g. 'GET'.
+            path: The path of the resource, relative to the API's
+                base URL.
+            start_time: The time at which the request's first attempt
+                started.
+            data: The serialized JSON data sent in the request's
+                body, or None.
+            response: The Requests response object, or None if the
+                request failed.
+        """
+        if self.profiler is None:
+            return
+        nbytes = len(data) if data is not None else 0
+        if response is not None:
+            nbytes += len(response.content)
+        self.profiler.record_http_request(method, path,
+                                          time.time() - start_time, nbytes)
+
+    def _get(self, path, params=None, revalidate=False):
+        if self.cache is None:
+            return self._request('GET', path, params=params).json()
+        return self._get_cached(path, params, revalidate)
+
+    def _get_cached(self, path, params, revalidate=False):
+        """Gets a resource, from the cache if it is not modified.
+
+        Args:
+            path: The path of the resource, relative to the API's
+                base URL.
+            params: The dict of query parameters, or None.
+            revalidate: If True, a cached response that can't be
+                revalidated is not used even if its TTL has not
+                expired, and the resource is requested again.
+                Defaults to False.
+
+        Returns:
+            The resource's JSON value.
+        """
+        key = httpcache.get_key(self.api_base_url + path, params)
+        ttl = self.cache_ttls.get(profiling.get_endpoint_template(path), 0)
+        generation = self.cache.generation
+        cached_response = self.cache.get(key)
+        conditional_headers = {}
+        if cached_response is not None:
+            if cached_response.etag is not None:
+                conditional_headers['If-None-Match'] = cached_response.etag
+            if cached_response.last_modified is not None:
+                conditional_headers['If-Modified-Since'] = (
+                    cached_response.last_modified)
+            if (not conditional_headers and not revalidate
+                and time.time() < cached_response.stored_time + ttl):
+                self.cache.record('hit')
+                return json.loads(cached_response.body)
+        response = self._request('GET', path, params=params,
+                                 conditional_headers=conditional_headers)
+        if response.status_code == 304:
+            self.cache.record('revalidation')
+            self.cache.touch(key)
+            return json.loads(cached_response.body)
+        self.cache.record('miss')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified or ttl > 0:
+            self.cache.put(key, path, etag, last_modified, response.content,
+                           generation)
         return response.json()
 
+    def _invalidate_cache(self, path):
+        """Deletes the cached responses modified by a write into a resource.
+
+        Args:
+            path: The path of the written resource, relative to the
+                API's base URL.
+        """
+        if self.cache is None:
+            return
+        paths = [path]
+        elements = path.split('/')
+        if len(elements) >= 3 and elements[0] == 'projects':
+            # Writing a project's stories may create tags, and writing
+            # its tags modifies its stories.
+            paths.extend(['/'.join(elements[:2] + [collection])
+                          for collection in ('stories', 'tags')])
+        self.cache.invalidate(paths)
+
+    def _post(self, path, data):
+        try:
+            return self._request('POST', path, data=data).json()
+        finally:
+            self._invalidate_cache(path)
+
     def _put(self, path, data):
-        url = self.api_base_url + path
-        if data is not None:
-            data = json.dumps(data)
-        response = self.session.put(url, data=data,
-                                    headers=self._get_headers())
-        if response.status_code != 200:
-            LOG.error('HTTP request failed with status code %i',
-                         response.status_code)
-            raise IOError('HTTP request failed')
-        return response.json()
+        try:
+            return self._request('PUT', path, data=data).json()
+        finally:
+            self._invalidate_cache(path)
 
     def _delete(self, path, params=None):
-        url = self.api_base_url + path
-        response = self.session.delete(url, params=params,
-                                       headers=self._get_headers())
-        if response.status_code != 200:
-            LOG.error('HTTP request failed with status code %i',
-                         response.status_code)
-            raise IOError('HTTP request failed')
-
-    def _iter_query(self, path, add_params=None):
-        page = 1
-        while True:
-            params = {
-                'page': page,
-                'pageSize': self.page_size,
-                }
-            if add_params:
-                params.update(add_params)
-            # TODO: Support adding filters.
-            query_res = self._get(path, params=params)
+        try:
+            self._request('DELETE', path, params=params)
+        finally:
+            self._invalidate_cache(path)
+
+    def _adapt_page_size(self, page_size, item_count, elapsed):
+        """Adapts the page size of the next queries to a page's latency.
+
+        The page size is doubled if a full page was answered in less
+        than half of PAGE_LATENCY_TARGET, and halved if a page was
+        answered in more than PAGE_LATENCY_TARGET.
+
+        Args:
+            page_size: The page size of the answered page.
+            item_count: The number of items in the answered page.
+            elapsed: The time it took to get the page, in seconds.
+        """
+        if elapsed > PAGE_LATENCY_TARGET:
+            self._adaptive_page_size = max(page_size // 2, MIN_PAGE_SIZE)
+        elif item_count >= page_size and elapsed < PAGE_LATENCY_TARGET / 2:
+            self._adaptive_page_size = min(page_size * 2, MAX_PAGE_SIZE)
+
+    def _get_page(self, path, page, page_size, add_params,
+                  revalidate=False):
+        params = {
+            'page': page,
+            'pageSize': page_size,
+            }
+        if add_params:
+            params.update(add_params)
+        start_time = time.time()
+        query_res = self._get(path, params=params, revalidate=revalidate)
+        if self.page_size is None:
+            self._adapt_page_size(page_size, len(query_res['items']),
+                                  time.time() - start_time)
+        return query_res
+
+    def _iter_query(self, path, add_params=None, revalidate=False):
+        # The page size must remain the same for all pages of a query.
+        page_size = self.page_size or self._adaptive_page_size
+        query_res = self._get_page(path, 1, page_size, add_params,
+                                   revalidate)
+        for json_obj in query_res['items']:
+            yield json_obj
+        # Get the next pages concurrently, now that their number is
+        # known.
+        next_pages = [
+            (lambda page=page:
+                 self._get_page(path, page, page_size, add_params,
+                                revalidate))
+            for page in xrange(2, query_res['totalPages'] + 1)]
+        for query_res in iter_concurrently(next_pages,
+                                           self.max_concurrent_pages):
             for json_obj in query_res['items']:
                 yield json_obj
-            if page >= query_res['totalPages']:
-                return
-            page += 1
 
     def iter_projects(self, where=None):
         add_params = {}
@@ -289,13 +1116,15 @@ class AgileZenDataAccess(object):
         for json_obj in self._iter_query('projects', add_params=add_params):
             yield Project.create_from_json(json_obj)
 
-    def get_project(self, project_id):
+    def get_project(self, project_id, revalidate=False):
         return Project.create_from_json(
-            self._get('/'.join(['projects', str(project_id)])))
+            self._get('/'.join(['projects', str(project_id)]),
+                      revalidate=revalidate))
 
-    def iter_project_phases(self, project_id):
+    def iter_project_phases(self, project_id, revalidate=False):
         for json_obj in self._iter_query(
-            '/'.join(['projects', str(project_id), 'phases'])):
+            '/'.join(['projects', str(project_id), 'phases']),
+            revalidate=revalidate):
             yield Phase.create_from_json(json_obj)
 
     def iter_project_tags(self, project_id):
@@ -304,8 +1133,7 @@ class AgileZenDataAccess(object):
             yield Tag.create_from_json(json_obj)
 
     def iter_project_stories(self, project_id, with_details=False,
-                             with_tags=False, with_tasks=False):
-        # TODO: Support adding filters.
+                             with_tags=False, with_tasks=False, where=None):
         enrichments = []
         if with_details:
             enrichments.append('details')
@@ -314,6 +1142,8 @@ class AgileZenDataAccess(object):
         if with_tasks:
             enrichments.append('tasks')
         add_params = {'with': ','.join(enrichments)} if enrichments else {}
+        if where is not None:
+            add_params['where'] = where
         for json_obj in self._iter_query(
             '/'.join(['projects', str(project_id), 'stories']),
             add_params=add_params):
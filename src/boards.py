@@ -0,0 +1,226 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import ConfigParser
+import datetime
+import logging
+
+import agilezen
+import omnifocus
+
+
+LOG = logging.getLogger('boards')
+
+# The color of the stories of projects which context matches no
+# configured color.
+DEFAULT_COLOR = 'green'
+
+
+class Board(collections.namedtuple('Board', (
+            'name', 'az_project_id', 'of_project_selector',
+            'of_color_picker', 'owner_username'))):
+    """An AgileZen project to synchronize OmniFocus projects into.
+
+    The of_project_selector is a callable taking an OmniFocus project
+    object, and returns True or False whether the project must be
+    synchronized into the AgileZen project.  The of_color_picker is a
+    callable taking an OmniFocus project object, and returns the color
+    of its story.  The owner_username is the username of the owner to
+    assign to all stories, or None.
+    """
+
+
+def is_project_scheduled(of_project):
+    """Returns whether a project is neither dropped nor deferred.
+
+    Args:
+        of_project: The OmniFocus project object.
+
+    Returns:
+        True if the project is not dropped, and has no start date or
+        a start date in the past.
+    """
+    return (of_project.status != omnifocus.STATUS_DROPPED
+            and (of_project.start_date is None
+                 or of_project.start_date < datetime.datetime.now()))
+
+
+def _matches_prefix(name, prefixes, separator):
+    """Returns whether a hierarchical name is in any of given hierarchies.
+
+    Args:
+        name: The full name, e.g. "Work, Admin".
+        prefixes: The iterable of full names of hierarchies, e.g.
+            ["Work"].
+        separator: The separator of the names of the hierarchy's
+            levels, e.g. ", ".
+
+    Returns:
+        True if name is any of the prefixes or a descendant of one.
+    """
+    return any(name == prefix or name.startswith(prefix + separator)
+               for prefix in prefixes)
+
+
+def make_project_selector(folders=None):
+    """Creates a selector of the scheduled projects in given folders.
+
+    Args:
+        folders: The list of the full names of the folders which
+            projects and sub-folders' projects are selected, e.g.
+            ["Work, Admin"].  Defaults to None, i.e. the projects in
+            all folders are selected.
+
+    Returns:
+        A callable taking an OmniFocus project object, and returns
+        True or False whether the project must be synchronized.
+    """
+    if not folders:
+        return is_project_scheduled
+    folders = tuple(folders)
+    return (lambda proj: is_project_scheduled(proj)
+                         and _matches_prefix(proj.full_folder_name,
+                                             folders, ', '))
+
+
+def make_color_picker(context_colors=(), default_color=DEFAULT_COLOR):
+    """Creates a picker of the colors of stories by project context.
+
+    Args:
+        context_colors: The list of (context, color) tuples, where
+            context is the full name of a context, e.g. "Office/Phone",
+            and color is the color of the stories of the projects in
+            that context or its sub-contexts.  The first matching
+            context applies.  Defaults to no contexts.
+        default_color: The color of the stories of the projects that
+            match no context.  Defaults to DEFAULT_COLOR.
+
+    Returns:
+        A callable taking an OmniFocus project object, and returns the
+        color of its story.
+    """
+    context_colors = tuple(context_colors)
+
+    def pick_color(proj):
+        full_context_name = proj.full_context_name
+        for context, color in context_colors:
+            if _matches_prefix(full_context_name, (context,), '/'):
+                return color
+        return default_color
+
+    return pick_color
+
+
+def _get_lines(config, section, option):
+    """Gets the non-empty lines of a multi-line option's value.
+    """
+    if not config.has_option(section, option):
+        return []
+    return [line.strip() for line in config.get(section, option).split('\n')
+            if line.strip()]
+
+
+def _check_color(path, section, color):
+    if color not in agilezen.COLORS:
+        raise ValueError('invalid color "%s" in board "%s" in file "%s", '
+                         'must be one of: %s'
+                         % (color, section, path, ', '.join(agilezen.COLORS)))
+
+
+def read_boards(path):
+    """Reads the configuration of the boards to synchronize.
+
+    The configuration is an INI file with one section per board, e.g.:
+
+        [work]
+        project = 1234
+        folders =
+            Work
+            Admin, Finance
+        colors =
+            Office/Phone: blue
+            Errands: yellow
+        color = green
+        owner = jdoe
+
+    Only the project option is required.  The folders are the full
+    names of the folders which projects are synchronized, one per
+    line, and default to all folders.  The colors are the colors of
+    the stories by project context, one "CONTEXT: COLOR" per line, and
+    color is the color of the other stories, which defaults to
+    DEFAULT_COLOR.  The owner is the username of the owner to assign
+    to all stories, and defaults to none.
+
+    Args:
+        path: The path of the configuration file.
+
+    Returns:
+        The list of Board objects, in the order of the file.
+
+    Raises:
+        IOError: The file can't be read.
+        ValueError: The configuration is invalid.
+    """
+    config = ConfigParser.RawConfigParser()
+    with open(path) as f:
+        try:
+            config.readfp(f)
+        except ConfigParser.Error, e:
+            raise ValueError('invalid boards file "%s": %s' % (path, e))
+    boards = []
+    for section in config.sections():
+        try:
+            az_project_id = config.getint(section, 'project')
+        except (ConfigParser.Error, ValueError), e:
+            raise ValueError('invalid project of board "%s" in file "%s": '
+                             '%s' % (section, path, e))
+        context_colors = []
+        for line in _get_lines(config, section, 'colors'):
+            context, sep, color = line.rpartition(':')
+            color = color.strip()
+            if not sep:
+                raise ValueError('invalid color "%s" in board "%s" in file '
+                                 '"%s", must be "CONTEXT: COLOR"'
+                                 % (line, section, path))
+            _check_color(path, section, color)
+            context_colors.append((context.strip(), color))
+        default_color = DEFAULT_COLOR
+        if config.has_option(section, 'color'):
+            default_color = config.get(section, 'color').strip()
+            _check_color(path, section, default_color)
+        owner_username = None
+        if config.has_option(section, 'owner'):
+            owner_username = config.get(section, 'owner').strip() or None
+        boards.append(Board(
+            section, az_project_id,
+            make_project_selector(_get_lines(config, section, 'folders')),
+            make_color_picker(context_colors, default_color),
+            owner_username))
+    if not boards:
+        raise ValueError('no boards in file "%s"' % (path,))
+    project_ids = collections.Counter(board.az_project_id
+                                      for board in boards)
+    for az_project_id, count in project_ids.iteritems():
+        if count > 1:
+            raise ValueError('AgileZen project %i is synchronized by %i '
+                             'boards in file "%s"'
+                             % (az_project_id, count, path))
+    LOG.debug('read %i boards from file "%s"', len(boards), path)
+    return boards
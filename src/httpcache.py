@@ -0,0 +1,215 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+import sqlite3
+import threading
+import time
+import urllib
+
+
+LOG = logging.getLogger('httpcache')
+
+# The time after which unused responses are purged from caches, in
+# seconds.
+MAX_AGE = 7 * 24 * 3600
+
+
+def get_key(url, params=None):
+    """Gets the cache key of a GET request.
+
+    Args:
+        url: The URL of the resource, without query parameters.
+        params: The dict of query parameters.  Defaults to None.
+
+    Returns:
+        The key, i.e. the URL with its query parameters sorted.
+    """
+    if not params:
+        return url
+    return '%s?%s' % (url, urllib.urlencode(sorted(params.iteritems())))
+
+
+class CachedResponse(collections.namedtuple('CachedResponse', (
+            'etag', 'last_modified', 'stored_time', 'body'))):
+    """The body of a cached response, and its validators.
+
+    The etag and last_modified are the values of the response's ETag
+    and Last-Modified headers, or None.  The stored_time is the time at
+    which the response was received or last revalidated.
+    """
+
+
+class ResponseCache(object):
+    """An on-disk cache of the responses to GET requests.
+
+    The cache is an SQLite database.  Every response is stored with
+    the path of its resource, to invalidate the responses of all the
+    requests of a resource, whatever their query parameters.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, path, max_age=MAX_AGE):
+        """Open the cache in the given file, creating it if necessary.
+
+        Responses unused for more than max_age seconds are purged.
+
+        Args:
+            path: The path of the SQLite database file.
+            max_age: The time after which unused responses are
+                purged, in seconds.  Defaults to MAX_AGE.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Incremented at every invalidation, to not store responses
+        # to requests sent before an invalidation.
+        self.generation = 0
+        # The numbers of responses served from the cache without
+        # requests, served from the cache after a revalidation, and
+        # not served from the cache.
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, '
+                'path TEXT NOT NULL, '
+                'etag TEXT, '
+                'last_modified TEXT, '
+                'stored_time REAL NOT NULL, '
+                'body BLOB NOT NULL)')
+            self.conn.execute(
+                'DELETE FROM responses WHERE stored_time < ?',
+                (time.time() - max_age,))
+        # The paths of the cached resources, to invalidate them
+        # without accessing the database if they are not cached.
+        self._paths = set([row[0] for row in self.conn.execute(
+                    'SELECT DISTINCT path FROM responses')])
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        """Gets a cached response.
+
+        Args:
+            key: The key of the request, as returned by get_key.
+
+        Returns:
+            The CachedResponse, or None if no response is cached.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT etag, last_modified, stored_time, body '
+                'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, stored_time, body = row
+        return CachedResponse(etag, last_modified, stored_time, str(body))
+
+    def put(self, key, path, etag, last_modified, body, generation):
+        """Stores a response.
+
+        The response is not stored if entries were invalidated since
+        its request was sent, since it may be stale.
+
+        Args:
+            key: The key of the request, as returned by get_key.
+            path: The path of the requested resource.
+            etag: The value of the response's ETag header, or None.
+            last_modified: The value of the response's Last-Modified
+                header, or None.
+            body: The body of the response, as a string.
+            generation: The generation of the cache when the request
+                was sent.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO responses '
+                    '(key, path, etag, last_modified, stored_time, body) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, path, etag, last_modified, time.time(),
+                     sqlite3.Binary(body)))
+            self._paths.add(path)
+
+    def touch(self, key):
+        """Records that a cached response was revalidated.
+
+        Args:
+            key: The key of the request, as returned by get_key.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE responses SET stored_time = ? WHERE key = ?',
+                    (time.time(), key))
+
+    def invalidate(self, paths):
+        """Deletes the cached responses of resources.
+
+        Args:
+            paths: The iterable of the paths of the resources.
+        """
+        with self._lock:
+            self.generation += 1
+            paths = self._paths.intersection(paths)
+            if not paths:
+                return
+            self._paths.difference_update(paths)
+            with self.conn:
+                self.conn.executemany(
+                    'DELETE FROM responses WHERE path = ?',
+                    [(path,) for path in paths])
+
+    def record(self, outcome):
+        """Counts a response.
+
+        Args:
+            outcome: 'hit', 'revalidation', or 'miss'.
+        """
+        with self._lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'revalidation':
+                self.revalidations += 1
+            else:
+                self.misses += 1
+
+    def get_stats(self):
+        """Gets the numbers of cache hits and misses.
+
+        Returns:
+            A dict with the 'hits', 'revalidations', and 'misses' keys.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'revalidations': self.revalidations,
+                    'misses': self.misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.revalidations = 0
+            self.misses = 0
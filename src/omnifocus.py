@@ -17,26 +17,279 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import calendar
+import collections
+import datetime
+import logging
+import operator
+import threading
+import time
+
 # appscript
 # URL: http://appscript.sourceforge.net/
 # MacPorts package: py*-appscript
-import appscript
+# Optional, e.g. to read OmniFocus's database from its bundle on
+# other systems than Mac OS X.
+try:
+    import appscript
+except ImportError:
+    appscript = None
+
+
+LOG = logging.getLogger('omnifocus')
+
+# The statuses of projects.  They are AppleScript keywords if appscript
+# is installed, and strings otherwise.
+if appscript is not None:
+    STATUS_ACTIVE = appscript.k.active
+    STATUS_ON_HOLD = appscript.k.on_hold
+    STATUS_DONE = appscript.k.done
+    STATUS_DROPPED = appscript.k.dropped
+else:
+    STATUS_ACTIVE = 'active'
+    STATUS_ON_HOLD = 'on_hold'
+    STATUS_DONE = 'done'
+    STATUS_DROPPED = 'dropped'
+
+# The attributes of projects that are fetched in bulk, for all projects
+# at once, when taking a snapshot of the projects.
+PROJECT_SNAPSHOT_ATTRS = ('name', 'note', 'status', 'completed',
+                          'start_date', 'due_date', 'modification_date')
+
+# The attributes of projects that reference other objects, which IDs
+# are fetched in bulk and cached in the "<name>_id" attributes of
+# projects.
+PROJECT_SNAPSHOT_REF_ATTRS = ('container', 'context')
+
+# The attributes of tasks that are fetched in bulk, for all tasks at
+# once, when grouping tasks by project.
+TASK_SNAPSHOT_ATTRS = ('name', 'completed', 'start_date', 'due_date',
+                       'modification_date')
+
+# The attributes of tasks that reference other objects, which IDs are
+# fetched in bulk and cached in the "<name>_id" attributes of tasks.
+TASK_SNAPSHOT_REF_ATTRS = ('containing_project', 'parent_task', 'context')
+
+# The default maximum number of proxy objects cached by a DAO.
+DEFAULT_PROXY_CACHE_SIZE = 200000
+
+# The fraction of the maximum number of cached proxy objects that is
+# evicted at once when the cache is full.
+PROXY_CACHE_EVICTION_RATIO = 0.25
+
+# The format of the UTC timestamps in OmniFocus's exports, without the
+# fractions of seconds and the time zone, e.g. "2012-09-01T10:30:00".
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def parse_time(text):
+    """Parses an exported timestamp, e.g. "2012-09-01T10:30:00.000Z".
+
+    Args:
+        text: The timestamp in UTC, or None.
+
+    Returns:
+        The naive datetime in local time, like the dates read with
+        Apple Events, or None.
+    """
+    if not text:
+        return None
+    return datetime.datetime.fromtimestamp(
+        calendar.timegm(time.strptime(text[:19], TIME_FORMAT)))
+
+
+class ProxyCache(object):
+    """A thread-safe, bounded cache of proxy objects, by object ID.
+
+    Proxy objects may be looked up and created concurrently, e.g. by
+    the thread reading OmniFocus while AgileZen is read by others,
+    and a single proxy object is created for every cached object ID.
+
+    The cache has a generation, which is incremented at the start of
+    every pass of reads from OmniFocus.  The attribute values cached
+    in proxy objects during previous generations are stale, and are
+    read again at their next accesses.  When the cache is full, the
+    proxy objects which were used in the oldest generations are
+    evicted, i.e. the least recently used at the granularity of
+    generations.
+    """
+
+    def __init__(self, max_size=DEFAULT_PROXY_CACHE_SIZE):
+        """Initialize an empty cache.
+
+        Args:
+            max_size: The maximum number of cached proxy objects.
+                Defaults to DEFAULT_PROXY_CACHE_SIZE.
+        """
+        self.max_size = max_size
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._proxies = {}
+        # The last generation in which every proxy object was used, by
+        # object ID.
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.attr_hits = 0
+        self.attr_misses = 0
+
+    def new_generation(self):
+        """Starts a new generation, making all attribute values stale.
+        """
+        with self._lock:
+            self.generation += 1
+
+    def _evict(self):
+        """Evicts the least recently used proxy objects.
+
+        Enough proxy objects are evicted at once to make room for
+        PROXY_CACHE_EVICTION_RATIO of the maximum size, so that the
+        proxy objects are not sorted at every insertion.  Must be
+        called with the lock held.
+        """
+        size = int(self.max_size * (1 - PROXY_CACHE_EVICTION_RATIO))
+        evicted = sorted(self._used.iteritems(),
+                         key=operator.itemgetter(1))
+        for obj_id, _ in evicted[:len(self._proxies) - size]:
+            del self._proxies[obj_id]
+            del self._used[obj_id]
+            self.evictions += 1
+
+    def get(self, obj_id):
+        """Gets a cached proxy object.
+
+        Args:
+            obj_id: The ID of the proxied object.
+
+        Returns:
+            The proxy object, or None if not cached.
+        """
+        with self._lock:
+            proxy = self._proxies.get(obj_id)
+            if proxy is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._used[obj_id] = self.generation
+            return proxy
+
+    def get_or_create(self, obj_id, create):
+        """Gets a cached proxy object, or creates and caches it.
+
+        Args:
+            obj_id: The ID of the proxied object.
+            create: The callable taking no arguments, that returns a
+                new proxy object to cache if none is cached.
+
+        Returns:
+            The cached or newly created proxy object.
+        """
+        with self._lock:
+            proxy = self._proxies.get(obj_id)
+            if proxy is None:
+                self.misses += 1
+                if len(self._proxies) >= self.max_size:
+                    self._evict()
+                proxy = create()
+                self._proxies[obj_id] = proxy
+            else:
+                self.hits += 1
+            self._used[obj_id] = self.generation
+            return proxy
+
+    def record_attr(self, hit):
+        """Counts an access to an attribute of a proxy object.
+
+        Attribute accesses are the most frequent operations on proxy
+        objects, so they are counted without locking, and the counts
+        may be slightly underestimated when proxy objects are accessed
+        concurrently.
+
+        Args:
+            hit: True if the attribute's value was cached, False if it
+                was read from OmniFocus.
+        """
+        if hit:
+            self.attr_hits += 1
+        else:
+            self.attr_misses += 1
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def get_stats(self):
+        """Gets the numbers of cache hits and misses.
+
+        Returns:
+            A dict with the 'size', 'hits', 'misses', and 'evictions'
+            keys for proxy objects, and the 'attr_hits' and
+            'attr_misses' keys for their attribute values.
+        """
+        with self._lock:
+            return {'size': len(self._proxies), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'attr_hits': self.attr_hits,
+                    'attr_misses': self.attr_misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.attr_hits = 0
+            self.attr_misses = 0
 
 
 class LazyAppScriptObject(object):
     """A proxy to an AppScript object that caches objects and attributes.
+
+    The attribute values are cached until the generation of the proxy
+    cache changes, and are then read again lazily.  Proxies compare
+    equal if they proxy the same AppScript object, even if one was
+    evicted from the proxy cache.
     """
 
-    def __init__(self, raw_obj, proxy_cache):
+    __slots__ = ('_raw_obj', '_proxy_cache', '_profiler', '_values',
+                 '_generation')
+
+    def __init__(self, raw_obj, proxy_cache, profiler=None):
         """Initialize this proxy to proxy the given AppScript object.
 
         Args:
             raw_obj: The AppScript object to proxy.
-            proxy_cache: The dictionary to use as a proxy object cache
-                when reading object attributes.  Keys are object IDs.
+            proxy_cache: The ProxyCache to use when reading object
+                attributes referencing other objects.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+        """
+        object.__setattr__(self, '_raw_obj', raw_obj)
+        object.__setattr__(self, '_proxy_cache', proxy_cache)
+        object.__setattr__(self, '_profiler', profiler)
+        object.__setattr__(self, '_values', {})
+        object.__setattr__(self, '_generation', proxy_cache.generation)
+
+    def __eq__(self, other):
+        return (isinstance(other, LazyAppScriptObject)
+                and self._raw_obj == other._raw_obj)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._raw_obj)
+
+    def _get_values(self):
+        """Gets the attribute values cached in the current generation.
+
+        Returns:
+            The dict of the cached attribute values, by name.
         """
-        self.__dict__['_raw_obj'] = raw_obj
-        self.__dict__['_proxy_cache'] = proxy_cache
+        generation = self._proxy_cache.generation
+        if self._generation != generation:
+            object.__setattr__(self, '_values', {})
+            object.__setattr__(self, '_generation', generation)
+        return self._values
 
     def _convert_attr_value(self, v):
         """Converts an AppScript attribute value.
@@ -50,18 +303,28 @@ class LazyAppScriptObject(object):
         if v == appscript.k.missing_value:
             return None
         elif isinstance(v, appscript.Reference):
-            proxy_cache = self.__dict__['_proxy_cache']
-            id = v.id
-            proxy = proxy_cache.get(id)
-            if proxy is None:
-                proxy = self.__class__(v, proxy_cache)
-                proxy_cache[id] = proxy
-            return proxy
+            proxy_cache = self._proxy_cache
+            return proxy_cache.get_or_create(
+                v.id, lambda: self.__class__(v, proxy_cache,
+                                             self._profiler))
         elif isinstance(v, list):
             return [self._convert_attr_value(o) for o in v]
         else:
             return v
 
+    def _cache_attr_value(self, name, value):
+        """Caches an attribute's value that was fetched in bulk.
+
+        The value is converted like any value read from the proxied
+        AppScript object, and the next accesses to the attribute in
+        the current generation will hit the cache.
+
+        Args:
+            name: The attribute's name.
+            value: The AppScript attribute value to convert and cache.
+        """
+        self._get_values()[name] = self._convert_attr_value(value)
+
     def _get_app_attr(self, name):
         """Gets an attribute's value from the proxied AppScript object.
 
@@ -75,14 +338,21 @@ class LazyAppScriptObject(object):
             The value of the attribute from the proxied AppScript
             object, or None if it has no value.
         """
-        return self._convert_attr_value(getattr(self._raw_obj, name).get())
+        profiler = self._profiler
+        if profiler is None:
+            return self._convert_attr_value(
+                getattr(self._raw_obj, name).get())
+        start_time = time.time()
+        value = getattr(self._raw_obj, name).get()
+        profiler.record_apple_event('get', name, time.time() - start_time)
+        return self._convert_attr_value(value)
 
     def __getattr__(self, name):
         """Gets and caches an attribute's value.
 
         The attribute's value is retrieved from the proxied AppScript
         object and cached, so that the next accesses to the attribute
-        will hit the cache.
+        in the current generation will hit the cache.
 
         Args:
             name: The attribute's name.
@@ -90,8 +360,17 @@ class LazyAppScriptObject(object):
         Returns:
             The value of the attribute from the proxied AppScript object.
         """
-        value = self._get_app_attr(name)
-        self.__dict__[name] = value
+        if name.startswith('__'):
+            raise AttributeError(name)
+        values = self._get_values()
+        try:
+            value = values[name]
+        except KeyError:
+            self._proxy_cache.record_attr(False)
+            value = self._get_app_attr(name)
+            values[name] = value
+        else:
+            self._proxy_cache.record_attr(True)
         return value
 
     def __setattr__(self, name, value):
@@ -104,14 +383,22 @@ class LazyAppScriptObject(object):
             name: The attribute's name.
             value: The attribute's value.
         """
-        getattr(self._raw_obj, name).set(value)
-        self.__dict__[name] = value
+        profiler = self._profiler
+        if profiler is None:
+            getattr(self._raw_obj, name).set(value)
+        else:
+            start_time = time.time()
+            getattr(self._raw_obj, name).set(value)
+            profiler.record_apple_event('set', name, time.time() - start_time)
+        self._get_values()[name] = value
 
 
 class OmniFocusLazyAppScriptObject(LazyAppScriptObject):
     """A proxy with special handling of OmniFocus-specific attributes.
     """
 
+    __slots__ = ()
+
     def _get_app_attr(self, name):
         if name in ('full_context_name', 'all_full_context_names'):
             name_parts = []
@@ -139,6 +426,168 @@ class OmniFocusLazyAppScriptObject(LazyAppScriptObject):
             return LazyAppScriptObject._get_app_attr(self, name)
 
 
+class HierarchyIndex(object):
+    """An in-memory index of the hierarchies of contexts and folders.
+
+    Full context and folder names are resolved by dictionary lookups
+    instead of walking up the hierarchy with Apple Events, and are
+    memoized.
+    """
+
+    def __init__(self, contexts, folders):
+        """Initialize this index with the given contexts and folders.
+
+        Args:
+            contexts: A dict which keys are context IDs and values are
+                tuples (name, parent_id), where parent_id is the ID of
+                the parent context, or of any object that is not a
+                context for top-level contexts.
+            folders: A dict which keys are folder IDs and values are
+                tuples (name, parent_id), similarly to contexts.
+        """
+        self.contexts = contexts
+        self.folders = folders
+        self._context_paths = {}
+        self._folder_paths = {}
+
+    @classmethod
+    def _get_path(cls, items, item_id, paths):
+        """Gets the names of an item and of all its ancestors.
+
+        Args:
+            items: The dict of (name, parent_id) tuples of all items.
+            item_id: The ID of the item.
+            paths: The dict to use to memoize the paths of items.
+
+        Returns:
+            The tuple of the names of the top-level ancestor down to
+            the item, or an empty tuple if the item is not found.
+        """
+        path = paths.get(item_id)
+        if path is None:
+            item = items.get(item_id)
+            if item is None:
+                path = ()
+            else:
+                name, parent_id = item
+                path = cls._get_path(items, parent_id, paths) + (name,)
+            paths[item_id] = path
+        return path
+
+    def get_full_context_name(self, context_id):
+        """Gets the full name of a context, e.g. "Office/Phone".
+
+        Args:
+            context_id: The ID of the context, or None.
+
+        Returns:
+            The '/'-separated names of the context's hierarchy, or an
+            empty string if the context is not found.
+        """
+        return '/'.join(
+            self._get_path(self.contexts, context_id, self._context_paths))
+
+    def get_all_full_context_names(self, context_id):
+        """Gets the full names of a context and of all its ancestors.
+
+        Args:
+            context_id: The ID of the context, or None.
+
+        Returns:
+            The list of the full names of the context's ancestors
+            from the top-level context down to the context, e.g.
+            ["Office", "Office/Phone"], or an empty list if the
+            context is not found.
+        """
+        path = self._get_path(self.contexts, context_id, self._context_paths)
+        return ['/'.join(path[:i]) for i in xrange(1, len(path)+1)]
+
+    def get_full_folder_name(self, folder_id):
+        """Gets the full name of a folder, e.g. "Work, Admin".
+
+        Args:
+            folder_id: The ID of the folder, or None.
+
+        Returns:
+            The ', '-separated names of the folder's hierarchy, or an
+            empty string if the folder is not found.
+        """
+        return ', '.join(
+            self._get_path(self.folders, folder_id, self._folder_paths))
+
+
+def _index_projects(projects, selector):
+    """Selects projects, and indexes them by ID.
+
+    Args:
+        projects: The iterable of project objects, in order.
+        selector: A callable taking a project object, and returns
+            True or False whether the project must be selected or not.
+
+    Returns:
+        A dict which keys are project IDs and values are tuples
+        (index, project) where index reflect the relative order of
+        projects in the results, and project is a project object.
+    """
+    selected_projects = [project for project in projects
+                         if selector(project)]
+    indexed_projects = zip(xrange(0, len(selected_projects)),
+                           selected_projects)
+    return dict([(index_project[1].id, index_project)
+                 for index_project in indexed_projects])
+
+
+class Project(collections.namedtuple('Project', (
+            'id', 'name', 'note', 'status', 'completed', 'start_date',
+            'due_date', 'modification_date', 'container_id', 'context_id',
+            'full_folder_name', 'full_context_name',
+            'all_full_context_names'))):
+    """An OmniFocus project read all at once, e.g. from an export.
+
+    The attributes have the same names and values as those of the
+    project proxy objects of OmniFocusDataAccess.  The container_id is
+    the ID of the project's folder, or None.
+    """
+
+
+class Task(collections.namedtuple('Task', (
+            'id', 'name', 'note', 'completed', 'start_date', 'due_date',
+            'modification_date', 'containing_project_id', 'parent_task_id',
+            'context_id', 'full_context_name', 'all_full_context_names'))):
+    """An OmniFocus task read all at once, e.g. from an export.
+
+    The attributes have the same names and values as those of the task
+    proxy objects of OmniFocusDataAccess.
+    """
+
+
+class OmniFocusSnapshot(collections.namedtuple('OmniFocusSnapshot', (
+            'index', 'projects', 'project_tasks'))):
+    """An in-memory snapshot of all OmniFocus projects and tasks.
+
+    The index is the HierarchyIndex of all contexts and folders,
+    projects is the OrderedDict of all projects by ID, as returned by
+    snapshot_projects, and project_tasks is the dict of the lists of
+    tasks by project ID, as returned by get_tasks_by_project.  A
+    snapshot may be shared by several synchronizations, e.g. to
+    different AgileZen projects.
+    """
+
+    def select_projects(self, selector):
+        """Get the projects of this snapshot that match a selector.
+
+        Args:
+            selector: A callable taking a project object, and returns
+                True or False whether the project must be selected or
+                not.
+
+        Returns:
+            A dict which keys are project IDs and values are tuples
+            (index, project), as returned by get_projects.
+        """
+        return _index_projects(self.projects.itervalues(), selector)
+
+
 class OmniFocusDataAccess(object):
     """Provides access to OmniFocus projects and tasks.
 
@@ -146,15 +595,59 @@ class OmniFocusDataAccess(object):
     of corruption of OmniFocus's database.
     """
 
-    def __init__(self, app):
+    def __init__(self, app, profiler=None,
+                 max_cached_proxies=DEFAULT_PROXY_CACHE_SIZE):
         """Initialize this DAO to the given AppleScript application stub.
 
         Args:
             app: The appscript app object to use to access
                 OmniFocus. The application must be running.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+            max_cached_proxies: The maximum number of cached proxy
+                objects.  Defaults to DEFAULT_PROXY_CACHE_SIZE.
         """
         self.app = app
-        self.obj_cache = dict()
+        self.obj_cache = ProxyCache(max_cached_proxies)
+        self.profiler = profiler
+        # Serializes the writes into OmniFocus, which may be executed
+        # by concurrent synchronizations, e.g. to several AgileZen
+        # projects.
+        self._write_lock = threading.Lock()
+
+    def _get(self, ref, name):
+        """Sends an Apple Event to get the value of a reference.
+
+        Args:
+            ref: The AppScript reference to get.
+            name: The name of the reference, e.g. "flattened_tasks.id",
+                to record the event under when profiling.
+
+        Returns:
+            The AppScript value.
+        """
+        if self.profiler is None:
+            return ref.get()
+        start_time = time.time()
+        value = ref.get()
+        self.profiler.record_apple_event('get', name,
+                                         time.time() - start_time)
+        return value
+
+    def _new_proxy(self, raw_obj):
+        """Create a caching proxy object, without caching it.
+        """
+        return OmniFocusLazyAppScriptObject(raw_obj, self.obj_cache,
+                                            self.profiler)
+
+    def begin_pass(self):
+        """Starts a new pass of reads from OmniFocus.
+
+        All the attribute values cached in proxy objects become
+        stale, so that they are read again from OmniFocus at their
+        next accesses.  The proxy objects themselves are reused.
+        """
+        self.obj_cache.new_generation()
 
     def _proxy_object(self, raw_obj):
         """Create a caching proxy object to proxy an AppScript object.
@@ -170,12 +663,197 @@ class OmniFocusDataAccess(object):
             A cached or a newly created caching proxy object with the
             ID in the given raw_obj.
         """
-        obj_id = raw_obj.id.get()
-        proxy = self.obj_cache.get(obj_id)
-        if proxy is None:
-            proxy = OmniFocusLazyAppScriptObject(raw_obj, self.obj_cache)
-            self.obj_cache[obj_id] = proxy
-        return proxy
+        obj_id = self._get(raw_obj.id, 'id')
+        return self.obj_cache.get_or_create(
+            obj_id, lambda: self._new_proxy(raw_obj))
+
+    def _snapshot_objects(self, elements_name, attr_names, ref_attr_names=()):
+        """Create caching proxy objects with attributes fetched in bulk.
+
+        Every attribute is read for all the objects in the collection
+        at once, i.e. with one Apple Event per attribute instead of
+        one Apple Event per object and per attribute.  The values are
+        cached in the proxy objects.
+
+        Args:
+            elements_name: The name of the collection of objects to
+                proxy in the default document, e.g.
+                "flattened_projects".
+            attr_names: The names of the attributes to fetch and cache.
+            ref_attr_names: The names of the attributes referencing
+                other objects, which IDs are fetched and cached in the
+                "<name>_id" attributes.  Defaults to no attributes.
+
+        Returns:
+            The list of cached or newly created caching proxy objects,
+            in the order of the collection.
+        """
+        raw_objs_ref = getattr(self.app.default_document, elements_name)
+        raw_objs = self._get(raw_objs_ref, elements_name)
+        obj_ids = self._get(raw_objs_ref.id, elements_name + '.id')
+        columns = [self._get(getattr(raw_objs_ref, name),
+                             '%s.%s' % (elements_name, name))
+                   for name in attr_names]
+        attr_names = list(attr_names)
+        for name in ref_attr_names:
+            columns.append(self._get(getattr(raw_objs_ref, name).id,
+                                     '%s.%s.id' % (elements_name, name)))
+            attr_names.append(name + '_id')
+        if any(len(column) != len(raw_objs)
+               for column in [obj_ids] + columns):
+            # The collection was modified between two Apple Events.
+            # Fall back to reading attributes object by object.
+            LOG.warning('collection modified while taking a snapshot, '
+                        'falling back to lazy reads')
+            return [self._proxy_object(raw_obj) for raw_obj in raw_objs]
+        proxies = []
+        for i, obj_id in enumerate(obj_ids):
+            proxy = self.obj_cache.get_or_create(
+                obj_id, lambda: self._new_proxy(raw_objs[i]))
+            proxy._cache_attr_value('id', obj_id)
+            for name, column in zip(attr_names, columns):
+                proxy._cache_attr_value(name, column[i])
+            proxies.append(proxy)
+        return proxies
+
+    def _get_hierarchy(self, elements_name):
+        """Get the names and parents of a collection of objects in bulk.
+
+        Args:
+            elements_name: The name of the collection of objects in
+                the default document, e.g. "flattened_contexts".
+
+        Returns:
+            A dict which keys are object IDs and values are tuples
+            (name, parent_id).
+        """
+        raw_objs_ref = getattr(self.app.default_document, elements_name)
+        obj_ids = self._get(raw_objs_ref.id, elements_name + '.id')
+        names = self._get(raw_objs_ref.name, elements_name + '.name')
+        parent_ids = self._get(raw_objs_ref.container.id,
+                               elements_name + '.container.id')
+        return dict(zip(obj_ids, zip(names, parent_ids)))
+
+    def get_hierarchy_index(self):
+        """Get an index of the hierarchies of all contexts and folders.
+
+        The index is built with a constant number of Apple Events,
+        regardless of the number of contexts and folders.
+
+        Returns:
+            A HierarchyIndex object.
+        """
+        return HierarchyIndex(self._get_hierarchy('flattened_contexts'),
+                              self._get_hierarchy('flattened_folders'))
+
+    def snapshot_projects(self, attr_names=PROJECT_SNAPSHOT_ATTRS,
+                          index=None):
+        """Take an in-memory snapshot of all projects.
+
+        Each attribute is fetched for all projects with a single Apple
+        Event.  Attributes not in the snapshot are still read lazily
+        from OmniFocus when accessed.
+
+        The IDs of the objects referenced by the attributes in
+        PROJECT_SNAPSHOT_REF_ATTRS are also fetched, e.g. context_id.
+        If a hierarchy index is given, the full_folder_name,
+        full_context_name, and all_full_context_names attributes are
+        resolved from the index.
+
+        Args:
+            attr_names: The names of the project attributes to
+                fetch.  Defaults to PROJECT_SNAPSHOT_ATTRS.
+            index: The HierarchyIndex to resolve full names from.
+                Defaults to None, i.e. full names are computed lazily
+                by walking up the hierarchies.
+
+        Returns:
+            An OrderedDict which keys are project IDs and values are
+            project objects, in the order of OmniFocus's projects.
+        """
+        projects = self._snapshot_objects(
+            'flattened_projects', attr_names, PROJECT_SNAPSHOT_REF_ATTRS)
+        if index is not None:
+            for project in projects:
+                project._cache_attr_value(
+                    'full_folder_name',
+                    index.get_full_folder_name(project.container_id))
+                self._cache_context_names(project, index)
+        return collections.OrderedDict(
+            [(project.id, project) for project in projects])
+
+    @staticmethod
+    def _cache_context_names(obj, index):
+        """Resolve and cache the full context names of an object.
+
+        Args:
+            obj: The project or task proxy object, which context_id
+                attribute is cached.
+            index: The HierarchyIndex to resolve full names from.
+        """
+        obj._cache_attr_value(
+            'full_context_name', index.get_full_context_name(obj.context_id))
+        obj._cache_attr_value(
+            'all_full_context_names',
+            index.get_all_full_context_names(obj.context_id))
+
+    def take_snapshot(self):
+        """Take an in-memory snapshot of all projects and tasks.
+
+        A new pass is started, so that all the values are read again
+        from OmniFocus.  The full names of contexts and folders are
+        resolved from a hierarchy index.
+
+        Returns:
+            An OmniFocusSnapshot object.
+        """
+        self.begin_pass()
+        index = self.get_hierarchy_index()
+        return OmniFocusSnapshot(index,
+                                 self.snapshot_projects(index=index),
+                                 self.get_tasks_by_project(index=index))
+
+    def get_tasks_by_project(self, index=None):
+        """Get the tasks of all projects, grouped by project.
+
+        Only the tasks directly contained in the projects' root tasks
+        are returned, i.e. not sub-tasks.  The attributes in
+        TASK_SNAPSHOT_ATTRS are fetched for all tasks at once, as well
+        as the IDs of the objects referenced by the attributes in
+        TASK_SNAPSHOT_REF_ATTRS, e.g. context_id.
+
+        Args:
+            index: The HierarchyIndex to resolve the full_context_name
+                and all_full_context_names attributes of tasks from.
+                Defaults to None, i.e. full names are computed lazily
+                by walking up the hierarchies.
+
+        Returns:
+            A dict which keys are project IDs and values are the
+            lists of task objects in each project, in the order of the
+            tasks in OmniFocus.
+        """
+        doc = self.app.default_document
+        root_task_project_ids = dict(zip(
+            self._get(doc.flattened_projects.root_task.id,
+                      'flattened_projects.root_task.id'),
+            self._get(doc.flattened_projects.id, 'flattened_projects.id')))
+        tasks = self._snapshot_objects('flattened_tasks',
+                                       TASK_SNAPSHOT_ATTRS,
+                                       TASK_SNAPSHOT_REF_ATTRS)
+        project_tasks = collections.defaultdict(list)
+        for task in tasks:
+            if task.id in root_task_project_ids:
+                continue  # A project's root task.
+            if index is not None:
+                self._cache_context_names(task, index)
+            if task.parent_task_id is not None:
+                project_id = root_task_project_ids.get(task.parent_task_id)
+            else:
+                project_id = task.containing_project_id
+            if project_id is not None:
+                project_tasks[project_id].append(task)
+        return dict(project_tasks)
 
     def get_project_by_id(self, project_id):
         """Get a single project given its ID.
@@ -213,27 +891,38 @@ class OmniFocusDataAccess(object):
         except appscript.reference.CommandError, e:
             return None  # Not found.
 
-    def get_projects(self, selector):
+    def get_projects(self, selector, snapshot_attrs=PROJECT_SNAPSHOT_ATTRS,
+                     index=None):
         """Get all projects.
 
         Args:
             selector: A callable taking a project object, and returns
                 True or False whether the project must be selected or
                 not.
+            snapshot_attrs: The names of the project attributes to
+                fetch in bulk for all projects, before calling the
+                selector.  Defaults to PROJECT_SNAPSHOT_ATTRS.  If
+                None or empty, all attributes are read lazily, project
+                by project.
+            index: The HierarchyIndex to resolve full names of
+                projects from, if snapshot_attrs is set.  Defaults to
+                None, i.e. full names are computed lazily.
 
         Returns:
             A dict which keys are project IDs and values are tuples
             (index, project) where index reflect the relative order of
             projects in the results, and project is a project object.
         """
-        raw_projects = self.app.default_document.flattened_projects.get()
-        projects = [self._proxy_object(project) for project in raw_projects]
-        selected_projects = [project for project in projects
-                             if selector(project)]
-        indexed_projects = zip(xrange(0, len(selected_projects)),
-                               selected_projects)
-        return dict([(index_project[1].id, index_project)
-                     for index_project in indexed_projects])
+        if snapshot_attrs:
+            projects = self.snapshot_projects(snapshot_attrs,
+                                              index=index).values()
+        else:
+            raw_projects = self._get(
+                self.app.default_document.flattened_projects,
+                'flattened_projects')
+            projects = [self._proxy_object(project)
+                        for project in raw_projects]
+        return _index_projects(projects, selector)
 
     def get_next_tasks(self, selector):
         """Get all next tasks.
@@ -248,14 +937,14 @@ class OmniFocusDataAccess(object):
             (index, task) where index reflect the relative order of
             tasks in the results, and task is a next-action task object.
         """
-        raw_tasks = self.app.default_document.flattened_tasks[
+        raw_tasks = self._get(self.app.default_document.flattened_tasks[
             (appscript.its.blocked == False).AND
             (appscript.its.completed == False).AND
             (appscript.its.containing_project.status == appscript.k.active).AND
             ((appscript.its.containing_project.next_task ==
               appscript.k.missing_value).OR
              (appscript.its.containing_project.next_task == appscript.its))
-            ].get()
+            ], 'flattened_tasks[next]')
         next_tasks = [self._proxy_object(task) for task in raw_tasks]
         selected_tasks = [task for task in next_tasks if selector(task)]
         indexed_tasks = zip(xrange(0, len(selected_tasks)), selected_tasks)
@@ -269,8 +958,9 @@ class OmniFocusDataAccess(object):
             project: The project to mark as completed, as a project
                 object.
         """
-        if not project.completed:
-            project.completed = True
+        with self._write_lock:
+            if not project.completed:
+                project.completed = True
 
     def set_project_active(self, project):
         """Set a project as active.
@@ -279,8 +969,9 @@ class OmniFocusDataAccess(object):
             project: The project to mark as active, as a project
                 object.
         """
-        if project.status != appscript.k.active:
-            project.status = appscript.k.active
+        with self._write_lock:
+            if project.status != STATUS_ACTIVE:
+                project.status = STATUS_ACTIVE
 
     def set_task_completed(self, task):
         """Set a task as completed.
@@ -288,5 +979,334 @@ class OmniFocusDataAccess(object):
         Args:
             task: The task to mark as completed, as a task object.
         """
-        if not task.completed:
-            task.completed = True
+        with self._write_lock:
+            if not task.completed:
+                task.completed = True
+
+    def set_objects_attr(self, elements_name, obj_ids, name, value):
+        """Sets an attribute of several objects with a single Apple Event.
+
+        The objects are selected with a "whose" filter on their IDs.
+        The values cached in their proxy objects, if any, are updated.
+
+        Args:
+            elements_name: The name of the elements of the objects,
+                e.g. "flattened_tasks".
+            obj_ids: The list of the IDs of the objects.
+            name: The name of the attribute to set, e.g. "completed".
+            value: The value to set.
+
+        Returns:
+            True if the attribute was set, False if there is no
+            OmniFocus application to write into.
+        """
+        elements = getattr(self.app.default_document, elements_name)
+        ref = getattr(elements[appscript.its.id.isin(list(obj_ids))], name)
+        with self._write_lock:
+            start_time = time.time()
+            ref.set(value)
+            if self.profiler is not None:
+                self.profiler.record_apple_event(
+                    'set', '%s.%s' % (elements_name, name),
+                    time.time() - start_time)
+        for obj_id in obj_ids:
+            proxy = self.obj_cache.get(obj_id)
+            if proxy is not None:
+                proxy._cache_attr_value(name, value)
+        return True
+
+
+class OmniFocusSnapshotDataAccess(OmniFocusDataAccess):
+    """Reads all OmniFocus projects and tasks at once, into snapshots.
+
+    This is the base class of the DAOs that read OmniFocus otherwise
+    than by navigating its objects with Apple Events, e.g. from an
+    export.  Projects and tasks are read-only Project and Task objects.
+    Writes are sent with Apple Events to the OmniFocus application, if
+    any.  Subclasses must implement _read_snapshot.
+    """
+
+    def __init__(self, app=None, profiler=None):
+        """Initialize this DAO.
+
+        Args:
+            app: The appscript app object to use to write into
+                OmniFocus.  Defaults to None, i.e. OmniFocus can't be
+                written into.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+        """
+        OmniFocusDataAccess.__init__(self, app, profiler=profiler)
+        self._lock = threading.Lock()
+        # The last snapshot read, and whether it must be read again.
+        self._snapshot = None
+        self._tasks_by_id = None
+        self._stale = True
+
+    def _read_snapshot(self, snapshot):
+        """Reads a snapshot of all OmniFocus projects and tasks.
+
+        Args:
+            snapshot: The OmniFocusSnapshot read previously, or None.
+
+        Returns:
+            The new OmniFocusSnapshot object, or the previous one if
+            OmniFocus was not modified since it was read.
+        """
+        raise NotImplementedError()
+
+    def _get_snapshot(self):
+        """Gets the snapshot of the current pass, reading it if needed.
+
+        Returns:
+            An OmniFocusSnapshot object.
+        """
+        with self._lock:
+            if self._stale:
+                snapshot = self._read_snapshot(self._snapshot)
+                if snapshot is not self._snapshot:
+                    self._snapshot = snapshot
+                    self._tasks_by_id = dict(
+                        [(task.id, task)
+                         for tasks in snapshot.project_tasks.itervalues()
+                         for task in tasks])
+                self._stale = False
+            return self._snapshot
+
+    def begin_pass(self):
+        """Starts a new pass of reads from OmniFocus.
+
+        A new snapshot is read at the next read.
+        """
+        with self._lock:
+            self._stale = True
+        OmniFocusDataAccess.begin_pass(self)
+
+    def take_snapshot(self):
+        self.begin_pass()
+        return self._get_snapshot()
+
+    def get_hierarchy_index(self):
+        return self._get_snapshot().index
+
+    def snapshot_projects(self, attr_names=None, index=None):
+        return self._get_snapshot().projects
+
+    def get_tasks_by_project(self, index=None):
+        return self._get_snapshot().project_tasks
+
+    def get_projects(self, selector, snapshot_attrs=None, index=None):
+        return self._get_snapshot().select_projects(selector)
+
+    def get_project_by_id(self, project_id):
+        return self._get_snapshot().projects.get(project_id)
+
+    def get_task_by_id(self, task_id):
+        self._get_snapshot()
+        return self._tasks_by_id.get(task_id)
+
+    def _get_app_object(self, get_by_id, obj_id):
+        """Gets the proxy object of an object in the OmniFocus application.
+
+        Args:
+            get_by_id: The unbound OmniFocusDataAccess method to get
+                the object by ID with Apple Events.
+            obj_id: The ID of the object.
+
+        Returns:
+            The proxy object, or None if not found or if there is no
+            OmniFocus application to write into.
+        """
+        if self.app is None:
+            LOG.warning('OmniFocus is not running, not writing object %s',
+                        obj_id)
+            return None
+        proxy = get_by_id(self, obj_id)
+        if proxy is None:
+            LOG.warning('object %s not found in OmniFocus', obj_id)
+        return proxy
+
+    def set_project_completed(self, project):
+        if project.completed:
+            return
+        proxy = self._get_app_object(OmniFocusDataAccess.get_project_by_id,
+                                     project.id)
+        if proxy is not None:
+            OmniFocusDataAccess.set_project_completed(self, proxy)
+
+    def set_project_active(self, project):
+        if project.status == STATUS_ACTIVE:
+            return
+        proxy = self._get_app_object(OmniFocusDataAccess.get_project_by_id,
+                                     project.id)
+        if proxy is not None:
+            OmniFocusDataAccess.set_project_active(self, proxy)
+
+    def set_task_completed(self, task):
+        if task.completed:
+            return
+        proxy = self._get_app_object(OmniFocusDataAccess.get_task_by_id,
+                                     task.id)
+        if proxy is not None:
+            OmniFocusDataAccess.set_task_completed(self, proxy)
+
+    def set_objects_attr(self, elements_name, obj_ids, name, value):
+        if self.app is None:
+            LOG.warning('OmniFocus is not running, not setting %s of %i '
+                        'objects', name, len(obj_ids))
+            return False
+        return OmniFocusDataAccess.set_objects_attr(
+            self, elements_name, obj_ids, name, value)
+
+
+class AppliedWrite(collections.namedtuple('AppliedWrite', (
+            'elements_name', 'name', 'value', 'obj_ids'))):
+    """A value written into an attribute of several OmniFocus objects.
+
+    The elements_name is the name of the elements of the objects, e.g.
+    "flattened_tasks", name is the name of the attribute, and obj_ids
+    is the list of the IDs of the objects.
+    """
+
+
+class WriteQueue(object):
+    """Collects writes into OmniFocus, to apply them all at once.
+
+    The writes are applied when the queue is flushed, e.g. at the end
+    of a synchronization, rather than interleaved with other I/O.  The
+    writes of a same value into a same attribute of objects of a same
+    kind are applied with a single Apple Event, and the writes of the
+    values that objects already have are skipped.  Writes may be added
+    concurrently.
+    """
+
+    def __init__(self, omnifocus_dao):
+        """Initialize this queue to write with the given DAO.
+
+        Args:
+            omnifocus_dao: The OmniFocusDataAccess object to use to
+                write into OmniFocus.
+        """
+        self.of_dao = omnifocus_dao
+        self._lock = threading.Lock()
+        # The keys of the queued writes, by object ID, in order, by
+        # tuple (elements_name, name, value).
+        self._writes = collections.OrderedDict()
+
+    def _add(self, elements_name, obj, name, value, key):
+        """Queues a write, unless the object already has the value.
+
+        Returns:
+            True if the write was queued, False if it is a no-op.
+        """
+        if getattr(obj, name) == value:
+            return False
+        with self._lock:
+            obj_keys = self._writes.get((elements_name, name, value))
+            if obj_keys is None:
+                obj_keys = collections.OrderedDict()
+                self._writes[(elements_name, name, value)] = obj_keys
+            obj_keys[obj.id] = key
+        return True
+
+    def set_project_active(self, project, key=None):
+        """Queues setting a project as active.
+
+        Args:
+            project: The project object.
+            key: The key to report failures under, e.g. a story ID.
+                Defaults to None.
+
+        Returns:
+            True if the write was queued, False if it is a no-op.
+        """
+        return self._add('flattened_projects', project, 'status',
+                         STATUS_ACTIVE, key)
+
+    def set_project_completed(self, project, key=None):
+        """Queues setting a project as completed.
+
+        Args:
+            project: The project object.
+            key: The key to report failures under, e.g. a story ID.
+                Defaults to None.
+
+        Returns:
+            True if the write was queued, False if it is a no-op.
+        """
+        return self._add('flattened_projects', project, 'completed', True,
+                         key)
+
+    def set_task_completed(self, task, key=None):
+        """Queues setting a task as completed.
+
+        Args:
+            task: The task object.
+            key: The key to report failures under, e.g. a story ID.
+                Defaults to None.
+
+        Returns:
+            True if the write was queued, False if it is a no-op.
+        """
+        return self._add('flattened_tasks', task, 'completed', True, key)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(obj_keys) for obj_keys in self._writes.itervalues())
+
+    def flush(self):
+        """Applies all the queued writes, and empties this queue.
+
+        If the writes of a value into several objects fail, they are
+        applied again object by object, so that only the writes that
+        actually fail are reported as failed.  The writes skipped
+        because there is no OmniFocus application to write into are
+        reported as failed too, so that they are planned again.
+
+        Returns:
+            A tuple (applied, failures), where applied is the list of
+            the AppliedWrite objects of the applied writes, in the
+            order they were first queued, and failures is a dict
+            which keys are the keys of the failed writes and values
+            are the exceptions they raised.
+        """
+        with self._lock:
+            writes = self._writes
+            self._writes = collections.OrderedDict()
+        applied = []
+        failures = {}
+        for (elements_name, name, value), obj_keys in writes.iteritems():
+            obj_ids = list(obj_keys)
+            try:
+                if self.of_dao.set_objects_attr(elements_name, obj_ids,
+                                                name, value):
+                    applied.append(AppliedWrite(elements_name, name, value,
+                                                obj_ids))
+                else:
+                    e = IOError('OmniFocus is not running')
+                    for key in obj_keys.itervalues():
+                        failures[key] = e
+                continue
+            except Exception, e:
+                if len(obj_ids) == 1:
+                    LOG.exception('failed to set %s of %s', name, obj_ids[0])
+                    failures[obj_keys[obj_ids[0]]] = e
+                    continue
+                LOG.warning('failed to set %s of %i objects, setting them '
+                            'one by one: %s', name, len(obj_ids), e)
+            applied_ids = []
+            for obj_id in obj_ids:
+                try:
+                    if self.of_dao.set_objects_attr(elements_name, [obj_id],
+                                                    name, value):
+                        applied_ids.append(obj_id)
+                    else:
+                        failures[obj_keys[obj_id]] = IOError(
+                            'OmniFocus is not running')
+                except Exception, e:
+                    LOG.exception('failed to set %s of %s', name, obj_id)
+                    failures[obj_keys[obj_id]] = e
+            if applied_ids:
+                applied.append(AppliedWrite(elements_name, name, value,
+                                            applied_ids))
+        return applied, failures
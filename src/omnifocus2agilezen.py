@@ -18,14 +18,34 @@
 
 
 import argparse
+import collections
+import contextlib
+import cProfile
 import datetime
+import hashlib
+import json
 import logging
 import os
+import signal
+import sys
+import threading
 
-import appscript
+try:
+    import appscript
+except ImportError:
+    appscript = None
 
 import agilezen
+import boards
+import httpcache
 import omnifocus
+import omnifocusbundle
+import omnifocusfile
+import omnifocusscript
+import pipeline
+import profiling
+import syncplan
+import syncstate
 
 
 AGILEZEN_API_BASE_URL = 'https://agilezen.com/api/v1/'
@@ -34,15 +54,72 @@ STORY_DUE_DATE_FORMAT = '%a %b %d %I:%M%p %Y'
 TASK_DATE_FORMAT = '%a %b %d %I:%M%p %Y'
 DUE_SOON_DAYS = 3
 
+# The number of days during which unused tags are kept, so that the
+# tags of temporarily unused contexts are not deleted and recreated.
+TAG_GRACE_PERIOD_DAYS = 7
+
+# The modes of synchronization of the stories in the archive phase:
+# like all other stories, or listed with their details and tags only,
+# to complete their OmniFocus projects.
+ARCHIVE_FULL = 'full'
+ARCHIVE_LIGHT = 'light'
+ARCHIVE_MODES = (ARCHIVE_FULL, ARCHIVE_LIGHT)
+
+# The name of the project value recording the time at which the
+# stories in the archive phase were last listed.
+ARCHIVE_LISTING_TIME = 'archive_listing_time'
+
+# The maximum number of AgileZen stories listed in advance, while
+# OmniFocus is read or while the previous stories are synchronized.
+STORY_BUFFER_SIZE = 2000
+
+# The commands of the main program: synchronize OmniFocus with
+# AgileZen, or write a snapshot of OmniFocus to synchronize later.
+COMMAND_SYNC = 'sync'
+COMMAND_SNAPSHOT = 'snapshot'
+COMMANDS = (COMMAND_SYNC, COMMAND_SNAPSHOT)
+
 LOG = logging.getLogger('omnifocus2agilezen')
 
 
+class ProjectSnapshot(collections.namedtuple('ProjectSnapshot', (
+            'text', 'details', 'color', 'tags', 'tag_names', 'tasks',
+            'of_tasks_by_name'))):
+    """The rendering of an OmniFocus project as an AgileZen story.
+
+    A snapshot is computed once per project and per pass, and the
+    project's story is compared against it.  The tags are the set of
+    Tag objects of the story, and tag_names the frozenset of their
+    names.  The tasks are the de-duplicated list of Task objects of
+    the story, in order, and of_tasks_by_name is the dict of the
+    OmniFocus tasks by AgileZen task text.
+    """
+
+    def fingerprint(self):
+        """Computes a fingerprint of the rendering of the project.
+
+        Returns:
+            The fingerprint, as a hexadecimal string.
+        """
+        contents = [
+            self.text,
+            self.details,
+            self.color,
+            sorted(self.tag_names),
+            [(task.text, bool(task.status)) for task in self.tasks],
+            ]
+        return hashlib.sha1(json.dumps(contents)).hexdigest()
+
+
 class OmniFocusToAgileZenSync(object):
     """A synchronizer between OmniFocus and AgileZen.
     """
 
     def __init__(self, omnifocus_dao, agilezen_dao,
-                 due_soon_days=DUE_SOON_DAYS):
+                 due_soon_days=DUE_SOON_DAYS, state_store=None,
+                 profiler=None, archive_mode=ARCHIVE_FULL,
+                 archive_interval=0,
+                 tag_grace_period_days=TAG_GRACE_PERIOD_DAYS):
         """Initialize this synchronizer with the OF and AZ DAOs.
 
         Args:
@@ -53,9 +130,38 @@ class OmniFocusToAgileZenSync(object):
             due_soon_days: The number of days in the future that is
                 the limit deadline for due dates to become "due soon".
                 Defaults to 3.
+            state_store: The SyncStateStore object to use to skip
+                unmodified projects, and to record the states of
+                synchronized projects.  Defaults to None, i.e. all
+                projects are synchronized.
+            profiler: The profiling.Profiler to time the stages of
+                synchronizations, and to attribute their costs to
+                stories.  Defaults to None, i.e. no profiling.
+            archive_mode: ARCHIVE_FULL to synchronize the stories in
+                the archive phase like all other stories, or
+                ARCHIVE_LIGHT to list them without their tasks and
+                only complete their OmniFocus projects.  Defaults to
+                ARCHIVE_FULL.
+            archive_interval: The minimum number of seconds between
+                two listings of the stories in the archive phase.  In
+                between, the stories last seen in the archive phase
+                are assumed to still be there.  Requires a state
+                store.  Defaults to 0, i.e. they are listed at every
+                sync.
+            tag_grace_period_days: The number of days during which
+                unused tags are kept before being deleted, if a state
+                store is used to register tags.  Defaults to 7.
         """
         self.of_dao = omnifocus_dao
         self.az_dao = agilezen_dao
+        self.state_store = state_store
+        self.profiler = profiler
+        self.archive_mode = archive_mode
+        self.archive_interval = datetime.timedelta(seconds=archive_interval)
+        self.tag_grace_period = datetime.timedelta(days=tag_grace_period_days)
+        # The cached (project, phases, all_phases) tuples of AgileZen
+        # projects, by project ID.
+        self._az_projects = {}
         self.due_soon_delta = datetime.timedelta(days=3)
 
     @classmethod
@@ -111,18 +217,18 @@ class OmniFocusToAgileZenSync(object):
                                          of_project.id)
 
     @classmethod
-    def _get_az_tags_for_project(cls, of_project):
-        """Gets the AgileZen tags matching the contexts of an OmniFocus project.
+    def _get_az_tags_for_tasks(cls, of_tasks):
+        """Gets the AgileZen tags matching the contexts of OmniFocus tasks.
 
         Args:
-            of_project: The OmniFocus project to get tags from.
+            of_tasks: The OmniFocus tasks of a project to get tags from.
 
         Returns:
             The set of AgileZen tags corresponding the contexts of the
-            actions of the OmniFocus project.
+            OmniFocus tasks.
         """
         tag_names = set()
-        for task in of_project.root_task.tasks:
+        for task in of_tasks:
             all_full_context_names = task.all_full_context_names
             if all_full_context_names:
                 tag_names.update([n.strip(' ').lower()
@@ -162,7 +268,7 @@ class OmniFocusToAgileZenSync(object):
             The new phase of the AgileZen story for the given
             OmniFocus project.
         """
-        if of_project.status == appscript.k.on_hold:
+        if of_project.status == omnifocus.STATUS_ON_HOLD:
             if current_az_phase.id == az_phases.ready.id:
                 return current_az_phase
             else:
@@ -205,44 +311,1068 @@ class OmniFocusToAgileZenSync(object):
         # TODO: Also append the context?
         return name
 
-    @classmethod
-    def _get_az_tasks_for_project(cls, of_project):
+    @staticmethod
+    def _get_az_tasks_for_tasks(of_named_tasks):
         """Gets a list of AgileZen tasks from an OmniFocus project's tasks.
 
         Tasks are de-duplicated: only the first task in an OmniFocus
         project is kept, the subsequenct tasks are ignored.
 
         Args:
-            of_project: The OmniFocus project to get tasks from.
+            of_named_tasks: The list of tuples (task_name, of_task) of
+                the OmniFocus tasks of a project, in order, with
+                their AgileZen task names.
 
         Returns:
             The list of Task objects corresponding to the OmniFocus
             project's non-completed tasks, each with a unique text.
         """
         # Task text is plain text, not Markdown, so we can't hide any
-        # OmniFocus task ID in there.  We rely on text comparisons to
-        # synchronize tasks.  So first remove any duplicate tasks
-        # texts.  To reduce the risk of collision, and to support
-        # repeated tasks properly, the start and due dates are
-        # appended to the task's name.
-        task_names_dups = [
-            (cls._get_az_task_name(of_task), of_task.completed)
-            for of_task in of_project.root_task.tasks]
+        # OmniFocus task ID in there.  Tasks are matched by the IDs
+        # recorded in the state store, and otherwise by text.  So
+        # first remove any duplicate tasks texts.  To reduce the risk
+        # of collision, and to support repeated tasks properly, the
+        # start and due dates are appended to the task's name.
         task_names_set = set()
         tasks = []
-        for task_name, task_completed in task_names_dups:
+        for task_name, of_task in of_named_tasks:
             if task_name not in task_names_set:
                 task_names_set.add(task_name)
                 tasks.append(agilezen.Task(None, task_name, None, None, None,
-                                           task_completed))
+                                           of_task.completed))
         return tasks
 
+    def _snapshot_project(self, of_project, of_tasks, of_color_picker):
+        """Renders an OmniFocus project as an AgileZen story, once.
+
+        Args:
+            of_project: The OmniFocus project.
+            of_tasks: The OmniFocus tasks of the project, in order.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of its story.
+
+        Returns:
+            The ProjectSnapshot of the project.
+        """
+        of_named_tasks = [(self._get_az_task_name(of_task), of_task)
+                          for of_task in of_tasks]
+        tags = self._get_az_tags_for_tasks(of_tasks)
+        return ProjectSnapshot(
+            self._get_az_story_text_for_project(of_project),
+            self._get_az_story_details_for_project(of_project),
+            of_color_picker(of_project),
+            tags,
+            frozenset([tag.name for tag in tags]),
+            self._get_az_tasks_for_tasks(of_named_tasks),
+            # Keep the first of the tasks with the same name, like
+            # _get_az_tasks_for_tasks.
+            dict(reversed(of_named_tasks)))
+
+    def _get_az_project(self, az_project_id, refresh=False):
+        """Gets an AgileZen project and its key phases.
+
+        The project and phases are cached, since they are rarely
+        modified.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            refresh: If True, get the project and phases from
+                AgileZen even if they are cached, here or in the
+                AgileZen DAO's response cache.  Defaults to False.
+
+        Returns:
+            A tuple (project, phases, all_phases) of the Project
+            object, the ProjectPhases object of its key phases, and
+            the list of all its Phase objects.
+        """
+        az_project_phases = self._az_projects.get(az_project_id)
+        if az_project_phases is None or refresh:
+            try:
+                az_project = self.az_dao.get_project(az_project_id,
+                                                     revalidate=refresh)
+            except Exception:
+                LOG.error('project ID %i not found', az_project_id)
+                raise ValueError('project ID %i not found' % (az_project_id,))
+            az_all_phases = list(
+                self.az_dao.iter_project_phases(az_project.id,
+                                                revalidate=refresh))
+            az_phases = agilezen.ProjectPhases.parse_phases(az_all_phases)
+            az_project_phases = (az_project, az_phases, az_all_phases)
+            self._az_projects[az_project_id] = az_project_phases
+        return az_project_phases
+
+    @staticmethod
+    def _get_of_modification_date(of_project, of_tasks):
+        """Gets the latest modification date of a project and its tasks.
+
+        Args:
+            of_project: The OmniFocus project.
+            of_tasks: The OmniFocus tasks of the project.
+
+        Returns:
+            The latest modification date as an ISO 8601 string, or
+            None if unknown.
+        """
+        dates = [obj.modification_date for obj in [of_project] + of_tasks
+                 if obj.modification_date is not None]
+        return max(dates).isoformat() if dates else None
+
+    def _get_expiration_date(self, of_project, now):
+        """Gets the date at which a project's story text will change.
+
+        A story's text changes without the project being modified
+        when the project becomes due soon.
+
+        Args:
+            of_project: The OmniFocus project.
+            now: The current datetime.
+
+        Returns:
+            The date at which the project becomes due soon as an ISO
+            8601 string, or None if it is already due soon or has no
+            due date.
+        """
+        due_date = of_project.due_date
+        if due_date is None or due_date - self.due_soon_delta <= now:
+            return None
+        return (due_date - self.due_soon_delta).isoformat()
+
+    @staticmethod
+    def _is_az_story_clean(az_story, state, of_modification_date,
+                           snapshot_fingerprint, owner, now):
+        """Checks whether a story is unmodified since its last sync.
+
+        Args:
+            az_story: The AgileZen story, with its tags and tasks.
+            state: The ProjectState of the story's OmniFocus project
+                at the last sync, or None.
+            of_modification_date: The latest modification date of the
+                OmniFocus project and of its tasks.
+            snapshot_fingerprint: The fingerprint of the
+                ProjectSnapshot of the OmniFocus project.
+            owner: The User to assign to the story, or None.
+            now: The current datetime.
+
+        Returns:
+            True if neither the OmniFocus project, its rendering, nor
+            the AgileZen story were modified, and the story's text
+            doesn't need to be updated, False otherwise.
+        """
+        return (state is not None
+                and state.az_story_id == az_story.id
+                and state.modification_date == of_modification_date
+                and state.snapshot_fingerprint == snapshot_fingerprint
+                and state.phase_id == az_story.phase.id
+                and (state.expiration_date is None
+                     or now.isoformat() < state.expiration_date)
+                and state.fingerprint == syncstate.fingerprint_story(
+                    az_story, with_owner=owner is not None))
+
+    @staticmethod
+    def _match_az_tasks(az_tasks_cur, az_tasks_new, of_task_ids,
+                        az_task_ids):
+        """Matches the desired tasks of a story with its current tasks.
+
+        Tasks are matched by the recorded IDs of the AgileZen tasks of
+        their OmniFocus tasks first, so that the tasks which text
+        changed are updated instead of being deleted and recreated.
+        The remaining tasks are matched by text.
+
+        Args:
+            az_tasks_cur: The current list of tasks in the story.
+            az_tasks_new: The desired list of tasks in the story.
+            of_task_ids: The list of the IDs of the OmniFocus tasks of
+                the tasks in az_tasks_new, in the same order.
+            az_task_ids: The dict of the recorded IDs of AgileZen
+                tasks, by OmniFocus task ID.
+
+        Returns:
+            The list of the current Task objects matching the tasks
+            in az_tasks_new, in the same order, with None for the
+            tasks to create.
+        """
+        az_tasks_cur_by_id = dict([(task.id, task) for task in az_tasks_cur])
+        az_tasks_matched = [
+            az_tasks_cur_by_id.pop(az_task_ids.get(of_task_id), None)
+            for of_task_id in of_task_ids]
+        # Fall back to matching the remaining tasks by text.
+        az_tasks_cur_by_text = dict([
+            (task.text, task) for task in az_tasks_cur
+            if task.id in az_tasks_cur_by_id])
+        return [az_task_cur if az_task_cur is not None
+                else az_tasks_cur_by_text.pop(az_task_new.text, None)
+                for az_task_new, az_task_cur
+                in zip(az_tasks_new, az_tasks_matched)]
+
+    @staticmethod
+    def _plan_az_story_tasks(az_story, az_tasks_new, az_tasks_matched):
+        """Plans the updates of the tasks in an AgileZen story.
+
+        Tasks are deleted, created, updated, then reordered, so that
+        the story contains exactly the given list of tasks.
+
+        Args:
+            az_story: The AgileZen story, with its current tasks.
+            az_tasks_new: The desired list of tasks in the story.
+            az_tasks_matched: The list of the current tasks matching
+                the tasks in az_tasks_new, or None for new tasks, as
+                returned by _match_az_tasks.
+
+        Returns:
+            The list of operations to update the story's tasks.
+        """
+        ops = []
+
+        # First update the set of tasks, regardless of their order.
+        az_tasks_matched_ids = set([task.id for task in az_tasks_matched
+                                    if task is not None])
+        az_tasks_cur = []
+
+        # Delete tasks in AZ if they are deleted in OF.
+        for az_task in az_story.tasks:
+            if az_task.id in az_tasks_matched_ids:
+                az_tasks_cur.append(az_task.id)
+            else:
+                ops.append(syncplan.DeleteTask(az_story.id, az_task))
+        # Add new tasks.  Tasks newly created via the API in AgileZen
+        # are inserted first, so create them in the reverse order of
+        # the desired list to avoid reordering them afterwards.
+        for az_task_new, az_task_cur in reversed(zip(az_tasks_new,
+                                                     az_tasks_matched)):
+            if az_task_cur is None:
+                ops.append(syncplan.CreateTask(az_story.id, az_task_new))
+                az_tasks_cur.insert(0, az_task_new.text)
+
+        # Update the text of tasks if it changed in OF, and mark tasks
+        # as completed in AZ if they are completed in OF.  New tasks
+        # are created with their completion status.
+        for az_task_new, az_task_cur in zip(az_tasks_new, az_tasks_matched):
+            if az_task_cur is None:
+                continue
+            status = az_task_cur.status or az_task_new.status
+            if az_task_cur.text != az_task_new.text:
+                ops.append(syncplan.UpdateTask(
+                    az_story.id,
+                    az_task_cur._replace(text=az_task_new.text,
+                                         status=status)))
+            elif status and not az_task_cur.status:
+                ops.append(syncplan.CompleteTask(az_story.id, az_task_cur))
+
+        # Second, reorder tasks, unless they are already in order.
+        # Current tasks are identified by ID, and new tasks by text.
+        az_tasks_new_ord = [
+            az_task_cur.id if az_task_cur is not None else az_task_new.text
+            for az_task_new, az_task_cur in zip(az_tasks_new,
+                                                az_tasks_matched)]
+        if az_tasks_cur != az_tasks_new_ord:
+            # Use the IDs of previously created AZ Task objects, or
+            # None for tasks created above, following the order of
+            # Task objects in az_tasks_new.
+            ops.append(syncplan.ReorderTasks(
+                az_story.id,
+                [(az_task_cur.id if az_task_cur is not None else None,
+                  az_task_new.text)
+                 for az_task_new, az_task_cur in zip(az_tasks_new,
+                                                     az_tasks_matched)]))
+        return ops
+
+    def _plan_new_story(self, plan, of_project, of_tasks, of_color_picker,
+                        az_phases, owner, now):
+        """Plans the creation of the story of a new OmniFocus project.
+
+        Args:
+            plan: The SyncPlan to append operations to.
+            of_project: The OmniFocus project.
+            of_tasks: The OmniFocus tasks of the project.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of its story.
+            az_phases: The ProjectPhases of the AgileZen project.
+            owner: The User to assign to the story, or None.
+            now: The current datetime.
+
+        Returns:
+            The set of tags of the new story.
+        """
+        snapshot = self._snapshot_project(of_project, of_tasks,
+                                          of_color_picker)
+        az_story = agilezen.Story(
+            None,
+            snapshot.text,
+            snapshot.details,
+            None,
+            None,
+            snapshot.color,
+            self._get_az_story_phase_for_project(of_project, az_phases,
+                                                 az_phases.backlog),
+            None,
+            owner,
+            snapshot.tags,
+            snapshot.tasks)
+        plan.append(syncplan.CreateStory(of_project.id, az_story))
+        if self.state_store is not None:
+            plan.project_states.append((
+                set([of_project.id]), of_project.id,
+                syncstate.ProjectState(
+                    of_project.id, None,
+                    self._get_of_modification_date(of_project, of_tasks),
+                    syncstate.fingerprint_story(
+                        az_story, with_owner=owner is not None),
+                    az_story.phase.id,
+                    self._get_expiration_date(of_project, now),
+                    snapshot.fingerprint())))
+            plan.task_ids.append((
+                set([of_project.id]), of_project.id, None,
+                [(snapshot.of_tasks_by_name[task.text].id, None, task.text)
+                 for task in snapshot.tasks]))
+        return az_story.tags
+
+    def _plan_story_update(self, plan, az_story, of_project, of_tasks,
+                           of_color_picker, az_phases, owner, state, now):
+        """Plans the update of an existing story and of its OF project.
+
+        Args:
+            plan: The SyncPlan to append the story's operations to.
+            az_story: The AgileZen story, with its tags and tasks.
+            of_project: The OmniFocus project of the story.
+            of_tasks: The OmniFocus tasks of the project.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of its story.
+            az_phases: The ProjectPhases of the AgileZen project.
+            owner: The User to assign to the story, or None.
+            state: The ProjectState of the project at the last sync,
+                or None.
+            now: The current datetime.
+
+        Returns:
+            The set of tags of the story, once updated.
+        """
+        # Skip comparing the project if neither it, its rendering,
+        # e.g. after renaming its contexts or folders, nor its story
+        # were modified since the last sync.
+        snapshot = self._snapshot_project(of_project, of_tasks,
+                                          of_color_picker)
+        snapshot_fingerprint = snapshot.fingerprint()
+        of_modification_date = self._get_of_modification_date(of_project,
+                                                               of_tasks)
+        if self._is_az_story_clean(az_story, state, of_modification_date,
+                                   snapshot_fingerprint, owner, now):
+            return az_story.tags
+        ops = []
+
+        az_story_is_completed = az_story.phase.id in (
+            az_phases.done.id, az_phases.archive.id)
+        az_story_is_in_progress = az_story.phase.id not in (
+            az_phases.backlog.id, az_phases.ready.id,
+            az_phases.done.id, az_phases.archive.id)
+
+        # Update the OmniFocus project.  The only update that can be
+        # performed on an OmniFocus project is setting it as active or
+        # completed, in case the AgileZen task is in an active or
+        # completed phase.
+        # The philosophy is that a project / story can only progress
+        # forward, never backward, so always in the order: backlog ->
+        # ready -> ... -> done & archive.  Which ever of OmniFocus or
+        # AgileZen makes a project / story go forward has precedence
+        # on the other re: the status.
+        if (az_story_is_in_progress
+            and of_project.status == omnifocus.STATUS_ON_HOLD):
+            ops.append(syncplan.SetProjectActive(of_project.id,
+                                                 of_project.name))
+        elif az_story_is_completed and not of_project.completed:
+            ops.append(syncplan.SetProjectCompleted(of_project.id,
+                                                    of_project.name))
+
+        # Update the AgileZen story if either the AZ story or the OF
+        # project has been modified.  Such updates always flow from OF
+        # to AZ, never the other way round: OF is the golden standard.
+        # Ignore the current story's owner if the owner option is not
+        # set, i.e. owner is None.  If the project's status is being
+        # updated after the story's phase, keep the story's phase,
+        # since the project's status is only written once the plan is
+        # executed.
+        if ops:
+            updated_phase = az_story.phase
+        else:
+            updated_phase = self._get_az_story_phase_for_project(
+                of_project, az_phases, az_story.phase)
+        tags_changed = (set([tag.name for tag in az_story.tags])
+                        != snapshot.tag_names)
+        if (az_story.text != snapshot.text or
+            az_story.details != snapshot.details or
+            az_story.color != snapshot.color or
+            az_story.phase.id != updated_phase.id or
+            owner is not None and (
+                az_story.owner is None or
+                az_story.owner.userName != owner.userName)):
+            # Fold the update of the story's tags into the story's
+            # update.  Tasks are updated separately.
+            ops.append(syncplan.UpdateStory(
+                az_story._replace(
+                    text=snapshot.text,
+                    details=snapshot.details,
+                    color=snapshot.color,
+                    phase=updated_phase,
+                    owner=owner,
+                    tags=snapshot.tags,
+                    tasks=None)))
+        elif tags_changed:
+            ops.append(syncplan.SetStoryTags(az_story.id, snapshot.tags))
+
+        # Update the tasks in the AgileZen story if any AZ task or OF
+        # task has been added, deleted, or modified.  OF is the golden
+        # standard for tasks.  Task updates always flow from OF to AZ,
+        # never the other way round, except for completion status: if
+        # a task is marked as completed in either AZ or OF, it is then
+        # marked as completed in the other.  After sync, each AZ story
+        # only contains non-completed tasks, and completed tasks are
+        # deleted in AZ and marked as completed in OF.
+
+        # The current (completed or not) tasks in the AZ story, with
+        # AZ task IDs, etc., matching the tasks of the OF project.
+        of_task_ids = [snapshot.of_tasks_by_name[task.text].id
+                       for task in snapshot.tasks]
+        az_task_ids = {}
+        if self.state_store is not None:
+            az_task_ids = self.state_store.get_task_ids(plan.az_project_id,
+                                                        az_story.id)
+        az_tasks_matched = self._match_az_tasks(
+            az_story.tasks, snapshot.tasks, of_task_ids, az_task_ids)
+
+        # The list of AZ tasks reflecting the list of tasks in the OF
+        # project, both completed and non-completed.  This is the
+        # desired list of tasks in the AZ story.  If a story has been
+        # set as completed in AZ, set it also as completed in the
+        # target list.  The AZ story is updated to contain exactly
+        # this list.
+        az_tasks_new = [
+            task._replace(status=True)
+                if not task.status
+                    and az_task_cur is not None and az_task_cur.status
+                else task
+            for task, az_task_cur in zip(snapshot.tasks, az_tasks_matched)]
+
+        # Mark tasks as completed in OF if they are completed in AZ.
+        for az_task_new, az_task_cur in zip(az_tasks_new, az_tasks_matched):
+            if az_task_cur is not None and az_task_cur.status:
+                of_task = snapshot.of_tasks_by_name.get(az_task_new.text)
+                if of_task is not None and not of_task.completed:
+                    ops.append(syncplan.SetTaskCompleted(of_task.id,
+                                                         of_task.name))
+
+        ops.extend(self._plan_az_story_tasks(az_story, az_tasks_new,
+                                             az_tasks_matched))
+        plan.extend(ops)
+
+        if self.state_store is not None:
+            # The state of the project, once the story is updated.
+            updated_story = az_story._replace(
+                text=snapshot.text,
+                details=snapshot.details,
+                color=snapshot.color,
+                phase=updated_phase,
+                owner=owner,
+                tags=snapshot.tags,
+                tasks=az_tasks_new)
+            plan.project_states.append((
+                set([az_story.id]).union([op.key for op in ops]),
+                of_project.id,
+                syncstate.ProjectState(
+                    of_project.id, az_story.id, of_modification_date,
+                    syncstate.fingerprint_story(
+                        updated_story, with_owner=owner is not None),
+                    updated_phase.id,
+                    self._get_expiration_date(of_project, now),
+                    snapshot_fingerprint)))
+            plan.task_ids.append((
+                set([az_story.id]).union([op.key for op in ops]),
+                of_project.id, az_story.id,
+                [(of_task_id,
+                  az_task_cur.id if az_task_cur is not None else None,
+                  az_task_new.text)
+                 for of_task_id, az_task_new, az_task_cur
+                 in zip(of_task_ids, az_tasks_new, az_tasks_matched)]))
+        return snapshot.tags
+
+    def _plan_archived_story(self, plan, az_story, of_project, state):
+        """Plans the completion of the OF project of an archived story.
+
+        The story itself is not updated, and its tasks are not read.
+
+        Args:
+            plan: The SyncPlan to append the story's operations to.
+            az_story: The AgileZen story in the archive phase, with
+                its tags.
+            of_project: The OmniFocus project of the story.
+            state: The ProjectState of the project at the last sync,
+                or None.
+
+        Returns:
+            The set of tags of the story.
+        """
+        ops = []
+        if not of_project.completed:
+            ops.append(syncplan.SetProjectCompleted(of_project.id,
+                                                    of_project.name))
+        plan.extend(ops)
+
+        # Record that the story is in the archive phase.  Its
+        # fingerprint then differs, so the story is fully synchronized
+        # if it leaves the archive phase.
+        if self.state_store is not None and (
+            state is None or state.az_story_id != az_story.id
+            or state.phase_id != az_story.phase.id):
+            if state is None:
+                state = syncstate.ProjectState(
+                    of_project.id, az_story.id, None, None,
+                    az_story.phase.id, None, None)
+            else:
+                state = state._replace(az_story_id=az_story.id,
+                                       phase_id=az_story.phase.id)
+            plan.project_states.append((
+                set([az_story.id]).union([op.key for op in ops]),
+                of_project.id, state))
+        return az_story.tags
+
+    def _plan_listed_story(self, plan, deletes, az_story, az_story_index,
+                           of_project_ids, of_project_tasks, of_color_picker,
+                           az_phases, owner, project_states, now,
+                           light=False):
+        """Plans the synchronization of a story listed from AgileZen.
+
+        Args:
+            plan: The SyncPlan to append the story's operations to.
+            deletes: The list to append the story's DeleteStory
+                operation to, if it must be deleted.  Deletions must
+                be appended to the plan only once all stories are
+                listed, as they shift the pages of the listings.
+            az_story: The AgileZen story, with its details and tags,
+                and with its tasks unless light is True.
+            az_story_index: The dict of the tuples (story_id,
+                phase_id) of the stories listed so far, by OmniFocus
+                project ID.  The story is added into it.
+            of_project_ids: The set of the IDs of the selected
+                OmniFocus projects.
+            of_project_tasks: The dict of the lists of OmniFocus
+                tasks, by OmniFocus project ID.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of its story.
+            az_phases: The ProjectPhases of the AgileZen project.
+            owner: The User to assign to the story, or None.
+            project_states: The dict of the ProjectStates of the
+                projects at the last sync, by OmniFocus project ID.
+            now: The current datetime.
+            light: If True, the story is in the archive phase, and is
+                not updated.  Defaults to False.
+
+        Returns:
+            The set of tags of the story, once synchronized.
+        """
+        # Delete stories that have no OmniFocus project ID.
+        of_project_id = self._get_omnifocus_id(az_story)
+        if of_project_id is None:
+            deletes.append(syncplan.DeleteStory(az_story.id, az_story.text))
+            return set()
+
+        # TODO: Delete duplicates, i.e. multiple stories with the same
+        # OmniFocus ID.
+        if of_project_id in az_story_index:
+            LOG.warning('ignoring AgileZen story %i, duplicate of story %i',
+                        az_story.id, az_story_index[of_project_id][0])
+            return set()
+        az_story_index[of_project_id] = (az_story.id, az_story.phase.id)
+
+        of_project = self.of_dao.get_project_by_id(of_project_id)
+
+        # Delete AZ stories that no more correspond to a selected
+        # project in OF, except if the OF project still exists and
+        # either the OF project or AZ story is completed, to keep a
+        # trace of completed projects in AZ until they are deleted
+        # (e.g. archived) in OF.
+        delete_az_story = (
+            of_project is None
+            or of_project_id not in of_project_ids
+            or of_project.status == omnifocus.STATUS_DROPPED)
+
+        if delete_az_story:
+            deletes.append(syncplan.DeleteStory(az_story.id, az_story.text))
+            plan.project_states.append(
+                (set([az_story.id]), of_project_id, None))
+            plan.task_ids.append(
+                (set([az_story.id]), of_project_id, az_story.id, []))
+            return set()
+        with profiling.attribute(self.profiler, az_story.id):
+            if light:
+                return self._plan_archived_story(
+                    plan, az_story, of_project,
+                    project_states.get(of_project_id))
+            return self._plan_story_update(
+                plan, az_story, of_project,
+                of_project_tasks.get(of_project_id, []), of_color_picker,
+                az_phases, owner, project_states.get(of_project_id), now)
+
+    @staticmethod
+    def _count_tags(tags, used_tag_counts, used_tag_ids):
+        """Counts the tags of a story as used.
+
+        Args:
+            tags: The set of tags of the story, once synchronized.
+            used_tag_counts: The Counter of the numbers of stories
+                using every tag, by tag name.
+            used_tag_ids: The dict of the known IDs of the used tags,
+                by tag name.
+        """
+        for tag_id, name in agilezen.iter_field_values(tags, ('id', 'name')):
+            used_tag_counts[name] += 1
+            if tag_id is not None:
+                used_tag_ids[name] = tag_id
+
+    def _plan_tags_gc(self, plan, used_tag_counts, used_tag_ids,
+                      all_tags_known, now):
+        """Updates the registered tags, and plans deleting unused tags.
+
+        The project's tags are read from AgileZen and unused tags are
+        deleted only if the set of used tags changed since the last
+        sync, or if some registered tags have been unused for longer
+        than the grace period, which are then deleted.
+
+        Args:
+            plan: The SyncPlan to append operations to.
+            used_tag_counts: The Counter of the numbers of stories
+                using every tag, by tag name.
+            used_tag_ids: The dict of the known IDs of the used tags,
+                by tag name.
+            all_tags_known: Whether the tags of all the stories were
+                counted.  If False, tags are not deleted.
+            now: The current datetime.
+        """
+        registry = self.state_store.get_tags(plan.az_project_id)
+        now_time = now.isoformat()
+        records = {}
+        for name, count in used_tag_counts.iteritems():
+            record = registry.get(name)
+            tag_id = used_tag_ids.get(name)
+            if tag_id is None and record is not None:
+                tag_id = record.tag_id
+            records[name] = syncstate.TagRecord(name, tag_id, now_time, count)
+        if not all_tags_known:
+            plan.tag_records.extend([(set(), name, record)
+                                     for name, record in records.iteritems()])
+            return
+
+        previously_used_names = set([name for name, record
+                                     in registry.iteritems()
+                                     if record.ref_count])
+        for name in previously_used_names.difference(used_tag_counts):
+            # Start the grace period of newly unused tags.
+            records[name] = registry[name]._replace(ref_count=0)
+        expiration_time = (now - self.tag_grace_period).isoformat()
+        gc_needed = (previously_used_names != set(used_tag_counts) or any(
+                not record.ref_count
+                and record.last_used_time <= expiration_time
+                for record in registry.itervalues()))
+
+        if gc_needed:
+            az_tag_names = set()
+            for tag in self.az_dao.iter_project_tags(plan.az_project_id):
+                az_tag_names.add(tag.name)
+                record = records.get(tag.name, registry.get(tag.name))
+                if record is None:
+                    # The tag was created in AgileZen, or was never
+                    # used.
+                    record = syncstate.TagRecord(tag.name, tag.id, now_time,
+                                                 0)
+                elif record.tag_id != tag.id:
+                    record = record._replace(tag_id=tag.id)
+                if (not record.ref_count
+                    and record.last_used_time <= expiration_time):
+                    op = syncplan.DeleteTag(tag.id, tag.name)
+                    plan.append(op)
+                    plan.tag_records.append((set([op.key]), tag.name, None))
+                    records.pop(tag.name, None)
+                else:
+                    records[tag.name] = record
+            # Forget the unused tags that were deleted in AgileZen.
+            for name in registry:
+                if name not in az_tag_names and name not in used_tag_counts:
+                    records.pop(name, None)
+                    plan.tag_records.append((set(), name, None))
+
+        plan.tag_records.extend([(set(), name, record)
+                                 for name, record in records.iteritems()
+                                 if record != registry.get(name)])
+
+    def _is_archive_listing_needed(self, az_project_id, az_phases,
+                                   of_project_ids, az_story_index,
+                                   project_states, now):
+        """Checks whether the stories in the archive phase must be listed.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            az_phases: The ProjectPhases of the AgileZen project.
+            of_project_ids: The set of the IDs of the selected
+                OmniFocus projects.
+            az_story_index: The dict of the tuples (story_id,
+                phase_id) of the stories listed in the other phases,
+                by OmniFocus project ID.
+            project_states: The dict of the ProjectStates of the
+                projects at the last sync, by OmniFocus project ID.
+            now: The current datetime.
+
+        Returns:
+            True if the archive_interval elapsed since the last
+            listing, or if the stories last seen in the archive phase
+            are unknown, or if a story last seen in another phase may
+            have been archived since, False otherwise.
+        """
+        if not self.archive_interval or not project_states:
+            return True
+        for of_project_id in of_project_ids.difference(az_story_index):
+            state = project_states.get(of_project_id)
+            if (state is not None and state.az_story_id is not None
+                and state.phase_id != az_phases.archive.id):
+                return True
+        listing_time = self.state_store.get_project_value(
+            az_project_id, ARCHIVE_LISTING_TIME)
+        return (listing_time is None
+                or listing_time <= (now - self.archive_interval).isoformat())
+
+    def _plan_into(self, plan, of_project_selector, of_color_picker,
+                   owner_username, full, of_snapshot=None):
+        """Plans the synchronization of OmniFocus projects, story by story.
+
+        The stories are read from AgileZen page by page, and every
+        story's operations are appended to the plan as soon as the
+        story is read.  Only the IDs and phases of the stories are
+        retained, to create the stories of new projects at the end.
+        Depending on the archive_mode and archive_interval, the
+        stories in the archive phase are listed last, without their
+        tasks, or only once in a while.
+
+        Args:
+            plan: The SyncPlan to append operations to, e.g. a
+                StreamingPlan to execute them immediately.
+            of_project_selector: A callable taking an OmniFocus
+                project object, and returns True or False whether the
+                project must be synchronized or not.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of its story.
+            owner_username: The username of the owner to assign to all
+                AgileZen stories, or None.
+            full: If True, synchronize all projects, even those which
+                are unmodified since the last sync according to the
+                state store.
+            of_snapshot: The omnifocus.OmniFocusSnapshot of all
+                OmniFocus projects and tasks.  Defaults to None, i.e.
+                a new snapshot is taken.
+        """
+        az_project_id = plan.az_project_id
+        owner = None
+        if owner_username:
+            owner = agilezen.User(None, None, None, owner_username)
+
+        # Unless the stories in the archive phase are synchronized
+        # like all other stories, list them separately, after all
+        # other stories.
+        split_archive = (self.archive_mode != ARCHIVE_FULL
+                         or bool(self.archive_interval))
+
+        with profiling.stage(self.profiler, 'fetch'):
+            # Read all OmniFocus projects and tasks at once, and index
+            # all contexts and folders, to resolve the full context
+            # and folder names used by selectors, color pickers, and
+            # tags without walking up their hierarchies.  OmniFocus is
+            # read in the background, while AgileZen is read.
+            of_snapshot_call = None
+            if of_snapshot is None:
+                of_snapshot_call = pipeline.BackgroundCall(
+                    self.of_dao.take_snapshot, 'omnifocus-reader')
+            try:
+                # The stories are then listed by phase, so all phases
+                # must be known.
+                az_project, az_phases, az_all_phases = (
+                    self._get_az_project(az_project_id,
+                                         refresh=split_archive))
+
+                project_states = {}
+                if self.state_store is not None and not full:
+                    project_states = self.state_store.get_project_states(
+                        az_project_id)
+
+                # Start listing the stories, to synchronize them as
+                # soon as OmniFocus is read.  The listing is started
+                # last, as it must be closed if anything fails.  Its
+                # thread sends its requests with the sessions of the
+                # DAO's pool, so it reuses the connections of the
+                # previous syncs.
+                where = None
+                if split_archive:
+                    where = agilezen.get_phase_filter(
+                        [phase for phase in az_all_phases
+                         if phase.id != az_phases.archive.id])
+                az_stories = pipeline.iter_in_background(
+                    self.az_dao.iter_project_stories(
+                        az_project_id, with_details=True, with_tags=True,
+                        with_tasks=True, where=where),
+                    STORY_BUFFER_SIZE, 'agilezen-lister')
+            except Exception:
+                # Don't read OmniFocus concurrently with the next sync.
+                if of_snapshot_call is not None:
+                    of_snapshot_call.wait()
+                raise
+
+            try:
+                if of_snapshot_call is not None:
+                    of_snapshot = of_snapshot_call.get_result()
+                of_projects_dict = of_snapshot.select_projects(
+                    of_project_selector)
+                of_project_tasks = of_snapshot.project_tasks
+            except Exception:
+                az_stories.close()
+                raise
+
+        with profiling.stage(self.profiler, 'diff'), \
+                contextlib.closing(az_stories):
+            now = datetime.datetime.now()
+            of_project_ids = set(of_projects_dict.iterkeys())
+            az_phase_ids = set([phase.id for phase in az_all_phases])
+            # The tuples (story_id, phase_id) of the stories of
+            # OmniFocus projects, by OmniFocus project ID.
+            az_story_index = {}
+
+            # Count the stories using every tag once synchronized, and
+            # collect the known IDs of tags, to delete unused tags.
+            used_tag_counts = collections.Counter()
+            used_tag_ids = {}
+
+            # The DeleteStory operations, held until all stories are
+            # listed.  Deleting a story while the next pages are listed
+            # would shift them, and skip stories.
+            deletes = []
+
+            for az_story in az_stories:
+                # Refresh the cached phases if they were modified in
+                # AgileZen.
+                if az_story.phase.id not in az_phase_ids:
+                    LOG.info('phases of AgileZen project %i modified, '
+                             'refreshing', az_project_id)
+                    az_project, az_phases, az_all_phases = (
+                        self._get_az_project(az_project_id, refresh=True))
+                    az_phase_ids = set([phase.id for phase
+                                        in az_all_phases])
+                self._count_tags(
+                    self._plan_listed_story(
+                        plan, deletes, az_story, az_story_index,
+                        of_project_ids, of_project_tasks, of_color_picker,
+                        az_phases, owner, project_states, now),
+                    used_tag_counts, used_tag_ids)
+
+            # Whether the tags of all stories are known.
+            all_tags_known = True
+            if split_archive:
+                if self._is_archive_listing_needed(
+                        az_project_id, az_phases, of_project_ids,
+                        az_story_index, project_states, now):
+                    light = self.archive_mode == ARCHIVE_LIGHT
+                    for az_story in self.az_dao.iter_project_stories(
+                            az_project_id, with_details=True,
+                            with_tags=True, with_tasks=not light,
+                            where=agilezen.get_phase_filter(
+                                [az_phases.archive])):
+                        self._count_tags(
+                            self._plan_listed_story(
+                                plan, deletes, az_story, az_story_index,
+                                of_project_ids, of_project_tasks,
+                                of_color_picker, az_phases, owner,
+                                project_states, now, light=light),
+                            used_tag_counts, used_tag_ids)
+                    plan.project_values[ARCHIVE_LISTING_TIME] = (
+                        now.isoformat())
+                else:
+                    # Assume that the stories last seen in the archive
+                    # phase are still there, with unknown tags.
+                    for of_project_id, state in project_states.iteritems():
+                        if (state.phase_id == az_phases.archive.id
+                            and state.az_story_id is not None
+                            and of_project_id not in az_story_index):
+                            az_story_index[of_project_id] = (
+                                state.az_story_id, state.phase_id)
+                    all_tags_known = False
+
+            plan.extend(deletes)
+
+            # TODO: Copy the project's "estimated_minutes" into the
+            # story's size.
+
+            # Add new AZ stories for new OF projects.
+            for of_project_id in of_project_ids.difference(az_story_index):
+                _, of_project = of_projects_dict[of_project_id]
+                with profiling.attribute(self.profiler, of_project_id):
+                    self._count_tags(
+                        self._plan_new_story(
+                            plan, of_project,
+                            of_project_tasks.get(of_project_id, []),
+                            of_color_picker, az_phases, owner, now),
+                        used_tag_counts, used_tag_ids)
+
+            # Delete tags that are now unused, after having
+            # dissociated them from AZ stories.  Tags may be used by
+            # the stories in the archive phase if they were not
+            # listed.
+            if self.state_store is not None:
+                self._plan_tags_gc(plan, used_tag_counts, used_tag_ids,
+                                   all_tags_known, now)
+            elif all_tags_known:
+                for tag in self.az_dao.iter_project_tags(az_project_id):
+                    if tag.name not in used_tag_counts:
+                        plan.append(syncplan.DeleteTag(tag.id, tag.name))
+
+    def plan_sync(self, of_project_selector, of_color_picker,
+                  az_project_id, owner_username=None, full=False,
+                  of_snapshot=None):
+        """Plans the synchronization of OmniFocus projects as AgileZen stories.
+
+        Every OmniFocus project corresponds to one story in an
+        AgileZen project.  OmniFocus and AgileZen are read, but not
+        modified.
+
+        Args:
+            of_project_selector: A callable taking an OmniFocus
+                project object, and returns True or False whether the
+                project must be synchronized or not.
+            of_color_picker: A callable taking an OmniFocus project
+                object, and returns the color of the corresponding
+                story card, as a string.  The returned color must be
+                in the agilezen.COLORS list.
+            az_project_id: The ID of the AgileZen project to contain
+                the stories.
+            owner_username: The username of the owner to assign to all
+                AgileZen stories.  Defaults to None, i.e. no owner.
+            full: If True, synchronize all projects, even those which
+                are unmodified since the last sync according to the
+                state store.  Defaults to False.
+            of_snapshot: The omnifocus.OmniFocusSnapshot of all
+                OmniFocus projects and tasks, e.g. shared by the plans
+                of several AgileZen projects.  Defaults to None, i.e.
+                a new snapshot is taken.
+
+        Returns:
+            The SyncPlan of the write operations to execute to
+            synchronize OmniFocus and AgileZen.
+        """
+        plan = syncplan.SyncPlan(az_project_id)
+        self._plan_into(plan, of_project_selector, of_color_picker,
+                        owner_username, full, of_snapshot)
+        return plan
+
+    def _store_project_states(self, plan, executor, failures):
+        """Stores the states of the projects synchronized by a plan.
+
+        The state of a project is stored only if all its operations
+        were executed successfully.  The registered tags, the IDs of
+        the stories' tasks, and the project's values are also stored.
+
+        Args:
+            plan: The executed SyncPlan.
+            executor: The PlanExecutor that executed the plan.
+            failures: The dict of failures, by operation key.
+        """
+        created_story_ids = executor.created_story_ids
+        states = []
+        deleted_of_project_ids = []
+        for keys, of_project_id, state in plan.project_states:
+            if any(key in failures for key in keys):
+                continue
+            if state is None:
+                deleted_of_project_ids.append(of_project_id)
+                continue
+            if state.az_story_id is None:
+                state = state._replace(
+                    az_story_id=created_story_ids.get(of_project_id))
+            states.append(state)
+        self.state_store.update_project_states(plan.az_project_id, states,
+                                               deleted_of_project_ids)
+        if plan.project_values:
+            self.state_store.update_project_values(plan.az_project_id,
+                                                   plan.project_values)
+        records = []
+        deleted_names = []
+        for keys, name, record in plan.tag_records:
+            if any(key in failures for key in keys):
+                continue
+            if record is None:
+                deleted_names.append(name)
+            else:
+                records.append(record)
+        if records or deleted_names:
+            self.state_store.update_tags(plan.az_project_id, records,
+                                         deleted_names)
+        story_task_ids = []
+        for keys, of_project_id, story_id, task_ids in plan.task_ids:
+            if any(key in failures for key in keys):
+                continue
+            # Tasks are created by the operations on existing stories,
+            # keyed by story ID, or on created stories, keyed by
+            # OmniFocus project ID.
+            key = story_id
+            if story_id is None:
+                key = of_project_id
+                story_id = created_story_ids.get(of_project_id)
+                if story_id is None:
+                    continue
+            resolved_task_ids = []
+            for of_task_id, az_task_id, text in task_ids:
+                if az_task_id is None:
+                    az_task_id = executor.get_created_task_id(key, text)
+                if az_task_id is not None:
+                    resolved_task_ids.append((of_task_id, az_task_id))
+            story_task_ids.append((story_id, resolved_task_ids))
+        if story_task_ids:
+            self.state_store.update_task_ids(plan.az_project_id,
+                                             story_task_ids)
+
+    def execute_plan(self, plan):
+        """Executes a synchronization plan.
+
+        Args:
+            plan: The SyncPlan to execute.
+
+        Raises:
+            IOError: Some operations failed.
+        """
+        executor = syncplan.PlanExecutor(self.of_dao, self.az_dao,
+                                         profiler=self.profiler)
+        with profiling.stage(self.profiler, 'write'):
+            failures = executor.execute(plan)
+        self._check_execution(plan, executor, failures)
+
+    def _check_execution(self, plan, executor, failures):
+        """Stores the states of synchronized projects, and reports failures.
+
+        Args:
+            plan: The executed SyncPlan.
+            executor: The PlanExecutor that executed the plan.
+            failures: The dict of failures, by operation key.
+
+        Raises:
+            IOError: Some operations failed.
+        """
+        if self.state_store is not None:
+            with profiling.stage(self.profiler, 'store state'):
+                self._store_project_states(plan, executor, failures)
+        if failures:
+            for key, e in failures.iteritems():
+                LOG.error('failed to sync %r: %s', key, e)
+            raise IOError('failed to sync %i AgileZen stories, tags, or '
+                          'OmniFocus objects' % (len(failures),))
+
     def sync_projects(self, of_project_selector, of_color_picker,
-                      az_project_id, owner_username=None):
+                      az_project_id, owner_username=None, full=False,
+                      of_snapshot=None):
         """Synchronizes OmniFocus projects as AgileZen stories.
 
         Every OmniFocus project corresponds to one story in an
-        AgileZen project.
+        AgileZen project.  The stories are read and updated page by
+        page, without keeping them all in memory.
 
         Args:
             of_project_selector: A callable taking an OmniFocus
@@ -256,277 +1386,218 @@ class OmniFocusToAgileZenSync(object):
                 the stories.
             owner_username: The username of the owner to assign to all
                 AgileZen stories.  Defaults to None, i.e. no owner.
+            full: If True, synchronize all projects, even those which
+                are unmodified since the last sync according to the
+                state store.  Defaults to False.
+            of_snapshot: The omnifocus.OmniFocusSnapshot of all
+                OmniFocus projects and tasks.  Defaults to None, i.e.
+                a new snapshot is taken.
+
+        Raises:
+            IOError: Some operations failed.
         """
-        owner = None
-        if owner_username:
-            owner = agilezen.User(None, None, None, owner_username)
+        self._sync_projects(self.az_dao, of_project_selector,
+                            of_color_picker, az_project_id, owner_username,
+                            full, of_snapshot)
 
-        az_project = None
+    def _sync_projects(self, az_dao, of_project_selector, of_color_picker,
+                       az_project_id, owner_username, full, of_snapshot):
+        """Synchronizes OmniFocus projects as AgileZen stories.
+
+        Args:
+            az_dao: The AgileZenDataAccess object to submit AgileZen
+                write operations to, e.g. a fork of this
+                synchronizer's DAO.
+            See sync_projects for the other arguments.
+
+        Raises:
+            IOError: Some operations failed.
+        """
+        # Execute the operations of every story as soon as they are
+        # planned, while the next pages of stories are read.
+        executor = syncplan.PlanExecutor(self.of_dao, az_dao,
+                                         profiler=self.profiler)
+        plan = syncplan.StreamingPlan(az_project_id, executor)
         try:
-            az_project = self.az_dao.get_project(az_project_id)
+            self._plan_into(plan, of_project_selector, of_color_picker,
+                            owner_username, full, of_snapshot)
         except Exception:
-            LOG.error('project ID %i not found', az_project_id)
-            raise ValueError('project ID %i not found' % (az_project_id,))
+            # Let the submitted operations complete before failing.
+            executor.wait()
+            raise
+        with profiling.stage(self.profiler, 'write'):
+            failures = executor.wait()
+        self._check_execution(plan, executor, failures)
 
-        az_phases = agilezen.ProjectPhases.parse_phases(
-            list(self.az_dao.iter_project_phases(az_project.id)))
+    def sync_boards(self, boards, full=False):
+        """Synchronizes OmniFocus projects into several AgileZen projects.
 
-        of_projects_dict = self.of_dao.get_projects(of_project_selector)
-        az_stories = list(self.az_dao.iter_project_stories(
-                az_project.id, with_details=True, with_tags=True,
-                with_tasks=True))
+        OmniFocus is read only once, and all the AgileZen projects are
+        synchronized concurrently from the same snapshot.  Every
+        AgileZen project is written with its own fork of the AgileZen
+        DAO, so that failures are reported per project.
 
-        # Delete stories that have no OmniFocus project ID.
-        for az_story in az_stories:
-            if self._get_omnifocus_id(az_story) is None:
-                LOG.debug('deleting AgileZen story %s "%s"',
-                          az_story.id, az_story.text)
-                self.az_dao.delete_project_story(az_project.id, az_story.id)
-
-        # TODO: Check for duplicates, i.e. multiple stories with the
-        # same OmniFocus ID.
-
-        az_stories_dict = dict([(self._get_omnifocus_id(story), story)
-                                for story in az_stories])
-        if None in az_stories_dict:
-            del az_stories_dict[None]  # Already deleted above.
-
-        of_project_ids = set(of_projects_dict.iterkeys())
-        az_of_project_ids = set(az_stories_dict.iterkeys())
-
-        # Collect the current and final sets of tags, to delete unused tags.
-        all_used_tags = set()
-
-        # Add new AZ stories for new OF projects.
-        for of_project_id in of_project_ids - az_of_project_ids:
-            _, of_project = of_projects_dict[of_project_id]
-            az_story = agilezen.Story(
-                None,
-                self._get_az_story_text_for_project(of_project),
-                self._get_az_story_details_for_project(of_project),
-                None,
-                None,
-                of_color_picker(of_project),
-                self._get_az_story_phase_for_project(of_project, az_phases,
-                                                     az_phases.backlog),
-                None,
-                owner,
-                self._get_az_tags_for_project(of_project),
-                self._get_az_tasks_for_project(of_project))
-            all_used_tags.update(az_story.tags)
-            LOG.debug('creating AgileZen story "%s"', az_story.text)
-            self.az_dao.create_project_story(az_project.id, az_story)
-
-        # TODO: Copy the project's "estimated_minutes" into the
-        # story's size.
-
-        for of_project_id in az_of_project_ids:
-            az_story = az_stories_dict[of_project_id]
-            of_project = self.of_dao.get_project_by_id(of_project_id)
-
-            delete_az_story = False
-            az_story_is_completed = az_story.phase.id in (
-                az_phases.done.id, az_phases.archive.id)
-            az_story_is_in_progress = az_story.phase.id not in (
-                az_phases.backlog.id, az_phases.ready.id,
-                az_phases.done.id, az_phases.archive.id)
-
-            # Delete AZ stories that no more correspond to a selected
-            # project in OF, except if the OF project still exists and
-            # either the OF project or AZ story is completed, to keep
-            # a trace of completed projects in AZ until they are
-            # deleted (e.g. archived) in OF.
-            delete_az_story = (
-                of_project is None
-                or of_project_id not in of_project_ids
-                or of_project.status == appscript.k.dropped)
-
-            if delete_az_story:
-                LOG.debug('deleting AgileZen story %s "%s"',
-                          az_story.id, az_story.text)
-                self.az_dao.delete_project_story(az_project.id, az_story.id)
-            else:
-                # Update the OmniFocus project.  The only update that
-                # can be performed on an OmniFocus project is setting
-                # it as active or completed, in case the AgileZen task
-                # is in an active or completed phase.
-                # The philosophy is that a project / story can only
-                # progress forward, never backward, so always in the
-                # order: backlog -> ready -> ... -> done & archive.
-                # Which ever of OmniFocus or AgileZen makes a project
-                # / story go forward has precedence on the other re:
-                # the status.
-                if (az_story_is_in_progress
-                    and of_project.status == appscript.k.on_hold):
-                    LOG.debug(
-                        'marking as active OmniFocus project %s "%s"',
-                        of_project.id, of_project.name)
-                    self.of_dao.set_project_active(of_project)
-                elif az_story_is_completed and not of_project.completed:
-                    LOG.debug(
-                        'marking as completed OmniFocus project %s "%s"',
-                        of_project.id, of_project.name)
-                    self.of_dao.set_project_completed(of_project)
-
-                # Update the AgileZen story if either the AZ story or
-                # the OF project has been modified.  Such updates
-                # always flow from OF to AZ, never the other way
-                # round: OF is the golden standard.
-                # Ignore the current story's owner if the owner option
-                # is not set, i.e. owner is None.
-                updated_text = self._get_az_story_text_for_project(of_project)
-                updated_details = self._get_az_story_details_for_project(
-                    of_project)
-                updated_color = of_color_picker(of_project)
-                updated_phase = self._get_az_story_phase_for_project(
-                    of_project, az_phases, az_story.phase)
-                if (az_story.text != updated_text or
-                    az_story.details != updated_details or
-                    az_story.color != updated_color or
-                    az_story.phase.id != updated_phase.id or
-                    owner is not None and (
-                        az_story.owner is None or
-                        az_story.owner.userName != owner.userName)):
-                    LOG.debug('updating AgileZen story %s "%s"',
-                              az_story.id, az_story.text)
-                    self.az_dao.update_project_story(
-                        az_project.id,
-                        az_story._replace(
-                            text=updated_text,
-                            details=updated_details,
-                            color=updated_color,
-                            phase=updated_phase,
-                            owner=owner))
-
-                # Update the AgileZen story's tags.
-                updated_tags = self._get_az_tags_for_project(of_project)
-                all_used_tags.update(updated_tags)
-                if (set([tag.name for tag in az_story.tags])
-                        != set([tag.name for tag in updated_tags])):
-                    LOG.debug('updating AgileZen tags in story %s "%s"',
-                              az_story.id, az_story.text)
-                    self.az_dao.update_project_story_tags(
-                        az_project.id, az_story.id, updated_tags)
-
-                # Update the tasks in the AgileZen story if any AZ
-                # task or OF task has been added, deleted, or
-                # modified.  OF is the golden standard for tasks.
-                # Task updates always flow from OF to AZ, never the
-                # other way round, except for completion status: if a
-                # task is marked as completed in either AZ or OF, it
-                # is then marked as completed in the other.  After
-                # sync, each AZ story only contains non-completed
-                # tasks, and completed tasks are deleted in AZ and
-                # marked as completed in OF.
-
-                # First update the set of tasks, regardless of their
-                # order.
-
-                # The current dict of all (completed or not) tasks in
-                # the OF project.
-                of_tasks_dict = dict(
-                    [(self._get_az_task_name(of_task), of_task)
-                     for of_task in of_project.root_task.tasks])
-                # The current list of (completed or not) tasks in the
-                # AZ story, with AZ task IDs, etc.
-                az_tasks_cur = az_story.tasks
-                az_tasks_cur_dict = dict(
-                    [(task.text, task) for task in az_tasks_cur])
-                az_tasks_cur_texts = set(az_tasks_cur_dict.iterkeys())
-
-                # The list of AZ tasks reflecting the list of tasks in
-                # the OF project, both completed and non-completed.
-                # This is the desired list of tasks in the AZ story.
-                # If a story has been set as completed in AZ, set it
-                # also as completed in the target list.  The code
-                # below updates the AZ story to contain exactly this
-                # list.
-                az_tasks_new = [
-                    task._replace(status=True)
-                        if not task.status
-                            and az_tasks_cur_dict.has_key(task.text)
-                            and az_tasks_cur_dict[task.text].status
-                        else task
-                    for task in self._get_az_tasks_for_project(of_project)]
-                az_tasks_new_dict = dict(
-                    [(task.text, task) for task in az_tasks_new])
-                az_tasks_new_texts = set(az_tasks_new_dict.iterkeys())
-
-                # Delete tasks in AZ if they are deleted in OF.
-                for az_task_text in az_tasks_cur_texts - az_tasks_new_texts:
-                    az_task = az_tasks_cur_dict[az_task_text]
-                    LOG.debug(
-                        'deleting AgileZen task %s "%s" in story %s "%s"',
-                        az_task.id, az_task.text, az_story.id, az_story.text)
-                    self.az_dao.delete_project_story_task(
-                        az_project.id, az_story.id, az_task.id)
-                    del az_tasks_cur_dict[az_task.text]
-                    az_tasks_cur.remove(az_task)
-                # Add new tasks.
-                for az_task_text in az_tasks_new_texts - az_tasks_cur_texts:
-                    az_task = az_tasks_new_dict[az_task_text]
-                    LOG.debug(
-                        'creating AgileZen task "%s" in story %s "%s"',
-                        az_task.text, az_story.id, az_story.text)
-                    created_az_task = self.az_dao.create_project_story_task(
-                        az_project.id, az_story.id, az_task)
-                    az_tasks_cur_dict[created_az_task.text] = created_az_task
-                    # Tasks newly created via the API in AgileZen are
-                    # inserted first.
-                    az_tasks_cur.insert(0, created_az_task)
-
-                # Update the status of tasks, either in AgileZen or
-                # OmniFocus.  If a task on any side is complete, the
-                # other is also marked as complete.
-                for az_task_new in az_tasks_new:
-                    az_task_cur = az_tasks_cur_dict[az_task_new.text]
-                    if az_task_new.status and not az_task_cur.status:
-                        # Mark the task as completed in AZ.
-                        LOG.debug('marking as completed AgileZen task "%s" '
-                                  'in story %s "%s"',
-                                  az_task_new.text, az_story.id, az_story.text)
-                        az_task_new = az_task_cur._replace(status=True)
-                        self.az_dao.update_project_story_task(
-                            az_project.id, az_story.id, az_task_new)
-                    elif az_task_cur.status:
-                        # Mark the tasks as completed in OF.
-                        of_task = of_tasks_dict.get(az_task_new.text)
-                        if of_task is not None and not of_task.completed:
-                            LOG.debug(
-                                'marking as completed OmniFocus task %s "%s" '
-                                'in project %s "%s"', of_task.id, of_task.name,
-                                of_project.id, of_project.name)
-                            self.of_dao.set_task_completed(of_task)
-                        
-                # Second, reorder tasks.
-                az_tasks_cur_ord_texts = [task.text for task in az_tasks_cur]
-                az_tasks_new_ord_texts = [task.text for task in az_tasks_new]
-                if az_tasks_cur_ord_texts != az_tasks_new_ord_texts:
-                    # Reorder tasks.
-                    LOG.debug(
-                        'reordering AgileZen tasks in story %s "%s"',
-                        az_story.id, az_story.text)
-                    # Use the IDs of previously or newly created AZ
-                    # Task objects, following the order of Task
-                    # objects in az_tasks_new.
-                    import json
-                    self.az_dao.reorder_project_story_tasks(
-                        az_project.id, az_story.id,
-                        [az_tasks_cur_dict[az_task.text].id
-                         for az_task in az_tasks_new])
-
-        # Delete tags that are now unused, after having dissociated
-        # them from AZ stories.
-        all_tags = self.az_dao.iter_project_tags(az_project_id)
-        all_used_tag_names = set([tag.name for tag in all_used_tags])
-        for tag in all_tags:
-            if tag.name not in all_used_tag_names:
-                LOG.debug('deleting AgileZen tag %i "%s"', tag.id, tag.name)
-                self.az_dao.delete_project_tag(az_project.id, tag.id)
+        Args:
+            boards: The list of boards.Board objects, which AgileZen
+                projects must be different.
+            full: If True, synchronize all projects, even those which
+                are unmodified since the last sync according to the
+                state store.  Defaults to False.
+
+        Raises:
+            IOError: The synchronization of some boards failed.
+        """
+        with profiling.stage(self.profiler, 'fetch'):
+            of_snapshot = self.of_dao.take_snapshot()
+        # The exceptions raised by failed synchronizations, by board
+        # name.
+        failures = {}
+
+        def sync_board(board):
+            try:
+                self._sync_projects(
+                    self.az_dao.fork(), board.of_project_selector,
+                    board.of_color_picker, board.az_project_id,
+                    board.owner_username, full, of_snapshot)
+            except Exception, e:
+                LOG.exception('failed to sync board "%s" to AgileZen '
+                              'project %i', board.name, board.az_project_id)
+                failures[board.name] = e
+
+        threads = [threading.Thread(target=sync_board, args=(board,),
+                                    name='board-%s' % (board.name,))
+                   for board in boards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise IOError('failed to sync %i of %i boards: %s' % (
+                    len(failures), len(boards),
+                    ', '.join(sorted(failures.iterkeys()))))
+
+
+def run_daemon(run_cycle, interval, pid_file):
+    """Runs synchronization cycles periodically, until terminated.
+
+    A cycle is started every interval seconds, or immediately when the
+    process receives the SIGUSR1 signal.  The process stops after the
+    current cycle when it receives the SIGTERM or SIGINT signal.
+
+    Args:
+        run_cycle: The callable to call to run a cycle.
+        interval: The number of seconds between the ends of two
+            successive cycles.
+        pid_file: The file to write the process ID into, to be
+            signaled by the --once-now option.
+    """
+    wakeup = threading.Event()
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        LOG.info('received signal %i, stopping', signum)
+        stopping.set()
+        wakeup.set()
+
+    def trigger(signum, frame):
+        LOG.info('received signal %i, starting a cycle now', signum)
+        wakeup.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, trigger)
+
+    with open(pid_file, 'w') as f:
+        f.write('%i\n' % (os.getpid(),))
+    try:
+        while not stopping.is_set():
+            wakeup.clear()
+            try:
+                run_cycle()
+            except Exception:
+                # Retry at the next cycle.
+                LOG.exception('sync cycle failed')
+            if not stopping.is_set():
+                wakeup.wait(interval)
+    finally:
+        os.remove(pid_file)
+
+
+def get_pending_writes_path(options):
+    """Gets the path of the file of the writes pending into OmniFocus.
+
+    Args:
+        options: The parsed command line options.
+
+    Returns:
+        The path of the file the writes are appended into with
+        --from-snapshot, and applied from with the snapshot command,
+        or None if there is no snapshot file.
+    """
+    if options.pending_writes is not None:
+        return options.pending_writes
+    if options.command == COMMAND_SNAPSHOT:
+        path = options.out
+    else:
+        path = options.from_snapshot
+    if path is None:
+        return None
+    return path + omnifocusfile.PENDING_WRITES_SUFFIX
+
+
+def make_omnifocus_dao(options, profiler=None):
+    """Creates the OmniFocus DAO selected by the command line options.
+
+    Args:
+        options: The parsed command line options.
+        profiler: The profiling.Profiler to record Apple Events into.
+            Defaults to None, i.e. no profiling.
+
+    Returns:
+        A tuple (omnifocus_app, omnifocus_dao), where omnifocus_app
+        is the appscript app object of OmniFocus, or None if OmniFocus
+        is not needed to read projects and is not running.
+
+    Raises:
+        IOError: OmniFocus is needed and is not running.
+    """
+    if options.from_snapshot is not None:
+        return None, omnifocusfile.OmniFocusFileDataAccess(
+            options.from_snapshot, profiler=profiler,
+            pending_writes_path=get_pending_writes_path(options))
+    if options.ofocus_bundle is not None:
+        # OmniFocus is only needed to write changes back into it.
+        omnifocus_app = None
+        if appscript is None:
+            LOG.warning('appscript is not installed, changes will not be '
+                        'written into OmniFocus')
+        else:
+            omnifocus_app = appscript.app(name='OmniFocus')
+            if not omnifocus_app.isrunning():
+                LOG.warning('OmniFocus is not running, changes will not be '
+                            'written into OmniFocus')
+                omnifocus_app = None
+        return omnifocus_app, omnifocusbundle.OmniFocusBundleDataAccess(
+            options.ofocus_bundle, omnifocus_app,
+            cache_path=options.ofocus_cache_file, profiler=profiler)
+    omnifocus_app = appscript.app(name='OmniFocus')
+    if not omnifocus_app.isrunning():
+        LOG.error('OmniFocus is not running')
+        raise IOError('OmniFocus is not running')
+    if options.ofocus_script:
+        return omnifocus_app, omnifocusscript.OmniFocusScriptDataAccess(
+            omnifocus_app, profiler=profiler)
+    return omnifocus_app, omnifocus.OmniFocusDataAccess(omnifocus_app,
+                                                        profiler=profiler)
 
 
 def main():
     default_api_key_file = os.path.expanduser('~/.agilezenapikey')
+    default_state_file = os.path.expanduser('~/.pikpointstate')
+    default_cache_file = os.path.expanduser('~/.pikpointcache')
+    default_ofocus_cache_file = os.path.expanduser('~/.pikpointofocus')
+    default_pid_file = os.path.expanduser('~/.pikpoint.pid')
+    default_profile_file = 'pikpoint-profile.json'
 
     # TODO: Get the project name, version number, copyright, and
     # contact information from configure.
@@ -543,6 +1614,13 @@ There is NO WARRANTY, to the extent permitted by law.''',
         epilog='''Report bugs to: Romain Lenglet <romain.lenglet@berabera.info>
 Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
 
+    parser.add_argument(
+        'command', nargs='?', default=COMMAND_SYNC, choices=COMMANDS,
+        help='"sync" to synchronize OmniFocus with AgileZen, or '
+             '"snapshot" to write the selected OmniFocus projects into the '
+             '--out file, to synchronize them with --from-snapshot, e.g. '
+             'on another host (default: %(default)s)')
+
     parser.add_argument(
         '-k', '--api-key-file', default=default_api_key_file,
         help='the file containing an AgileZen API key on the first line '
@@ -552,10 +1630,17 @@ Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
         metavar='FILE')
 
     parser.add_argument(
-        '-p', '--project', required=True, type=int,
+        '-p', '--project', type=int,
         help='the ID of the AgileZen project to sync to',
         metavar='ID')
 
+    parser.add_argument(
+        '-b', '--boards-file',
+        help='the INI file listing the AgileZen projects to sync to '
+             'concurrently, with the folders, colors, and owner of each, '
+             'instead of --project and --owner',
+        metavar='FILE')
+
     parser.add_argument(
         '-d', '--due-soon', default=DUE_SOON_DAYS, type=int,
         help='the number of days in the future whithin which deadlines are '
@@ -568,6 +1653,161 @@ Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
              '(default: no owner assigned)',
         metavar='USERNAME')
 
+    parser.add_argument(
+        '-j', '--jobs', default=1, type=int,
+        help='the maximum number of AgileZen stories to update '
+             'concurrently (default: %(default)i)',
+        metavar='N')
+
+    parser.add_argument(
+        '--page-size', type=int,
+        help='the number of AgileZen stories, etc. to get per request '
+             '(default: adapted to the server\'s response times)',
+        metavar='N')
+
+    parser.add_argument(
+        '--concurrent-pages', default=4, type=int,
+        help='the maximum number of pages of AgileZen stories, etc. to '
+             'get concurrently (default: %(default)i)',
+        metavar='N')
+
+    parser.add_argument(
+        '--rate-limit', type=int,
+        help='the maximum number of AgileZen API requests to send per '
+             'minute (default: no limit)',
+        metavar='N')
+
+    parser.add_argument(
+        '--max-retries', default=5, type=int,
+        help='the maximum number of times to retry an AgileZen API request '
+             'that is throttled or fails temporarily (default: %(default)i)',
+        metavar='N')
+
+    parser.add_argument(
+        '-s', '--state-file', default=default_state_file,
+        help='the SQLite database file recording the state of every '
+             'project at the last sync, to skip unmodified projects '
+             '(default: %(default)s)',
+        metavar='FILE')
+
+    parser.add_argument(
+        '--cache-file', default=default_cache_file,
+        help='the SQLite database file caching the AgileZen API\'s '
+             'responses, to revalidate them instead of getting them again '
+             '(default: %(default)s)',
+        metavar='FILE')
+
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='don\'t cache the AgileZen API\'s responses')
+
+    parser.add_argument(
+        '--cache-ttl', action='append', default=[],
+        help='the number of seconds during which the cached responses of '
+             'an endpoint are used without requests, if they can\'t be '
+             'revalidated, e.g. "projects/{id}/tags=300"; may be repeated '
+             '(default: %s)' % (', '.join(
+                '%s=%i' % item
+                for item in sorted(agilezen.DEFAULT_CACHE_TTLS.items())),),
+        metavar='ENDPOINT=SECONDS')
+
+    parser.add_argument(
+        '--ofocus-bundle',
+        help='read OmniFocus projects and tasks directly from the .ofocus '
+             'database bundle at PATH, instead of with Apple Events; '
+             'changes are still written into OmniFocus with Apple Events',
+        metavar='PATH')
+
+    parser.add_argument(
+        '--ofocus-script', action='store_true',
+        help='read OmniFocus projects and tasks with a single script '
+             'exporting them, instead of with one Apple Event per '
+             'attribute; requires Omni Automation')
+
+    parser.add_argument(
+        '--from-snapshot',
+        help='read OmniFocus projects and tasks from the FILE written by '
+             'the snapshot command, instead of from OmniFocus; changes are '
+             'written into the --pending-writes file instead of into '
+             'OmniFocus',
+        metavar='FILE')
+
+    parser.add_argument(
+        '--out',
+        help='the FILE to write the snapshot into, with the snapshot '
+             'command',
+        metavar='FILE')
+
+    parser.add_argument(
+        '--pending-writes',
+        help='the FILE to append the changes to write into OmniFocus into, '
+             'with --from-snapshot, and to apply them from before writing '
+             'the snapshot, with the snapshot command (default: the '
+             'snapshot file with the "%s" suffix)'
+             % (omnifocusfile.PENDING_WRITES_SUFFIX,),
+        metavar='FILE')
+
+    parser.add_argument(
+        '--ofocus-cache-file', default=default_ofocus_cache_file,
+        help='the file caching the state read from the --ofocus-bundle, '
+             'to read only new transactions (default: %(default)s)',
+        metavar='FILE')
+
+    parser.add_argument(
+        '-f', '--full', action='store_true',
+        help='synchronize all projects, including those unmodified since '
+             'the last sync')
+
+    parser.add_argument(
+        '--tag-grace-period', default=TAG_GRACE_PERIOD_DAYS, type=int,
+        help='the number of days during which unused AgileZen tags are '
+             'kept before being deleted (default: %(default)i)',
+        metavar='DAYS')
+
+    parser.add_argument(
+        '--archive', default=ARCHIVE_FULL, choices=ARCHIVE_MODES,
+        help='how to synchronize the stories in the archive phase: like '
+             'all other stories, or without reading their tasks, only to '
+             'complete their projects (default: %(default)s)')
+
+    parser.add_argument(
+        '--archive-interval', default=0, type=int,
+        help='the minimum number of seconds between two listings of the '
+             'stories in the archive phase, which are otherwise assumed '
+             'unmodified (default: %(default)i, i.e. at every sync)',
+        metavar='SECONDS')
+
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='print the operations to synchronize OmniFocus and AgileZen '
+             'and their estimated number of calls, without executing them')
+
+    daemon_group = parser.add_argument_group(
+        'daemon arguments',
+        'options to keep synchronizing periodically')
+
+    daemon_group.add_argument(
+        '--daemon', action='store_true',
+        help='keep running and synchronize every --interval seconds, or '
+             'immediately on SIGUSR1, until SIGTERM or SIGINT')
+
+    daemon_group.add_argument(
+        '--interval', default=300, type=int,
+        help='the number of seconds between synchronizations in daemon '
+             'mode (default: %(default)i)',
+        metavar='SECONDS')
+
+    daemon_group.add_argument(
+        '--pid-file', default=default_pid_file,
+        help='the file containing the process ID of the running daemon '
+             '(default: %(default)s)',
+        metavar='FILE')
+
+    daemon_group.add_argument(
+        '--once-now', action='store_true',
+        help='make the running daemon synchronize immediately, by sending '
+             'it SIGUSR1, and exit')
+
     troubleshooting_group = parser.add_argument_group(
         'optional troubleshooting arguments',
         'options not intended for general use')
@@ -577,6 +1817,20 @@ Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
         help='turn on verbose debugging logging to the standard output '
              '(default: off)')
 
+    troubleshooting_group.add_argument(
+        '--profile', nargs='?', const=default_profile_file,
+        help='print a summary of the Apple Events, HTTP requests, and time '
+             'spent in every stage of synchronizations and for every story, '
+             'and write a detailed JSON report into FILE '
+             '(default: %s)' % (default_profile_file,),
+        metavar='FILE')
+
+    troubleshooting_group.add_argument(
+        '--profile-pstats',
+        help='write cProfile statistics of synchronizations into FILE, '
+             'to be read with the pstats module',
+        metavar='FILE')
+
     troubleshooting_group.add_argument(
         '--api-base-url', default=AGILEZEN_API_BASE_URL,
         help='the base URL of the AgileZen API (default: %(default)s)',
@@ -594,7 +1848,64 @@ Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    az_project_id = options.project
+    if options.once_now:
+        with open(options.pid_file) as f:
+            os.kill(int(f.readline()), signal.SIGUSR1)
+        return
+
+    if options.boards_file is not None:
+        if options.project is not None:
+            parser.error('argument -p/--project: not allowed with argument '
+                         '-b/--boards-file')
+        az_boards = boards.read_boards(options.boards_file)
+    elif options.project is None and options.command == COMMAND_SYNC:
+        parser.error('argument -p/--project or -b/--boards-file is required')
+    else:
+        az_boards = None
+
+    if options.ofocus_bundle is not None and options.ofocus_script:
+        parser.error('argument --ofocus-script: not allowed with argument '
+                     '--ofocus-bundle')
+    if options.from_snapshot is not None:
+        if options.ofocus_bundle is not None or options.ofocus_script:
+            parser.error('argument --from-snapshot: not allowed with '
+                         'arguments --ofocus-bundle and --ofocus-script')
+        if options.command == COMMAND_SNAPSHOT:
+            parser.error('argument --from-snapshot: not allowed with '
+                         'command snapshot')
+    elif (options.pending_writes is not None
+          and options.command != COMMAND_SNAPSHOT):
+        parser.error('argument --pending-writes: requires argument '
+                     '--from-snapshot or command snapshot')
+
+    if options.command == COMMAND_SNAPSHOT:
+        if options.out is None:
+            parser.error('argument --out is required by command snapshot')
+        if az_boards is None:
+            selectors = [boards.is_project_scheduled]
+        else:
+            selectors = [board.of_project_selector for board in az_boards]
+        omnifocus_app, omnifocus_dao = make_omnifocus_dao(options)
+        # Apply the changes of the synchronizations of the previous
+        # snapshot, so that they are in this snapshot.
+        omnifocusfile.apply_pending_writes(omnifocus_dao,
+                                           get_pending_writes_path(options))
+        count = omnifocusfile.write_snapshot(
+            omnifocus_dao.take_snapshot(), options.out,
+            lambda proj: any(selector(proj) for selector in selectors))
+        LOG.info('wrote %i OmniFocus projects into file "%s"', count,
+                 options.out)
+        return
+
+    cache_ttls = dict(agilezen.DEFAULT_CACHE_TTLS)
+    for cache_ttl in options.cache_ttl:
+        endpoint, _, seconds = cache_ttl.rpartition('=')
+        try:
+            cache_ttls[endpoint] = int(seconds)
+        except ValueError:
+            parser.error('argument --cache-ttl: invalid value: %r'
+                         % (cache_ttl,))
+
     az_api_key = None
     with open(options.api_key_file) as f:
         for line in f:
@@ -605,36 +1916,115 @@ Pikpoint home page: <https://github.com/rlenglet/pikpoint>''')
         raise ValueError('invalid key file "%s"' % (options.api_key_file,))
     verify_ssl_cert = not options.disable_verify_ssl_cert
 
-    LOG.info('syncing to AgileZen project ID %i', az_project_id)
+    if az_boards is None:
+        LOG.info('syncing to AgileZen project ID %i', options.project)
+    else:
+        LOG.info('syncing to AgileZen project IDs %s', ', '.join(
+                [str(board.az_project_id) for board in az_boards]))
     LOG.debug('syncing to URL "%s" using AgileZen API key "%s"',
               options.api_base_url, az_api_key)
     LOG.debug('projects are due soon in %i days', options.due_soon)
 
-    start_time = datetime.datetime.now()
-
-    omnifocus_app = appscript.app(name='OmniFocus')
-    if not omnifocus_app.isrunning():
-        LOG.error('OmniFocus is not running')
-        raise IOError('OmniFocus is not running')
-    omnifocus_dao = omnifocus.OmniFocusDataAccess(omnifocus_app)
+    profiler = profiling.Profiler() if options.profile else None
+    omnifocus_app, omnifocus_dao = make_omnifocus_dao(options, profiler)
 
+    cache = None
+    if not options.no_cache:
+        cache = httpcache.ResponseCache(options.cache_file)
     agilezen_dao = agilezen.AgileZenDataAccess(
-        options.api_base_url, az_api_key, page_size=100,
-        verify_ssl_cert=verify_ssl_cert)
+        options.api_base_url, az_api_key, page_size=options.page_size,
+        verify_ssl_cert=verify_ssl_cert, jobs=options.jobs,
+        max_concurrent_pages=options.concurrent_pages,
+        rate_limit=options.rate_limit, max_retries=options.max_retries,
+        profiler=profiler, cache=cache, cache_ttls=cache_ttls)
+
+    state_store = syncstate.SyncStateStore(options.state_file)
 
     sync = OmniFocusToAgileZenSync(omnifocus_dao, agilezen_dao,
-                                   due_soon_days=options.due_soon)
-    sync.sync_projects(
+                                   due_soon_days=options.due_soon,
+                                   state_store=state_store,
+                                   profiler=profiler,
+                                   archive_mode=options.archive,
+                                   archive_interval=options.archive_interval,
+                                   tag_grace_period_days=(
+                                       options.tag_grace_period))
+    if az_boards is None:
+        of_color_picker = (
+            lambda proj: 'blue' if proj.full_context_name.startswith('VMware')
+                                else 'green')
         # Ignore projects that are dropped or not yet scheduled.
-        lambda proj: proj.status != appscript.k.dropped
-                     and (proj.start_date is None
-                          or proj.start_date < datetime.datetime.now()),
-        lambda proj: 'blue' if proj.full_context_name.startswith('VMware')
-                            else 'green',
-        az_project_id, owner_username=options.owner)
-
-    end_time = datetime.datetime.now()
-    LOG.debug('sync completed in %s', end_time - start_time)
+        az_boards = [boards.Board(str(options.project), options.project,
+                                  boards.is_project_scheduled,
+                                  of_color_picker, options.owner)]
+
+    def sync_once():
+        if options.dry_run:
+            # Read OmniFocus only once for all boards.
+            of_snapshot = omnifocus_dao.take_snapshot()
+            for board in az_boards:
+                plan = sync.plan_sync(board.of_project_selector,
+                                      board.of_color_picker,
+                                      board.az_project_id,
+                                      owner_username=board.owner_username,
+                                      full=options.full,
+                                      of_snapshot=of_snapshot)
+                if len(az_boards) > 1:
+                    sys.stdout.write('board "%s":\n' % (board.name,))
+                plan.dump(sys.stdout)
+        elif len(az_boards) > 1:
+            sync.sync_boards(az_boards, full=options.full)
+        else:
+            board = az_boards[0]
+            sync.sync_projects(board.of_project_selector,
+                               board.of_color_picker, board.az_project_id,
+                               owner_username=board.owner_username,
+                               full=options.full)
+
+    def run_cycle():
+        start_time = datetime.datetime.now()
+        if (options.ofocus_bundle is None and options.from_snapshot is None
+            and not omnifocus_app.isrunning()):
+            LOG.error('OmniFocus is not running')
+            raise IOError('OmniFocus is not running')
+        if profiler is not None:
+            profiler.reset()
+        if cache is not None:
+            cache.reset_stats()
+        omnifocus_dao.obj_cache.reset_stats()
+        try:
+            if options.profile_pstats:
+                python_profiler = cProfile.Profile()
+                try:
+                    python_profiler.runcall(sync_once)
+                finally:
+                    python_profiler.dump_stats(options.profile_pstats)
+            else:
+                sync_once()
+        finally:
+            # Report the costs of failed cycles too.
+            if profiler is not None:
+                profiler.dump(sys.stderr)
+                profiler.dump_json(options.profile)
+        end_time = datetime.datetime.now()
+        LOG.debug('sync completed in %s', end_time - start_time)
+        if cache is not None:
+            LOG.debug('AgileZen responses: %(hits)i cached, '
+                      '%(revalidations)i revalidated, %(misses)i not cached',
+                      cache.get_stats())
+        LOG.debug('OmniFocus objects: %(hits)i cached, %(misses)i not cached, '
+                  '%(evictions)i evicted, %(size)i in cache; attributes: '
+                  '%(attr_hits)i cached, %(attr_misses)i read',
+                  omnifocus_dao.obj_cache.get_stats())
+
+    try:
+        if options.daemon:
+            run_daemon(run_cycle, options.interval, options.pid_file)
+        else:
+            run_cycle()
+    finally:
+        state_store.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
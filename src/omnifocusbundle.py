@@ -0,0 +1,380 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import cPickle
+import logging
+import os
+import xml.etree.cElementTree as ElementTree
+import zipfile
+
+import omnifocus
+
+
+LOG = logging.getLogger('omnifocusbundle')
+
+# The name of the XML document in every transaction file.
+CONTENTS_NAME = 'contents.xml'
+
+# The version of the format of cached states.  Cached states of other
+# versions are ignored.
+CACHE_VERSION = 2
+
+# The names of the elements of the objects folded into the state of
+# the database.  Other elements, e.g. settings, are ignored.
+OBJECT_ELEMENT_NAMES = ('context', 'folder', 'task')
+
+# The statuses of projects, by name in transactions.
+_PROJECT_STATUSES = {
+    'active': omnifocus.STATUS_ACTIVE,
+    'inactive': omnifocus.STATUS_ON_HOLD,
+    'done': omnifocus.STATUS_DONE,
+    'dropped': omnifocus.STATUS_DROPPED,
+    }
+
+
+def _get_local_name(tag):
+    """Gets the name of an XML element without its namespace.
+    """
+    return tag.rpartition('}')[2]
+
+
+def _get_note_text(elem):
+    """Gets the plain text of a rich text note element.
+
+    Args:
+        elem: The note element, which paragraphs are "p" elements
+            containing "lit" elements.
+
+    Returns:
+        The text of the paragraphs, separated with newlines.
+    """
+    paragraphs = [''.join([lit.text or '' for lit in p.iter()
+                           if _get_local_name(lit.tag) == 'lit'])
+                  for p in elem.iter() if _get_local_name(p.tag) == 'p']
+    if not paragraphs:
+        return (elem.text or '').strip()
+    return '\n'.join(paragraphs)
+
+
+def _parse_record(elem):
+    """Converts the element of an object into a dict of its fields.
+
+    The fields are the texts of the child elements, by element name,
+    except for references to other objects, which IDs are the values
+    of the "<name>_id" fields, e.g. "context_id", or None for empty
+    references, e.g. '<context idref=""/>'.  The "project" element of
+    a project is converted into a nested dict, and the empty "project"
+    element of other tasks is ignored.
+
+    Args:
+        elem: The XML element of the object.
+
+    Returns:
+        The dict of the object's fields.
+    """
+    record = {}
+    for child in elem:
+        name = _get_local_name(child.tag)
+        idref = child.get('idref')
+        if idref is not None:
+            record[name + '_id'] = idref or None
+        elif name == 'note':
+            record[name] = _get_note_text(child)
+        elif name == 'project':
+            if len(child):
+                record[name] = _parse_record(child)
+        else:
+            record[name] = child.text
+    return record
+
+
+def _iter_elements(f):
+    """Parses a transaction's XML document incrementally.
+
+    The elements are freed as soon as they are parsed, so that the
+    whole document is never held in memory.
+
+    Args:
+        f: The file object of the XML document.
+
+    Returns:
+        An iterator over the top-level elements of the document.
+    """
+    depth = 0
+    root = None
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield elem
+                root.clear()
+
+
+def apply_transaction(objects, f):
+    """Applies a transaction to the state of a database.
+
+    Every object element without an "op" attribute inserts an object,
+    "update" replaces it, and "delete" deletes it.
+
+    Args:
+        objects: The dict of the dicts of object fields by object ID,
+            by element name, e.g. "task", as returned by
+            _parse_record.
+        f: The file object of the transaction's XML document.
+    """
+    for elem in _iter_elements(f):
+        records = objects.get(_get_local_name(elem.tag))
+        if records is None:
+            continue
+        obj_id = elem.get('id')
+        op = elem.get('op')
+        if op == 'delete':
+            records.pop(obj_id, None)
+        elif op is None or op == 'update':
+            records[obj_id] = _parse_record(elem)
+
+
+def _get_rank(record):
+    try:
+        return int(record.get('rank') or 0)
+    except ValueError:
+        return 0
+
+
+class OmniFocusBundleDataAccess(omnifocus.OmniFocusSnapshotDataAccess):
+    """Reads OmniFocus's database directly from its bundle on disk.
+
+    OmniFocus stores its database as a bundle directory of zipped XML
+    transaction files, named after their timestamps, which are applied
+    in order.  The state folded from the transactions is cached in a
+    file, with the names of the applied transactions, so that only
+    new transactions are parsed at every pass.
+
+    Reads require no Apple Events, and are possible without OmniFocus
+    or appscript, e.g. on other systems than Mac OS X.  Writes are sent
+    with Apple Events to the OmniFocus application, if any.
+    """
+
+    def __init__(self, bundle_path, app=None, cache_path=None,
+                 profiler=None):
+        """Initialize this DAO to read the given bundle.
+
+        Args:
+            bundle_path: The path of the .ofocus bundle directory.
+            app: The appscript app object to use to write into
+                OmniFocus.  Defaults to None, i.e. OmniFocus can't be
+                written into.
+            cache_path: The path of the file caching the database's
+                state.  Defaults to None, i.e. the state is cached only
+                in memory.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+        """
+        omnifocus.OmniFocusSnapshotDataAccess.__init__(self, app,
+                                                       profiler=profiler)
+        self.bundle_path = bundle_path
+        self.cache_path = cache_path
+        # The names of the applied transactions, in order, and the
+        # state folded from them.
+        self._transactions = None
+        self._objects = None
+
+    @staticmethod
+    def _new_objects():
+        return dict([(name, {}) for name in OBJECT_ELEMENT_NAMES])
+
+    def _list_transactions(self):
+        """Lists the transactions of the bundle, in order.
+
+        Returns:
+            The sorted list of the names of the transaction files.
+        """
+        return sorted([name for name in os.listdir(self.bundle_path)
+                       if name.endswith('.zip')])
+
+    def _read_cache(self):
+        """Reads the cached state, if any.
+        """
+        self._transactions = []
+        self._objects = self._new_objects()
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as f:
+                version, bundle_path, transactions, objects = cPickle.load(f)
+        except Exception, e:
+            LOG.warning('ignoring invalid cache file "%s": %s',
+                        self.cache_path, e)
+            return
+        if version == CACHE_VERSION and bundle_path == self.bundle_path:
+            self._transactions = transactions
+            self._objects = objects
+
+    def _write_cache(self):
+        """Writes the state into the cache file, if any.
+        """
+        if self.cache_path is None:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump((CACHE_VERSION, self.bundle_path,
+                              self._transactions, self._objects),
+                             f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError), e:
+            LOG.warning('failed to write cache file "%s": %s',
+                        self.cache_path, e)
+
+    def _apply_transaction(self, name):
+        with zipfile.ZipFile(os.path.join(self.bundle_path, name)) as z:
+            with z.open(CONTENTS_NAME) as f:
+                apply_transaction(self._objects, f)
+
+    def _load(self):
+        """Applies the new transactions of the bundle to the state.
+
+        If the applied transactions are not all still in the bundle,
+        e.g. because OmniFocus compacted its database, or if new
+        transactions precede applied ones, e.g. after a sync with
+        another device, all the transactions are applied again.
+
+        Returns:
+            True if the state was modified, False otherwise.
+        """
+        transactions = self._list_transactions()
+        if self._objects is None:
+            self._read_cache()
+        applied = set(self._transactions)
+        new_transactions = [name for name in transactions
+                            if name not in applied]
+        if (not applied.issubset(transactions)
+            or (new_transactions and self._transactions
+                and new_transactions[0] < self._transactions[-1])):
+            LOG.info('OmniFocus database compacted or merged, reading all '
+                     'transactions')
+            self._transactions = []
+            self._objects = self._new_objects()
+            new_transactions = transactions
+        if not new_transactions:
+            return False
+        LOG.debug('applying %i OmniFocus transactions',
+                  len(new_transactions))
+        for name in new_transactions:
+            self._apply_transaction(name)
+        self._transactions.extend(new_transactions)
+        self._write_cache()
+        return True
+
+    def _build_snapshot(self):
+        """Builds the snapshot of the projects and tasks of the state.
+
+        Returns:
+            An omnifocus.OmniFocusSnapshot object.
+        """
+        contexts = self._objects['context']
+        folders = self._objects['folder']
+        tasks = self._objects['task']
+        index = omnifocus.HierarchyIndex(
+            dict([(obj_id, (record.get('name') or '',
+                            record.get('context_id')))
+                  for obj_id, record in contexts.iteritems()]),
+            dict([(obj_id, (record.get('name') or '',
+                            record.get('folder_id')))
+                  for obj_id, record in folders.iteritems()]))
+
+        # Order projects like OmniFocus, i.e. by the ranks of their
+        # folders then by their own ranks.
+        folder_ranks = {}
+
+        def get_folder_ranks(folder_id):
+            ranks = folder_ranks.get(folder_id)
+            if ranks is None:
+                record = folders.get(folder_id)
+                if record is None:
+                    ranks = ()
+                else:
+                    ranks = (get_folder_ranks(record.get('folder_id'))
+                             + (_get_rank(record),))
+                folder_ranks[folder_id] = ranks
+            return ranks
+
+        project_records = sorted(
+            [(obj_id, record) for obj_id, record in tasks.iteritems()
+             if 'project' in record],
+            key=lambda (obj_id, record): (
+                get_folder_ranks(record['project'].get('folder_id')),
+                _get_rank(record)))
+        projects = collections.OrderedDict()
+        for obj_id, record in project_records:
+            folder_id = record['project'].get('folder_id')
+            context_id = record.get('context_id')
+            projects[obj_id] = omnifocus.Project(
+                obj_id,
+                record.get('name') or '',
+                record.get('note') or '',
+                _PROJECT_STATUSES.get(record['project'].get('status'),
+                                      omnifocus.STATUS_ACTIVE),
+                record.get('completed') is not None,
+                omnifocus.parse_time(record.get('start')),
+                omnifocus.parse_time(record.get('due')),
+                omnifocus.parse_time(record.get('modified')
+                                     or record.get('added')),
+                folder_id,
+                context_id,
+                index.get_full_folder_name(folder_id),
+                index.get_full_context_name(context_id),
+                index.get_all_full_context_names(context_id))
+
+        # Only the tasks directly in projects are returned, not
+        # sub-tasks.  A project is its own root task.
+        project_tasks = collections.defaultdict(list)
+        for obj_id, record in sorted(
+                tasks.iteritems(),
+                key=lambda (obj_id, record): _get_rank(record)):
+            project_id = record.get('task_id')
+            if 'project' in record or project_id not in projects:
+                continue
+            context_id = record.get('context_id')
+            project_tasks[project_id].append(omnifocus.Task(
+                obj_id,
+                record.get('name') or '',
+                record.get('note') or '',
+                record.get('completed') is not None,
+                omnifocus.parse_time(record.get('start')),
+                omnifocus.parse_time(record.get('due')),
+                omnifocus.parse_time(record.get('modified')
+                                     or record.get('added')),
+                project_id,
+                project_id,
+                context_id,
+                index.get_full_context_name(context_id),
+                index.get_all_full_context_names(context_id)))
+        return omnifocus.OmniFocusSnapshot(index, projects,
+                                           dict(project_tasks))
+
+    def _read_snapshot(self, snapshot):
+        if self._load() or snapshot is None:
+            return self._build_snapshot()
+        return snapshot
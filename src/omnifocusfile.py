@@ -0,0 +1,366 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import json
+import logging
+import os
+import time
+
+import omnifocus
+import omnifocusscript
+
+
+LOG = logging.getLogger('omnifocusfile')
+
+# The version of the format of snapshot files.  In version 1, dates
+# were in UTC, and were converted into the local time of the reading
+# host.  In version 2, dates are in the local time of the writing
+# host.  Files of other versions can't be read.
+SNAPSHOT_VERSION = 2
+
+# The suffix of the default path of the file of the pending writes of
+# a snapshot file.
+PENDING_WRITES_SUFFIX = '.pending'
+
+# The exported names of the statuses of projects.
+_STATUS_NAMES = dict([(status, name) for name, status
+                      in omnifocusscript.PROJECT_STATUSES.iteritems()])
+
+
+def _select_hierarchy(items, item_ids):
+    """Selects items in a hierarchy, and all their ancestors.
+
+    Args:
+        items: A dict which keys are item IDs and values are tuples
+            (name, parent_id), as in a HierarchyIndex.
+        item_ids: The iterable of the IDs of the items to select.
+
+    Returns:
+        The list of the arrays [id, name, parent_id] of the selected
+        items, in the order of the fields of
+        omnifocusscript.CONTEXT_FIELDS and FOLDER_FIELDS.
+    """
+    selected = {}
+    for item_id in item_ids:
+        while item_id in items and item_id not in selected:
+            name, parent_id = items[item_id]
+            selected[item_id] = [item_id, name, parent_id]
+            item_id = parent_id
+    return [selected[item_id] for item_id in sorted(selected)]
+
+
+def format_local_time(date):
+    """Formats a datetime in local time, with its offset from UTC.
+
+    Args:
+        date: The naive datetime in local time, or None.
+
+    Returns:
+        The timestamp, e.g. "2012-09-01T10:30:00+09:00", or None.
+    """
+    if date is None:
+        return None
+    offset = date - datetime.datetime.utcfromtimestamp(
+        time.mktime(date.timetuple()))
+    minutes = int(offset.total_seconds()) // 60
+    sign = '+' if minutes >= 0 else '-'
+    return '%s%s%02i:%02i' % (date.strftime(omnifocus.TIME_FORMAT), sign,
+                              abs(minutes) // 60, abs(minutes) % 60)
+
+
+def parse_local_time(text):
+    """Parses a timestamp formatted by format_local_time.
+
+    The local time of the writing host is restored, whatever the time
+    zone of the reading host, so that the snapshot is synchronized the
+    same way on every host.
+
+    Args:
+        text: The timestamp, or None.
+
+    Returns:
+        The naive datetime in the local time of the writing host, or
+        None.
+    """
+    if not text:
+        return None
+    return datetime.datetime.strptime(text[:19], omnifocus.TIME_FORMAT)
+
+
+def _to_values(fields, record):
+    """Converts a dict of fields into an array, in the order of fields.
+    """
+    return [record[name] for name, _ in fields]
+
+
+def write_snapshot(snapshot, path, selector):
+    """Writes the selected projects of a snapshot into a file.
+
+    The file contains the selected projects, the tasks of those
+    projects, and the contexts and folders they are in, in the format
+    of the exports of omnifocusscript, with a version number.  Dates
+    are in local time, as formatted by format_local_time.
+
+    Args:
+        snapshot: The omnifocus.OmniFocusSnapshot to write.
+        path: The path of the file to write.
+        selector: A callable taking a project object, and returns
+            True or False whether the project must be written.
+
+    Returns:
+        The number of written projects.
+
+    Raises:
+        IOError: The file can't be written.
+    """
+    projects = []
+    tasks = []
+    context_ids = set()
+    folder_ids = set()
+    for project in snapshot.projects.itervalues():
+        if not selector(project):
+            continue
+        # The project is its own root task, so that its tasks'
+        # parent_task_id is the project's ID.
+        projects.append(_to_values(omnifocusscript.PROJECT_FIELDS, {
+                    'id': project.id,
+                    'name': project.name,
+                    'note': project.note,
+                    'status': _STATUS_NAMES[project.status],
+                    'completed': project.completed,
+                    'start_date': format_local_time(project.start_date),
+                    'due_date': format_local_time(project.due_date),
+                    'modification_date': format_local_time(
+                        project.modification_date),
+                    'container_id': project.container_id,
+                    'context_id': project.context_id,
+                    'root_task_id': project.id,
+                    }))
+        folder_ids.add(project.container_id)
+        context_ids.add(project.context_id)
+        # Notes of tasks are not synchronized, and are not written.
+        for task in snapshot.project_tasks.get(project.id, ()):
+            tasks.append(_to_values(omnifocusscript.TASK_FIELDS, {
+                        'id': task.id,
+                        'name': task.name,
+                        'note': None,
+                        'completed': task.completed,
+                        'start_date': format_local_time(task.start_date),
+                        'due_date': format_local_time(task.due_date),
+                        'modification_date': format_local_time(
+                            task.modification_date),
+                        'containing_project_id': project.id,
+                        'parent_task_id': project.id,
+                        'context_id': task.context_id,
+                        }))
+            context_ids.add(task.context_id)
+    export = {
+        'version': SNAPSHOT_VERSION,
+        'contexts': _select_hierarchy(snapshot.index.contexts, context_ids),
+        'folders': _select_hierarchy(snapshot.index.folders, folder_ids),
+        'projects': projects,
+        'tasks': tasks,
+        }
+    # Replace the file atomically, as it may be read concurrently,
+    # e.g. by a daemon.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        json.dump(export, f, separators=(',', ':'))
+    os.rename(tmp_path, path)
+    LOG.debug('wrote %i projects and %i tasks into file "%s"',
+              len(projects), len(tasks), path)
+    return len(projects)
+
+
+def read_snapshot(path):
+    """Reads a snapshot from a file written by write_snapshot.
+
+    Args:
+        path: The path of the file to read.
+
+    Returns:
+        An omnifocus.OmniFocusSnapshot object.
+
+    Raises:
+        IOError: The file can't be read.
+        ValueError: The file is not a valid snapshot.
+    """
+    with open(path, 'rb') as f:
+        export = json.load(f)
+    version = export.get('version')
+    if version == 1:
+        return omnifocusscript.make_snapshot(export)
+    elif version != SNAPSHOT_VERSION:
+        raise ValueError('unsupported version %r of snapshot file "%s", '
+                         'must be %i' % (version, path, SNAPSHOT_VERSION))
+    return omnifocusscript.make_snapshot(export, parse_local_time)
+
+
+def append_pending_write(path, write):
+    """Appends a write into OmniFocus into a file of pending writes.
+
+    Every write is appended as one line of JSON, so that writes can be
+    appended by several synchronizations before they are applied.
+
+    Args:
+        path: The path of the file of pending writes.
+        write: The omnifocus.AppliedWrite to append.
+
+    Raises:
+        IOError: The file can't be written.
+    """
+    value = write.value
+    if write.name == 'status':
+        value = _STATUS_NAMES[value]
+    line = json.dumps({
+            'elements': write.elements_name,
+            'name': write.name,
+            'value': value,
+            'ids': list(write.obj_ids),
+            }, separators=(',', ':'))
+    with open(path, 'ab') as f:
+        f.write(line + '\n')
+
+
+def read_pending_writes(path):
+    """Reads the writes appended into a file by append_pending_write.
+
+    Args:
+        path: The path of the file of pending writes.
+
+    Returns:
+        The list of the omnifocus.AppliedWrite objects of the writes,
+        in the order they were appended.
+
+    Raises:
+        IOError: The file can't be read.
+        ValueError: The file is not a valid file of pending writes.
+    """
+    writes = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            value = record['value']
+            if record['name'] == 'status':
+                value = omnifocusscript.PROJECT_STATUSES[value]
+            writes.append(omnifocus.AppliedWrite(
+                    str(record['elements']), str(record['name']), value,
+                    record['ids']))
+    return writes
+
+
+def apply_pending_writes(omnifocus_dao, path):
+    """Applies the writes of a file of pending writes into OmniFocus.
+
+    The file is renamed while the writes are applied, so that the
+    writes appended concurrently are applied next time.  The writes
+    that fail are appended back into the file, to be applied again
+    next time.
+
+    Args:
+        omnifocus_dao: The OmniFocusDataAccess object to use to write
+            into OmniFocus.
+        path: The path of the file of pending writes.  It doesn't
+            need to exist.
+
+    Returns:
+        The number of applied writes.
+
+    Raises:
+        IOError: The file can't be read or written.
+    """
+    applying_path = path + '.applying'
+    # A file left by an interrupted call is applied again.
+    if not os.path.exists(applying_path):
+        if not os.path.exists(path):
+            return 0
+        os.rename(path, applying_path)
+    applied = 0
+    for write in read_pending_writes(applying_path):
+        try:
+            if omnifocus_dao.set_objects_attr(write.elements_name,
+                                              write.obj_ids, write.name,
+                                              write.value):
+                LOG.info('set %s of %i OmniFocus %s to %r', write.name,
+                         len(write.obj_ids),
+                         write.elements_name.replace('flattened_', ''),
+                         write.value)
+                applied += 1
+                continue
+        except Exception:
+            LOG.exception('failed to set %s of %i objects', write.name,
+                          len(write.obj_ids))
+        append_pending_write(path, write)
+    os.remove(applying_path)
+    return applied
+
+
+class OmniFocusFileDataAccess(omnifocus.OmniFocusSnapshotDataAccess):
+    """Reads OmniFocus projects and tasks from a snapshot file.
+
+    The snapshot file is written by write_snapshot, e.g. on the Mac
+    running OmniFocus, and can be read on any other host.  It is read
+    again at every pass if it was modified.  Writes are sent with
+    Apple Events to the OmniFocus application, if any, or else are
+    appended into a file of pending writes, if any, to be applied by
+    apply_pending_writes, e.g. on the Mac running OmniFocus.
+    """
+
+    def __init__(self, path, app=None, profiler=None,
+                 pending_writes_path=None):
+        """Initialize this DAO to read the given file.
+
+        Args:
+            path: The path of the snapshot file.
+            app: The appscript app object to use to write into
+                OmniFocus.  Defaults to None, i.e. OmniFocus can't be
+                written into.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+            pending_writes_path: The path of the file to append the
+                writes into, if app is None.  Defaults to None, i.e.
+                the writes fail.
+        """
+        omnifocus.OmniFocusSnapshotDataAccess.__init__(self, app,
+                                                       profiler=profiler)
+        self.path = path
+        self.pending_writes_path = pending_writes_path
+        self._mtime = None
+
+    def _read_snapshot(self, snapshot):
+        mtime = os.stat(self.path).st_mtime
+        if snapshot is not None and mtime == self._mtime:
+            return snapshot
+        snapshot = read_snapshot(self.path)
+        self._mtime = mtime
+        return snapshot
+
+    def set_objects_attr(self, elements_name, obj_ids, name, value):
+        if self.app is not None or self.pending_writes_path is None:
+            return omnifocus.OmniFocusSnapshotDataAccess.set_objects_attr(
+                self, elements_name, obj_ids, name, value)
+        append_pending_write(self.pending_writes_path, omnifocus.AppliedWrite(
+                elements_name, name, value, obj_ids))
+        LOG.info('OmniFocus is not running, deferred setting %s of %i '
+                 'objects into file "%s"', name, len(obj_ids),
+                 self.pending_writes_path)
+        return True
@@ -0,0 +1,280 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import json
+import logging
+import time
+
+import omnifocus
+
+
+LOG = logging.getLogger('omnifocusscript')
+
+# The exported fields of every kind of objects, as tuples (name,
+# expression), where expression is the JavaScript expression of the
+# field's value for an object "o".  Objects are exported as arrays of
+# their fields' values, in this order.
+CONTEXT_FIELDS = (
+    ('id', 'ref(o)'),
+    ('name', 'o.name'),
+    ('parent_id', 'ref(o.parent)'),
+    )
+
+FOLDER_FIELDS = (
+    ('id', 'ref(o)'),
+    ('name', 'o.name'),
+    ('parent_id', 'ref(o.parent)'),
+    )
+
+PROJECT_FIELDS = (
+    ('id', 'ref(o)'),
+    ('name', 'o.name'),
+    ('note', 'o.note'),
+    ('status', 'status(o)'),
+    ('completed', 'o.task.completed'),
+    ('start_date', 'time(o.deferDate)'),
+    ('due_date', 'time(o.dueDate)'),
+    ('modification_date', 'time(o.task.modified)'),
+    ('container_id', 'ref(o.parentFolder)'),
+    ('context_id', 'ref(first(o.tags))'),
+    ('root_task_id', 'ref(o.task)'),
+    )
+
+TASK_FIELDS = (
+    ('id', 'ref(o)'),
+    ('name', 'o.name'),
+    ('note', 'o.note'),
+    ('completed', 'o.completed'),
+    ('start_date', 'time(o.deferDate)'),
+    ('due_date', 'time(o.dueDate)'),
+    ('modification_date', 'time(o.modified)'),
+    ('containing_project_id', 'ref(o.containingProject)'),
+    ('parent_task_id', 'ref(o.parent)'),
+    ('context_id', 'ref(first(o.tags))'),
+    )
+
+# The exported kinds of objects, as tuples (name, collection, fields),
+# where collection is the JavaScript expression of the flattened list
+# of all the objects of that kind.  Contexts are tags in Omni
+# Automation.
+EXPORTED_OBJECTS = (
+    ('contexts', 'flattenedTags', CONTEXT_FIELDS),
+    ('folders', 'flattenedFolders', FOLDER_FIELDS),
+    ('projects', 'flattenedProjects', PROJECT_FIELDS),
+    ('tasks', 'flattenedTasks', TASK_FIELDS),
+    )
+
+# The statuses of projects, by exported name.
+PROJECT_STATUSES = {
+    'active': omnifocus.STATUS_ACTIVE,
+    'on_hold': omnifocus.STATUS_ON_HOLD,
+    'done': omnifocus.STATUS_DONE,
+    'dropped': omnifocus.STATUS_DROPPED,
+    }
+
+_SCRIPT_HEADER = '''\
+(function () {
+    function ref(o) { return o ? o.id.primaryKey : null; }
+    function time(d) { return d ? d.toISOString() : null; }
+    function first(os) { return os.length > 0 ? os[0] : null; }
+    function status(o) {
+        var s = o.status;
+        return s === Project.Status.Active ? 'active'
+            : s === Project.Status.OnHold ? 'on_hold'
+            : s === Project.Status.Done ? 'done' : 'dropped';
+    }
+    return JSON.stringify({
+'''
+
+_SCRIPT_FOOTER = '''\
+    });
+})()
+'''
+
+
+def make_export_script(exported_objects=EXPORTED_OBJECTS):
+    """Generates the Omni Automation script exporting OmniFocus as JSON.
+
+    The script is evaluated by OmniFocus itself, so all the objects
+    are read with a single Apple Event, whatever their number.  The
+    script's result is a JSON string of an object which keys are the
+    names of the kinds of objects, and values are the lists of the
+    arrays of the objects' fields.
+
+    Args:
+        exported_objects: The exported kinds of objects, as tuples
+            (name, collection, fields).  Defaults to EXPORTED_OBJECTS.
+
+    Returns:
+        The JavaScript source of the script.
+    """
+    lines = []
+    for name, collection, fields in exported_objects:
+        lines.append('        %s: %s.map(function (o) { return [%s]; })'
+                     % (json.dumps(name), collection,
+                        ', '.join(expr for _, expr in fields)))
+    return _SCRIPT_HEADER + ',\n'.join(lines) + '\n' + _SCRIPT_FOOTER
+
+
+def _iter_records(export, name, fields):
+    """Iterates over the exported objects of a kind, as dicts.
+    """
+    names = [field_name for field_name, _ in fields]
+    for values in export.get(name, ()):
+        yield dict(zip(names, values))
+
+
+def load_export(text):
+    """Loads the JSON export of OmniFocus into a snapshot.
+
+    Args:
+        text: The JSON string returned by the export script.
+
+    Returns:
+        An omnifocus.OmniFocusSnapshot object.
+
+    Raises:
+        ValueError: The export is invalid.
+    """
+    return make_snapshot(json.loads(text))
+
+
+def make_snapshot(export, parse_time=omnifocus.parse_time):
+    """Converts an export of OmniFocus into a snapshot.
+
+    Args:
+        export: The dict of the lists of the arrays of the fields of
+            the exported objects, by kind of objects, as decoded from
+            the JSON returned by the export script.
+        parse_time: A callable taking an exported timestamp or None,
+            and returns a naive datetime in local time or None.
+            Defaults to omnifocus.parse_time, for timestamps in UTC.
+
+    Returns:
+        An omnifocus.OmniFocusSnapshot object.
+
+    Raises:
+        ValueError: The export is invalid.
+    """
+    index = omnifocus.HierarchyIndex(
+        dict([(record['id'], (record['name'], record['parent_id']))
+              for record in _iter_records(export, 'contexts',
+                                          CONTEXT_FIELDS)]),
+        dict([(record['id'], (record['name'], record['parent_id']))
+              for record in _iter_records(export, 'folders', FOLDER_FIELDS)]))
+
+    projects = collections.OrderedDict()
+    root_task_project_ids = {}
+    for record in _iter_records(export, 'projects', PROJECT_FIELDS):
+        project_id = record['id']
+        container_id = record['container_id']
+        context_id = record['context_id']
+        root_task_project_ids[record['root_task_id']] = project_id
+        projects[project_id] = omnifocus.Project(
+            project_id,
+            record['name'] or '',
+            record['note'] or '',
+            PROJECT_STATUSES.get(record['status'], omnifocus.STATUS_DROPPED),
+            bool(record['completed']),
+            parse_time(record['start_date']),
+            parse_time(record['due_date']),
+            parse_time(record['modification_date']),
+            container_id,
+            context_id,
+            index.get_full_folder_name(container_id),
+            index.get_full_context_name(context_id),
+            index.get_all_full_context_names(context_id))
+
+    # Only the tasks directly contained in the projects' root tasks are
+    # returned, like OmniFocusDataAccess.get_tasks_by_project.
+    project_tasks = collections.defaultdict(list)
+    for record in _iter_records(export, 'tasks', TASK_FIELDS):
+        task_id = record['id']
+        if task_id in root_task_project_ids:
+            continue  # A project's root task.
+        parent_task_id = record['parent_task_id']
+        if parent_task_id is not None:
+            project_id = root_task_project_ids.get(parent_task_id)
+        else:
+            project_id = record['containing_project_id']
+        if project_id is None:
+            continue
+        context_id = record['context_id']
+        project_tasks[project_id].append(omnifocus.Task(
+            task_id,
+            record['name'] or '',
+            record['note'] or '',
+            bool(record['completed']),
+            parse_time(record['start_date']),
+            parse_time(record['due_date']),
+            parse_time(record['modification_date']),
+            record['containing_project_id'],
+            parent_task_id,
+            context_id,
+            index.get_full_context_name(context_id),
+            index.get_all_full_context_names(context_id)))
+    return omnifocus.OmniFocusSnapshot(index, projects, dict(project_tasks))
+
+
+class OmniFocusScriptDataAccess(omnifocus.OmniFocusSnapshotDataAccess):
+    """Reads OmniFocus with a single script exporting it as JSON.
+
+    Instead of reading every attribute of every kind of objects with
+    its own Apple Event, OmniFocus evaluates a generated script that
+    exports all the objects, and the whole export is read with a
+    single Apple Event.  Writes are still sent with Apple Events.
+    """
+
+    def __init__(self, app, run_script=None, profiler=None):
+        """Initialize this DAO to the given AppleScript application stub.
+
+        Args:
+            app: The appscript app object to use to access
+                OmniFocus. The application must be running.
+            run_script: A callable taking the JavaScript source of a
+                script, and returns the string result of its
+                evaluation by OmniFocus.  Defaults to None, i.e.
+                scripts are evaluated with OmniFocus's "evaluate
+                javascript" command.
+            profiler: The profiling.Profiler to record Apple Events
+                into.  Defaults to None, i.e. no profiling.
+        """
+        omnifocus.OmniFocusSnapshotDataAccess.__init__(self, app,
+                                                       profiler=profiler)
+        if run_script is None:
+            run_script = self._evaluate_javascript
+        self.run_script = run_script
+        self.script = make_export_script()
+
+    def _evaluate_javascript(self, script):
+        """Sends an Apple Event to evaluate a script in OmniFocus.
+        """
+        if self.profiler is None:
+            return self.app.evaluate_javascript(script)
+        start_time = time.time()
+        result = self.app.evaluate_javascript(script)
+        self.profiler.record_apple_event('evaluate', 'javascript',
+                                         time.time() - start_time)
+        return result
+
+    def _read_snapshot(self, snapshot):
+        text = self.run_script(self.script)
+        LOG.debug('read %i bytes of OmniFocus export', len(text))
+        return load_export(text)
@@ -0,0 +1,148 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import Queue
+import sys
+import threading
+
+
+# The interval at which a producer blocked on a full queue checks
+# whether its consumer stopped, in seconds.
+_POLL_INTERVAL = 0.1
+
+# The kinds of the entries of the queues of background iterations.
+_ITEM = 'item'
+_END = 'end'
+_ERROR = 'error'
+
+
+class BackgroundCall(object):
+    """A call of a function in a background thread.
+
+    The function is called as soon as this object is created, and
+    its result is retrieved later, e.g. once other I/O is done in the
+    calling thread.
+    """
+
+    def __init__(self, func, name):
+        """Start calling a function in a new daemon thread.
+
+        Args:
+            func: The callable to call, taking no arguments.
+            name: The name of the thread.
+        """
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(func,),
+                                        name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func):
+        try:
+            self._result = func()
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def wait(self):
+        """Waits for the call to complete, ignoring its result.
+        """
+        self._thread.join()
+
+    def get_result(self):
+        """Waits for the call to complete, and gets its result.
+
+        Returns:
+            The value returned by the function.
+
+        Raises:
+            Exception: The exception raised by the function, if any.
+        """
+        self._thread.join()
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
+        return self._result
+
+
+def iter_in_background(iterable, max_buffered, name):
+    """Iterates over an iterable in a background thread.
+
+    The iteration starts immediately, and up to max_buffered items are
+    read in advance, while the consumer is busy, e.g. with other I/O.
+    The background iteration stops when the returned iterator is
+    closed, e.g. when its consumer fails.
+
+    Args:
+        iterable: The iterable to iterate over.
+        max_buffered: The maximum number of items read in advance.
+        name: The name of the thread.
+
+    Returns:
+        A generator of the items of the iterable, in order.  If the
+        iteration raises an exception, the exception is re-raised
+        after the items read before it are consumed.
+    """
+    entries = Queue.Queue(max(max_buffered, 1))
+    cancelled = threading.Event()
+
+    def put(kind, value):
+        while not cancelled.is_set():
+            try:
+                entries.put((kind, value), timeout=_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(_ITEM, item):
+                    return
+        except Exception:
+            put(_ERROR, sys.exc_info())
+        else:
+            put(_END, None)
+
+    thread = threading.Thread(target=produce, name=name)
+    thread.daemon = True
+    thread.start()
+    return _consume(entries, cancelled)
+
+
+def _consume(entries, cancelled):
+    """Yields the items produced by a background iteration.
+
+    Args:
+        entries: The Queue of (kind, value) tuples of the iteration.
+        cancelled: The Event to set to stop the iteration, once this
+            generator is closed.
+    """
+    try:
+        while True:
+            kind, value = entries.get()
+            if kind == _END:
+                return
+            elif kind == _ERROR:
+                exc_type, exc_value, exc_traceback = value
+                raise exc_type, exc_value, exc_traceback
+            yield value
+    finally:
+        cancelled.set()
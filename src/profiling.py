@@ -0,0 +1,313 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import re
+import threading
+import time
+
+
+LOG = logging.getLogger('profiling')
+
+# The upper bounds of the buckets of the HTTP latency histograms, in
+# milliseconds.  The last bucket contains all greater latencies.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# The number of most expensive stories listed in summaries.
+TOP_SUBJECTS = 10
+
+_ID_PATH_ELEMENT_RE = re.compile(r'(?<=/)\d+(?=/|$)')
+
+
+def get_endpoint_template(path):
+    """Gets the template of an AgileZen API path, without IDs.
+
+    Args:
+        path: The path of a resource, relative to the API's base URL,
+            e.g. "projects/12/stories/345".
+
+    Returns:
+        The path with every numeric element replaced with "{id}",
+        e.g. "projects/{id}/stories/{id}".
+    """
+    return _ID_PATH_ELEMENT_RE.sub('{id}', '/' + path)[1:]
+
+
+class _Stats(object):
+    """The number of calls, time, and bytes of a kind of call.
+    """
+
+    __slots__ = ('count', 'time', 'bytes', 'histogram')
+
+    def __init__(self, with_histogram=False):
+        self.count = 0
+        self.time = 0.0
+        self.bytes = 0
+        self.histogram = ([0] * (len(LATENCY_BUCKETS_MS) + 1)
+                          if with_histogram else None)
+
+    def add(self, elapsed, nbytes=0):
+        self.count += 1
+        self.time += elapsed
+        self.bytes += nbytes
+        if self.histogram is not None:
+            self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS,
+                                              elapsed * 1000.0)] += 1
+
+    def to_json(self):
+        json_obj = {'count': self.count, 'time': self.time}
+        if self.bytes:
+            json_obj['bytes'] = self.bytes
+        if self.histogram is not None:
+            json_obj['histogram'] = dict(
+                [('<=%ims' % (bound,), n) for bound, n
+                 in zip(LATENCY_BUCKETS_MS, self.histogram) if n]
+                + ([('>%ims' % (LATENCY_BUCKETS_MS[-1],),
+                     self.histogram[-1])] if self.histogram[-1] else []))
+        return json_obj
+
+
+class _SubjectStats(object):
+    """The costs attributed to a subject, e.g. an AgileZen story.
+    """
+
+    __slots__ = ('time', 'apple_events', 'apple_event_time', 'http_calls',
+                 'http_time', 'http_bytes')
+
+    def __init__(self):
+        self.time = 0.0
+        self.apple_events = 0
+        self.apple_event_time = 0.0
+        self.http_calls = 0
+        self.http_time = 0.0
+        self.http_bytes = 0
+
+    def to_json(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+
+class Profiler(object):
+    """Collects call counts and timings during synchronizations.
+
+    Apple Events are counted per verb and attribute name, HTTP
+    requests per method and endpoint template, with a histogram of
+    their latencies and the number of bytes they transfer.  Stages,
+    e.g. "fetch", "diff", and "write", are timed separately.  Costs
+    are also attributed to the subject being processed by the calling
+    thread, e.g. a story, to find the most expensive ones.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Forgets all the collected counts and timings.
+        """
+        with self._lock:
+            self.start_time = time.time()
+            # The _Stats of Apple Events, by (verb, attribute name).
+            self.apple_events = collections.defaultdict(_Stats)
+            # The _Stats of HTTP requests, by (method, template).
+            self.http_requests = collections.defaultdict(
+                lambda: _Stats(with_histogram=True))
+            # The total time of every stage, by name, in order.
+            self.stages = collections.OrderedDict()
+            # The _SubjectStats of subjects, by subject.
+            self.subjects = collections.defaultdict(_SubjectStats)
+
+    def _get_subject_stats(self):
+        subject = getattr(self._local, 'subject', None)
+        if subject is None:
+            return None
+        return self.subjects[subject]
+
+    def record_apple_event(self, verb, name, elapsed):
+        """Records an Apple Event.
+
+        Args:
+            verb: The event's verb, i.e. 'get' or 'set'.
+            name: The name of the attribute read or written.
+            elapsed: The time the event took, in seconds.
+        """
+        with self._lock:
+            self.apple_events[(verb, name)].add(elapsed)
+            subject_stats = self._get_subject_stats()
+            if subject_stats is not None:
+                subject_stats.apple_events += 1
+                subject_stats.apple_event_time += elapsed
+
+    def record_http_request(self, method, path, elapsed, nbytes):
+        """Records an HTTP request.
+
+        Args:
+            method: The HTTP method, e.g. 'GET'.
+            path: The path of the resource, relative to the API's
+                base URL.
+            elapsed: The time the request took, in seconds, including
+                any retries.
+            nbytes: The number of bytes sent and received in the
+                requests' and responses' bodies.
+        """
+        with self._lock:
+            self.http_requests[(method, get_endpoint_template(path))].add(
+                elapsed, nbytes)
+            subject_stats = self._get_subject_stats()
+            if subject_stats is not None:
+                subject_stats.http_calls += 1
+                subject_stats.http_time += elapsed
+                subject_stats.http_bytes += nbytes
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times a stage of a synchronization, e.g. "fetch".
+
+        Args:
+            name: The name of the stage.  The times of stages with the
+                same name are summed.
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def attribute(self, subject):
+        """Attributes the costs of the calling thread to a subject.
+
+        Args:
+            subject: The subject, e.g. the ID of an AgileZen story.
+        """
+        previous_subject = getattr(self._local, 'subject', None)
+        self._local.subject = subject
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            self._local.subject = previous_subject
+            with self._lock:
+                self.subjects[subject].time += elapsed
+
+    def to_json(self):
+        """Gets a report of the collected counts and timings.
+
+        Returns:
+            The report, as a JSON object.
+        """
+        with self._lock:
+            subjects = sorted(self.subjects.iteritems(),
+                              key=lambda item: item[1].time, reverse=True)
+            return {
+                'time': time.time() - self.start_time,
+                'stages': collections.OrderedDict(self.stages),
+                'apple_events': dict(
+                    [('%s %s' % key, stats.to_json())
+                     for key, stats in self.apple_events.iteritems()]),
+                'http_requests': dict(
+                    [('%s %s' % key, stats.to_json())
+                     for key, stats in self.http_requests.iteritems()]),
+                'subjects': [
+                    dict(stats.to_json(), subject=subject)
+                    for subject, stats in subjects],
+                }
+
+    def dump_json(self, path):
+        """Writes a report of the collected counts and timings.
+
+        Args:
+            path: The path of the JSON file to write.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2, sort_keys=True)
+
+    def dump(self, f):
+        """Writes a human-readable summary of the counts and timings.
+
+        Args:
+            f: The file object to write into.
+        """
+        report = self.to_json()
+        f.write('total: %.3fs\n' % (report['time'],))
+        for name, elapsed in report['stages'].iteritems():
+            f.write('  %-58s %9.3fs\n' % (name, elapsed))
+        for title, key in (('Apple Events', 'apple_events'),
+                           ('HTTP requests', 'http_requests')):
+            f.write('%-50s %8s %10s %12s\n' % (title, 'count', 'time',
+                                                'bytes'))
+            items = sorted(report[key].iteritems(),
+                           key=lambda item: item[1]['time'], reverse=True)
+            for name, stats in items:
+                f.write('  %-48s %8i %9.3fs %12s\n' % (
+                    name, stats['count'], stats['time'],
+                    stats.get('bytes', '')))
+        if report['subjects']:
+            f.write('%-30s %9s %8s %9s %8s %9s\n' % (
+                'most expensive stories', 'time', 'events', 'ev. time',
+                'requests', 'req. time'))
+            for stats in report['subjects'][:TOP_SUBJECTS]:
+                f.write('  %-28s %8.3fs %8i %8.3fs %8i %8.3fs\n' % (
+                    stats['subject'], stats['time'],
+                    stats['apple_events'], stats['apple_event_time'],
+                    stats['http_calls'], stats['http_time']))
+
+
+@contextlib.contextmanager
+def _no_profiling():
+    yield
+
+
+def stage(profiler, name):
+    """Times a stage of a synchronization, if profiling.
+
+    Args:
+        profiler: The Profiler to record the stage into, or None.
+        name: The name of the stage.
+
+    Returns:
+        A context manager.
+    """
+    if profiler is None:
+        return _no_profiling()
+    return profiler.stage(name)
+
+
+def attribute(profiler, subject):
+    """Attributes the costs of the calling thread to a subject, if profiling.
+
+    Args:
+        profiler: The Profiler to record the costs into, or None.
+        subject: The subject, e.g. the ID of an AgileZen story.
+
+    Returns:
+        A context manager.
+    """
+    if profiler is None:
+        return _no_profiling()
+    return profiler.attribute(subject)
@@ -0,0 +1,540 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import logging
+
+import omnifocus
+import profiling
+
+
+LOG = logging.getLogger('syncplan')
+
+
+def _value_to_json(value):
+    """Converts an operation's field value into a JSON value.
+
+    Args:
+        value: The value to convert, e.g. an AgileZen Story object.
+
+    Returns:
+        The JSON value.
+    """
+    if hasattr(value, 'to_json'):
+        return value.to_json()
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return [_value_to_json(v) for v in value]
+    else:
+        return value
+
+
+class Operation(object):
+    """A write operation in a synchronization plan.
+    """
+
+    # Whether the operation writes into OmniFocus instead of AgileZen.
+    is_omnifocus = False
+
+    # Whether all the previous operations in the plan, except other
+    # barrier operations, must be executed before executing the
+    # operation.
+    is_barrier = False
+
+    @property
+    def key(self):
+        """The key identifying the sequence of operations to execute in
+        order, e.g. the ID of the story the operation modifies.
+        """
+        return self.story_id
+
+    def to_json(self):
+        json_obj = dict([(field, _value_to_json(getattr(self, field)))
+                         for field in self._fields])
+        json_obj['op'] = self.__class__.__name__
+        return json_obj
+
+
+class CreateStory(collections.namedtuple('CreateStory',
+                                         ('of_project_id', 'story')),
+                  Operation):
+
+    @property
+    def key(self):
+        return self.of_project_id
+
+    def describe(self):
+        return 'create AgileZen story "%s"' % (self.story.text,)
+
+
+class UpdateStory(collections.namedtuple('UpdateStory', ('story',)),
+                  Operation):
+
+    @property
+    def key(self):
+        return self.story.id
+
+    def describe(self):
+        return 'update AgileZen story %s "%s"' % (self.story.id,
+                                                  self.story.text)
+
+
+class SetStoryTags(collections.namedtuple('SetStoryTags',
+                                          ('story_id', 'tags')),
+                   Operation):
+
+    def describe(self):
+        return 'set AgileZen tags %s in story %s' % (
+            ', '.join(sorted(tag.name for tag in self.tags)), self.story_id)
+
+
+class DeleteStory(collections.namedtuple('DeleteStory', ('story_id', 'text')),
+                  Operation):
+
+    def describe(self):
+        return 'delete AgileZen story %s "%s"' % (self.story_id, self.text)
+
+
+class DeleteTask(collections.namedtuple('DeleteTask', ('story_id', 'task')),
+                 Operation):
+
+    def describe(self):
+        return 'delete AgileZen task %s "%s" in story %s' % (
+            self.task.id, self.task.text, self.story_id)
+
+
+class CreateTask(collections.namedtuple('CreateTask', ('story_id', 'task')),
+                 Operation):
+
+    def describe(self):
+        return 'create AgileZen task "%s" in story %s' % (
+            self.task.text, self.story_id)
+
+
+class UpdateTask(collections.namedtuple('UpdateTask', ('story_id', 'task')),
+                 Operation):
+    """Updates the text and completion status of a task in a story.
+    """
+
+    def describe(self):
+        return 'update AgileZen task %s "%s" in story %s' % (
+            self.task.id, self.task.text, self.story_id)
+
+
+class CompleteTask(collections.namedtuple('CompleteTask',
+                                          ('story_id', 'task')),
+                   Operation):
+
+    def describe(self):
+        return 'mark as completed AgileZen task %s "%s" in story %s' % (
+            self.task.id, self.task.text, self.story_id)
+
+
+class ReorderTasks(collections.namedtuple('ReorderTasks',
+                                          ('story_id', 'tasks')),
+                   Operation):
+    """Reorders the tasks in a story.
+
+    The tasks field is the list of (task_id, text) tuples in the new
+    order, where task_id is None for tasks created earlier in the plan.
+    """
+
+    def describe(self):
+        return 'reorder %i AgileZen tasks in story %s' % (len(self.tasks),
+                                                          self.story_id)
+
+
+class DeleteTag(collections.namedtuple('DeleteTag', ('tag_id', 'name')),
+                Operation):
+
+    # Tags must be deleted only after they are dissociated from stories.
+    is_barrier = True
+
+    @property
+    def key(self):
+        return ('tag', self.tag_id)
+
+    def describe(self):
+        return 'delete AgileZen tag %s "%s"' % (self.tag_id, self.name)
+
+
+class SetProjectActive(collections.namedtuple('SetProjectActive',
+                                              ('project_id', 'name')),
+                       Operation):
+
+    is_omnifocus = True
+
+    @property
+    def key(self):
+        return self.project_id
+
+    def describe(self):
+        return 'mark as active OmniFocus project %s "%s"' % (self.project_id,
+                                                             self.name)
+
+
+class SetProjectCompleted(collections.namedtuple('SetProjectCompleted',
+                                                 ('project_id', 'name')),
+                          Operation):
+
+    is_omnifocus = True
+
+    @property
+    def key(self):
+        return self.project_id
+
+    def describe(self):
+        return 'mark as completed OmniFocus project %s "%s"' % (
+            self.project_id, self.name)
+
+
+class SetTaskCompleted(collections.namedtuple('SetTaskCompleted',
+                                              ('task_id', 'name')),
+                       Operation):
+
+    is_omnifocus = True
+
+    @property
+    def key(self):
+        return self.task_id
+
+    def describe(self):
+        return 'mark as completed OmniFocus task %s "%s"' % (self.task_id,
+                                                             self.name)
+
+
+class SyncPlan(object):
+    """An ordered list of write operations to synchronize OF and AZ.
+    """
+
+    def __init__(self, az_project_id, ops=None):
+        """Initialize this plan.
+
+        Args:
+            az_project_id: The ID of the AgileZen project to write to.
+            ops: The initial list of Operation objects.  Defaults to
+                None, i.e. an empty plan.
+        """
+        self.az_project_id = az_project_id
+        self.ops = list(ops) if ops else []
+        # The list of (keys, of_project_id, state) tuples of the
+        # states of the projects to store or delete once the
+        # operations with the given keys are successfully executed.
+        # The state is a syncstate.ProjectState object to store, or
+        # None if the project's state must be deleted.
+        self.project_states = []
+        # The dict of the values to store for the AgileZen project
+        # once the plan is executed, by name, e.g. the time at which
+        # the stories in the archive phase were listed.
+        self.project_values = {}
+        # The list of (keys, name, record) tuples of the tag
+        # registrations to store or delete once the operations with
+        # the given keys are successfully executed.  The record is a
+        # syncstate.TagRecord object to store, or None if the tag's
+        # registration must be deleted.
+        self.tag_records = []
+        # The list of (keys, of_project_id, story_id, task_ids) tuples
+        # of the identities of the tasks of stories to store once the
+        # operations with the given keys are successfully executed.
+        # The story_id is None for a created story.  The task_ids is
+        # the list of (of_task_id, az_task_id, text) tuples of the
+        # story's tasks, where az_task_id is None for a created task.
+        self.task_ids = []
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def append(self, op):
+        self.ops.append(op)
+
+    def extend(self, ops):
+        self.ops.extend(ops)
+
+    def count_calls(self):
+        """Estimates the number of calls needed to execute this plan.
+
+        Every AgileZen operation requires one API call.  OmniFocus
+        operations are applied in batches, so all the operations of a
+        same type require a single Apple Event.
+
+        Returns:
+            A tuple (az_calls, of_calls) of the number of AgileZen API
+            calls and of OmniFocus Apple Events.
+        """
+        of_ops = [op for op in self.ops if op.is_omnifocus]
+        return (len(self.ops) - len(of_ops),
+                len(set(type(op) for op in of_ops)))
+
+    def to_json(self):
+        return {
+            'az_project_id': self.az_project_id,
+            'ops': [op.to_json() for op in self.ops],
+            }
+
+    def dump(self, f):
+        """Writes a human-readable description of this plan.
+
+        Args:
+            f: The file object to write into.
+        """
+        for op in self.ops:
+            f.write(op.describe() + '\n')
+        az_calls, of_calls = self.count_calls()
+        f.write('%i operations: %i AgileZen API calls, '
+                '%i OmniFocus Apple Events\n' % (len(self.ops), az_calls,
+                                                 of_calls))
+
+
+class StreamingPlan(SyncPlan):
+    """A plan which operations are executed as soon as they are planned.
+
+    Operations are submitted to a PlanExecutor when appended, and are
+    not retained, so that the writes of a synchronization start before
+    it is completely planned, and memory usage doesn't grow with the
+    number of operations.  Project states are retained as in any plan.
+    """
+
+    def __init__(self, az_project_id, executor):
+        """Initialize this plan.
+
+        Args:
+            az_project_id: The ID of the AgileZen project to write to.
+            executor: The PlanExecutor to submit operations to.
+        """
+        SyncPlan.__init__(self, az_project_id)
+        self.executor = executor
+        self._ops_count = 0
+
+    def __len__(self):
+        return self._ops_count
+
+    def append(self, op):
+        self.executor.submit(self.az_project_id, op)
+        self._ops_count += 1
+
+    def extend(self, ops):
+        for op in ops:
+            self.append(op)
+
+
+class PlanExecutor(object):
+    """Executes synchronization plans.
+
+    AgileZen operations are submitted to the AgileZen DAO's executor,
+    so that operations on different stories may be executed
+    concurrently, and operations on a same story are executed in
+    order.  OmniFocus operations are queued, and applied all at once
+    when waiting for the execution of all operations, so that Apple
+    Events don't stall the AgileZen operations.
+    """
+
+    def __init__(self, omnifocus_dao, agilezen_dao, profiler=None):
+        """Initialize this executor with the OF and AZ DAOs.
+
+        Args:
+            omnifocus_dao: The OmniFocusDataAccess object to use to
+                write into the OmniFocus database.
+            agilezen_dao: The AgileZenDataAccess object to use to
+                write into the AgileZen database.
+            profiler: The profiling.Profiler to attribute the costs of
+                operations to their keys, e.g. story IDs.  Defaults to
+                None, i.e. no profiling.
+        """
+        self.of_dao = omnifocus_dao
+        self.az_dao = agilezen_dao
+        self.profiler = profiler
+        # The queue of the OmniFocus writes, and the writes applied so
+        # far, as omnifocus.AppliedWrite objects.
+        self._of_writes = omnifocus.WriteQueue(omnifocus_dao)
+        self.applied_of_writes = []
+        # The IDs of the created stories, by OmniFocus project ID.
+        self.created_story_ids = {}
+        # The IDs of the AZ tasks created during execution, by text,
+        # for every operation key, i.e. every story.
+        self._created_task_ids = collections.defaultdict(dict)
+        # The exceptions raised by failed operations, by key.
+        self._failures = {}
+        # Whether AgileZen operations were submitted since the last
+        # barrier, so that consecutive barriers, e.g. tag deletions,
+        # are executed concurrently.
+        self._barrier_needed = False
+        self._appliers = {
+            CreateStory: self._create_story,
+            UpdateStory: self._update_story,
+            SetStoryTags: self._set_story_tags,
+            DeleteStory: self._delete_story,
+            DeleteTask: self._delete_task,
+            CreateTask: self._create_task,
+            UpdateTask: self._update_task,
+            CompleteTask: self._complete_task,
+            ReorderTasks: self._reorder_tasks,
+            DeleteTag: self._delete_tag,
+            SetProjectActive: self._set_project_active,
+            SetProjectCompleted: self._set_project_completed,
+            SetTaskCompleted: self._set_task_completed,
+            }
+
+    def _create_story(self, az_project_id, op, created_task_ids):
+        created_story = self.az_dao.create_project_story(az_project_id,
+                                                         op.story)
+        self.created_story_ids[op.of_project_id] = created_story.id
+        for task in created_story.tasks or ():
+            created_task_ids[task.text] = task.id
+
+    def _update_story(self, az_project_id, op, created_task_ids):
+        self.az_dao.update_project_story(az_project_id, op.story)
+
+    def _set_story_tags(self, az_project_id, op, created_task_ids):
+        self.az_dao.update_project_story_tags(az_project_id, op.story_id,
+                                              op.tags)
+
+    def _delete_story(self, az_project_id, op, created_task_ids):
+        self.az_dao.delete_project_story(az_project_id, op.story_id)
+
+    def _delete_task(self, az_project_id, op, created_task_ids):
+        self.az_dao.delete_project_story_task(az_project_id, op.story_id,
+                                              op.task.id)
+
+    def _create_task(self, az_project_id, op, created_task_ids):
+        created_task = self.az_dao.create_project_story_task(
+            az_project_id, op.story_id, op.task)
+        created_task_ids[created_task.text] = created_task.id
+
+    def _update_task(self, az_project_id, op, created_task_ids):
+        self.az_dao.update_project_story_task(az_project_id, op.story_id,
+                                              op.task)
+
+    def _complete_task(self, az_project_id, op, created_task_ids):
+        self.az_dao.update_project_story_task(
+            az_project_id, op.story_id, op.task._replace(status=True))
+
+    def _reorder_tasks(self, az_project_id, op, created_task_ids):
+        self.az_dao.reorder_project_story_tasks(
+            az_project_id, op.story_id,
+            [task_id if task_id is not None else created_task_ids[text]
+             for task_id, text in op.tasks])
+
+    def _delete_tag(self, az_project_id, op, created_task_ids):
+        self.az_dao.delete_project_tag(az_project_id, op.tag_id)
+
+    def _set_project_active(self, az_project_id, op, created_task_ids):
+        project = self.of_dao.get_project_by_id(op.project_id)
+        if project is not None:
+            self._of_writes.set_project_active(project, op.key)
+
+    def _set_project_completed(self, az_project_id, op, created_task_ids):
+        project = self.of_dao.get_project_by_id(op.project_id)
+        if project is not None:
+            self._of_writes.set_project_completed(project, op.key)
+
+    def _set_task_completed(self, az_project_id, op, created_task_ids):
+        task = self.of_dao.get_task_by_id(op.task_id)
+        if task is not None:
+            self._of_writes.set_task_completed(task, op.key)
+
+    def get_created_task_id(self, key, text):
+        """Gets the ID of a task created during execution.
+
+        Args:
+            key: The key of the operation that created the task, i.e.
+                the ID of an existing story, or the OmniFocus project
+                ID of a created story.
+            text: The text of the task.
+
+        Returns:
+            The ID of the created task, or None if unknown.
+        """
+        created_task_ids = self._created_task_ids.get(key)
+        if created_task_ids is None:
+            return None
+        return created_task_ids.get(text)
+
+    def _apply(self, az_project_id, op, created_task_ids):
+        LOG.debug('executing: %s', op.describe())
+        with profiling.attribute(self.profiler, op.key):
+            self._appliers[type(op)](az_project_id, op, created_task_ids)
+
+    def submit(self, az_project_id, op):
+        """Submits an operation for execution.
+
+        OmniFocus operations are queued immediately, AgileZen
+        operations may be executed asynchronously.  A barrier
+        operation waits for the execution of all previously submitted
+        non-barrier operations first, so that consecutive barrier
+        operations are executed concurrently.
+
+        Args:
+            az_project_id: The ID of the AgileZen project to write to.
+            op: The Operation to execute.
+        """
+        if op.is_barrier and self._barrier_needed:
+            self._failures.update(self.az_dao.wait())
+            self._barrier_needed = False
+        elif not op.is_barrier and not op.is_omnifocus:
+            self._barrier_needed = True
+        if op.is_omnifocus:
+            try:
+                self._apply(az_project_id, op, None)
+            except Exception, e:
+                LOG.exception('failed to %s', op.describe())
+                self._failures[op.key] = e
+        else:
+            self.az_dao.submit(op.key, self._apply, az_project_id, op,
+                               self._created_task_ids[op.key])
+
+    def wait(self):
+        """Waits for the execution of all submitted operations.
+
+        The queued OmniFocus writes are applied once all AgileZen
+        operations are executed, and are added to applied_of_writes.
+
+        Returns:
+            A dict which keys are the keys of failed operations, e.g.
+            story IDs, and values are the exceptions they raised.  The
+            failures are forgotten after this call.
+        """
+        self._failures.update(self.az_dao.wait())
+        if len(self._of_writes):
+            applied, failures = self._of_writes.flush()
+            for write in applied:
+                LOG.info('set %s of %i OmniFocus %s to %r', write.name,
+                         len(write.obj_ids),
+                         write.elements_name.replace('flattened_', ''),
+                         write.value)
+            self.applied_of_writes.extend(applied)
+            self._failures.update(failures)
+        failures = self._failures
+        self._failures = {}
+        return failures
+
+    def execute(self, plan):
+        """Executes a plan.
+
+        Args:
+            plan: The SyncPlan to execute.
+
+        Returns:
+            A dict which keys are the keys of failed operations, e.g.
+            story IDs, and values are the exceptions they raised.
+        """
+        for op in plan:
+            self.submit(plan.az_project_id, op)
+        return self.wait()
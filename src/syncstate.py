@@ -0,0 +1,308 @@
+#!/usr/bin/python2.7
+#
+# Pikpoint - OmniFocus to AgileZen (GTD to Personal Kanban) synchronizer
+# Copyright (C) 2012  Romain Lenglet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+import agilezen
+
+
+LOG = logging.getLogger('syncstate')
+
+
+def fingerprint_story(story, with_owner=True):
+    """Computes a fingerprint of the synchronized contents of a story.
+
+    Args:
+        story: The AgileZen Story object, with its tags and tasks.
+        with_owner: Whether the story's owner is synchronized, and
+            must be part of the fingerprint.  Defaults to True.
+
+    Returns:
+        The fingerprint, as a hexadecimal string.  The tags and tasks
+        are not decoded, if they were not decoded yet.
+    """
+    owner_username = None
+    if with_owner and story.owner is not None:
+        owner_username = story.owner.userName
+    tag_names = sorted(
+        name for (name,) in agilezen.iter_field_values(story.tags, ('name',)))
+    tasks = [
+        (text, bool(status)) for text, status
+        in agilezen.iter_field_values(story.tasks, ('text', 'status'))]
+    contents = [
+        story.text,
+        story.details,
+        story.color,
+        story.phase.id,
+        owner_username,
+        tag_names,
+        tasks,
+        ]
+    return hashlib.sha1(json.dumps(contents)).hexdigest()
+
+
+class ProjectState(collections.namedtuple('ProjectState', (
+            'of_project_id', 'az_story_id', 'modification_date',
+            'fingerprint', 'phase_id', 'expiration_date',
+            'snapshot_fingerprint'))):
+    """The state of an OmniFocus project at its last successful sync.
+
+    The modification_date is the latest modification date of the
+    project and of its tasks, and the expiration_date is the date at
+    which the story must be synchronized again even if unmodified,
+    e.g. once the project becomes due soon.  Both dates are ISO 8601
+    strings, or None.  The fingerprint is the fingerprint of the
+    story, and the snapshot_fingerprint that of the rendering of the
+    project, which changes without the project being modified when a
+    context or folder is renamed.
+    """
+
+
+class TagRecord(collections.namedtuple('TagRecord', (
+            'name', 'tag_id', 'last_used_time', 'ref_count'))):
+    """The registration of a tag of an AgileZen project.
+
+    The tag_id is None if the tag was created implicitly by a story
+    update, and was not read from AgileZen yet.  The last_used_time is
+    the ISO 8601 time of the last sync at which the tag was used by
+    any story, and ref_count is the number of stories using it.
+    """
+
+
+class SyncStateStore(object):
+    """A persistent store of the states of synchronized projects.
+
+    The store is an SQLite database.  States are stored per AgileZen
+    project, so that a same OmniFocus project may be synchronized into
+    several AgileZen projects.
+    """
+
+    def __init__(self, path):
+        """Open the store in the given file, creating it if necessary.
+
+        Args:
+            path: The path of the SQLite database file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS project_states ('
+                'az_project_id INTEGER NOT NULL, '
+                'of_project_id TEXT NOT NULL, '
+                'az_story_id INTEGER, '
+                'modification_date TEXT, '
+                'fingerprint TEXT, '
+                'phase_id INTEGER, '
+                'expiration_date TEXT, '
+                'snapshot_fingerprint TEXT, '
+                'PRIMARY KEY (az_project_id, of_project_id))')
+            # Add the columns missing in stores created by previous
+            # versions.
+            columns = [row[1] for row in self.conn.execute(
+                    'PRAGMA table_info(project_states)')]
+            if 'snapshot_fingerprint' not in columns:
+                self.conn.execute('ALTER TABLE project_states '
+                                  'ADD COLUMN snapshot_fingerprint TEXT')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tags ('
+                'az_project_id INTEGER NOT NULL, '
+                'name TEXT NOT NULL, '
+                'tag_id INTEGER, '
+                'last_used_time TEXT, '
+                'ref_count INTEGER NOT NULL, '
+                'PRIMARY KEY (az_project_id, name))')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS task_ids ('
+                'az_project_id INTEGER NOT NULL, '
+                'az_story_id INTEGER NOT NULL, '
+                'of_task_id TEXT NOT NULL, '
+                'az_task_id INTEGER NOT NULL, '
+                'PRIMARY KEY (az_project_id, az_story_id, of_task_id))')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS project_values ('
+                'az_project_id INTEGER NOT NULL, '
+                'name TEXT NOT NULL, '
+                'value TEXT, '
+                'PRIMARY KEY (az_project_id, name))')
+
+    def close(self):
+        self.conn.close()
+
+    def get_project_states(self, az_project_id):
+        """Gets the states of all the projects synced into an AZ project.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+
+        Returns:
+            A dict which keys are OmniFocus project IDs and values are
+            ProjectState objects.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT of_project_id, az_story_id, modification_date, '
+                'fingerprint, phase_id, expiration_date, '
+                'snapshot_fingerprint '
+                'FROM project_states WHERE az_project_id = ?',
+                (az_project_id,)).fetchall()
+        return dict([(row[0], ProjectState(*row)) for row in rows])
+
+    def update_project_states(self, az_project_id, states,
+                              deleted_of_project_ids=()):
+        """Stores and deletes project states, in one transaction.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            states: The iterable of ProjectState objects to store.
+            deleted_of_project_ids: The iterable of the IDs of the
+                OmniFocus projects which states must be deleted.
+                Defaults to no projects.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO project_states '
+                    '(az_project_id, of_project_id, az_story_id, '
+                    'modification_date, fingerprint, phase_id, '
+                    'expiration_date, snapshot_fingerprint) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(az_project_id,) + tuple(state) for state in states])
+                self.conn.executemany(
+                    'DELETE FROM project_states '
+                    'WHERE az_project_id = ? AND of_project_id = ?',
+                    [(az_project_id, of_project_id)
+                     for of_project_id in deleted_of_project_ids])
+
+    def get_project_value(self, az_project_id, name):
+        """Gets a value stored for an AZ project.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            name: The name of the value.
+
+        Returns:
+            The value, as a string, or None if no value is stored.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT value FROM project_values '
+                'WHERE az_project_id = ? AND name = ?',
+                (az_project_id, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def update_project_values(self, az_project_id, values):
+        """Stores values for an AZ project, in one transaction.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            values: The dict of the string values to store, by name.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO project_values '
+                    '(az_project_id, name, value) VALUES (?, ?, ?)',
+                    [(az_project_id, name, value)
+                     for name, value in values.iteritems()])
+
+    def get_tags(self, az_project_id):
+        """Gets the registered tags of an AZ project.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+
+        Returns:
+            A dict which keys are tag names and values are TagRecord
+            objects.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT name, tag_id, last_used_time, ref_count '
+                'FROM tags WHERE az_project_id = ?',
+                (az_project_id,)).fetchall()
+        return dict([(row[0], TagRecord(*row)) for row in rows])
+
+    def update_tags(self, az_project_id, records, deleted_names=()):
+        """Stores and deletes tag registrations, in one transaction.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            records: The iterable of TagRecord objects to store.
+            deleted_names: The iterable of the names of the tags which
+                registrations must be deleted.  Defaults to no tags.
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO tags '
+                    '(az_project_id, name, tag_id, last_used_time, '
+                    'ref_count) VALUES (?, ?, ?, ?, ?)',
+                    [(az_project_id,) + tuple(record) for record in records])
+                self.conn.executemany(
+                    'DELETE FROM tags WHERE az_project_id = ? AND name = ?',
+                    [(az_project_id, name) for name in deleted_names])
+
+    def get_task_ids(self, az_project_id, az_story_id):
+        """Gets the IDs of the AZ tasks of the OF tasks of a story.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            az_story_id: The ID of the AgileZen story.
+
+        Returns:
+            A dict which keys are OmniFocus task IDs and values are
+            AgileZen task IDs.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT of_task_id, az_task_id FROM task_ids '
+                'WHERE az_project_id = ? AND az_story_id = ?',
+                (az_project_id, az_story_id)).fetchall()
+        return dict(rows)
+
+    def update_task_ids(self, az_project_id, story_task_ids):
+        """Replaces the IDs of the tasks of stories, in one transaction.
+
+        Args:
+            az_project_id: The ID of the AgileZen project.
+            story_task_ids: The iterable of (az_story_id, task_ids)
+                tuples, where task_ids is the list of (of_task_id,
+                az_task_id) tuples of all the tasks of the story, or
+                an empty list if the story was deleted.
+        """
+        with self._lock:
+            with self.conn:
+                for az_story_id, task_ids in story_task_ids:
+                    self.conn.execute(
+                        'DELETE FROM task_ids '
+                        'WHERE az_project_id = ? AND az_story_id = ?',
+                        (az_project_id, az_story_id))
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO task_ids '
+                        '(az_project_id, az_story_id, of_task_id, '
+                        'az_task_id) VALUES (?, ?, ?, ?)',
+                        [(az_project_id, az_story_id, of_task_id, az_task_id)
+                         for of_task_id, az_task_id in task_ids])